@@ -30,6 +30,13 @@ import sys
 import re
 import os
 import getopt
+import array
+import ipaddr
+
+try:
+    import numpy
+except ImportError:
+    numpy=None # table statistics fall back to Python loops, see TableStats
 
 import common
 import graph
@@ -74,51 +81,233 @@ def get_bgp_pathlen(p):
     return (len(p.split(' '))-1)
 
 
+class PathLenBucket(object):
+    """ Path lengths of prefixes of one prefix length: count of prefixes,
+    sum of path lengths and histogram path length -> count of prefixes.
+    len() of the bucket is the count of prefixes.
+    """
+
+    __slots__=['count', 'total', 'hist']
+
+    def __init__(self):
+        self.count=0
+        self.total=0
+        self.hist={}
+
+    def add(self, pathlen):
+        """ Add a prefix.
+
+        :param int pathlen: AS-path length of the prefix
+        """
+        self.count+=1
+        self.total+=pathlen
+        self.hist[pathlen]=self.hist.get(pathlen, 0)+1
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        return (self.count, self.total, self.hist)
+
+    def __setstate__(self, state):
+        (self.count, self.total, self.hist)=state
+
+
+
+class TableStats(object):
+    """ Statistics engine of a BGP dump. The dump is scanned once to build
+    columns of prefix length (pfxlen, see get_pfxlen()), AS-path length
+    (pathlen), path flag (valid, 0 when the row can not go to buckets),
+    best flag (best), RIR index (rir, index to rirs or -1 when not resolved)
+    and prefix length of the network for RIR stats (rirpfxlen, see
+    ipaddr.IPNetwork). Statistics are computed from the columns, with
+    vectorized numpy operations when numpy is available and with Python
+    loops otherwise.
+    """
+
+    def __init__(self, bgpdump, ipv6=False, ianadir=None, bestonly=False):
+        """
+        :param bgpdump: Data structure of parsed show ip bgp dump
+        :param bool ipv6: (=expect /128 masks)
+        :param ianadir: ianaspace.IanaDirectory object to resolve RIRs or None
+        :param bool bestonly: Ignore received but not used routes
+        """
+
+        self.ipv6=ipv6
+        self.rng=(128 if ipv6 else 32)
+        self.rirs=[]
+        self.error=None
+        ririds={}
+
+        pfxlen=array.array('B')
+        pathlen=array.array('H')
+        valid=array.array('B')
+        best=array.array('B')
+        rir=array.array('h')
+        rirpfxlen=array.array('B')
+
+        if ianadir:
+            common.d("bgp.TableStats: matching prefixes in a tree (%d)"%len(bgpdump))
+
+        for r in bgpdump:
+            b=(1 if r[0] and '>' in r[0] else 0)
+            if bestonly and not b:
+                continue
+
+            try:
+                nm = get_pfxlen(r[1])
+            except Exception as e:
+                # raised by buckets(), RIR stats do not need it
+                self.error=e
+                nm=None
+            try:
+                l=get_bgp_pathlen(r[3])
+            except:
+                l=None
+            if nm == None:
+                (nm, l, v)=(0, 0, 0)
+            elif l == None or nm > self.rng:
+                # the row is still counted in RIR stats
+                print "EXC: nm="+str(nm)+" r[6]="+str(r)
+                (nm, l, v)=(0, 0, 0)
+            else:
+                v=1
+
+            rid=-1
+            rnm=0
+            if ianadir:
+                net=ipaddr.IPNetwork(r[1])
+                name=ianadir.resolve_rir(net)
+                if not name:
+                    common.w("No IANA assignment for", str(r[1]))
+                elif name in ririds:
+                    rid=ririds[name]
+                else:
+                    rid=ririds[name]=len(self.rirs)
+                    self.rirs.append(name)
+                rnm=net.prefixlen
+
+            pfxlen.append(nm)
+            pathlen.append(l)
+            valid.append(v)
+            best.append(b)
+            rir.append(rid)
+            rirpfxlen.append(rnm)
+
+        if numpy:
+            self.pfxlen=numpy.array(pfxlen, dtype=numpy.intp)
+            self.pathlen=numpy.array(pathlen, dtype=numpy.intp)
+            self.valid=numpy.array(valid, dtype=numpy.bool_)
+            self.best=numpy.array(best, dtype=numpy.bool_)
+            self.rir=numpy.array(rir, dtype=numpy.intp)
+            self.rirpfxlen=numpy.array(rirpfxlen, dtype=numpy.intp)
+        else:
+            self.pfxlen=pfxlen
+            self.pathlen=pathlen
+            self.valid=valid
+            self.best=best
+            self.rir=rir
+            self.rirpfxlen=rirpfxlen
+
+
+    def _rows(self, bestonly):
+        """ Internal method. Do not use.
+
+        :param bool bestonly: Select best routes only
+        :returns: Indices of selected rows
+        """
+        if bestonly:
+            return [i for i in xrange(len(self.pfxlen)) if self.best[i]]
+        return xrange(len(self.pfxlen))
+
+
+    def buckets(self, bestonly=False):
+        """ Path length buckets, see gen_buckets().
+
+        :param bool bestonly: Count best routes only
+        :returns: List of PathLenBucket objects indexed by prefix length
+        """
+
+        if self.error:
+            raise self.error
+
+        buckets=[PathLenBucket() for i in range(0,self.rng+1)]
+
+        if not numpy:
+            for i in self._rows(bestonly):
+                if self.valid[i]:
+                    buckets[self.pfxlen[i]].add(self.pathlen[i])
+            return buckets
+
+        sel=(self.valid & self.best if bestonly else self.valid)
+        pfxlen=self.pfxlen[sel]
+        pathlen=self.pathlen[sel]
+        width=(int(pathlen.max())+1 if len(pathlen) else 1)
+
+        # hist[pfxlen, pathlen] = count of prefixes
+        hist=numpy.bincount(pfxlen*width+pathlen, minlength=(self.rng+1)*width).reshape(self.rng+1, width)
+        counts=hist.sum(axis=1)
+        totals=hist.dot(numpy.arange(width))
+
+        for (p, l) in zip(*numpy.nonzero(hist)):
+            buckets[p].hist[int(l)]=int(hist[p, l])
+        for p in numpy.nonzero(counts)[0]:
+            buckets[p].count=int(counts[p])
+            buckets[p].total=int(totals[p])
+        return buckets
+
+
+    def rir_counts(self, bestonly=False):
+        """ Prefix counts for each RIR, see gen_rir_counts().
+
+        :param bool bestonly: Count best routes only
+        :returns: Dict RIR -> (count of prefixes, sum of prefix lengths)
+        """
+
+        if not numpy:
+            counts={}
+            for i in self._rows(bestonly):
+                if self.rir[i] >= 0:
+                    name=self.rirs[self.rir[i]]
+                    (cnt, total)=counts.get(name, (0, 0))
+                    counts[name]=(cnt+1, total+self.rirpfxlen[i])
+            return counts
+
+        sel=(self.rir >= 0)
+        if bestonly:
+            sel&=self.best
+        counts=numpy.bincount(self.rir[sel], minlength=len(self.rirs))
+        totals=numpy.bincount(self.rir[sel], weights=self.rirpfxlen[sel], minlength=len(self.rirs))
+        return dict([(name, (int(counts[i]), int(totals[i]))) for (i, name) in enumerate(self.rirs) if counts[i]])
+
+
+
 def gen_buckets(bgpdump,ipv6=False,bestonly=False):
     """
     Reads Cisco show ip bgp output captured in a file and returns
-    list of lists of path length where:
+    list of buckets of path lengths where:
     r=gen_buckets(...)
-    r[16]=[x,y,z,...] ; x,y,z are ints. It means that there was
-    prefixes with netmask /16. One with AS-path length x, another y, ...
+    r[16]=PathLenBucket ; it contains count, sum and histogram of AS-path
+    lengths of prefixes with netmask /16.
 
     :param bgpdump: Data structure of parsed show ip bgp dump
     :param bool ipv6: (=expect /128 masks)
     :param bool bestonly: Ignore received but not used routes
     :returns: List representing the buckets
     """
-    
-    buckets=[]
-    rng=32
-    if ipv6:
-        rng=128
 
-    for i in range(0,rng+1):
-        buckets.append([])
-
-    for r in bgpdump:
-        if bestonly and not (r[0] and '>' in r[0]):
-            continue
-        
-        nm = get_pfxlen(r[1])
-        try:
-            buckets[nm].append(get_bgp_pathlen(r[3]))
-        except:
-            print "EXC: nm="+str(nm)+" r[6]="+str(r)
-
-    return buckets
+    return TableStats(bgpdump, ipv6, bestonly=bestonly).buckets()
 
 
 def avg_pathlen(bucket):
-    """ Count avgpathlen for a bucket (=list of pathlens like
-    ["1 2 3","1 2","1 2 3 4",...]
+    """ Count avgpathlen for a bucket (see PathLenBucket).
 
-    :param bucket: The list representing the bucket
-    :returns: Integer representing the avg path length
+    :param PathLenBucket bucket: The bucket
+    :returns: Float representing the avg path length
     """
 
-    if len(bucket)>0:
-        return sum(bucket)/float(len(bucket))
+    if bucket.count>0:
+        return bucket.total/float(bucket.count)
     else:
         return 0
 
@@ -126,7 +315,7 @@ def avg_pathlen(bucket):
 def format_buckets(buckets):
     """ Generate textual representation of buckets.
     
-    :param buckets: List of integers representing the buckets.
+    :param buckets: List of PathLenBucket objects.
     :returns: List of lines = the text representation.
     """
     
@@ -145,7 +334,7 @@ def format_buckets(buckets):
 
 
 def gen_pathlen_textfile(buckets,outfile,ipv6):
-    """ Gen textfile from buckets of one day (=list 1..32 or 128 of lists of pathlenghts).
+    """ Gen textfile from buckets of one day (=list 1..32 or 128 of PathLenBucket objects).
 
     :param buckets: List representing the buckets
     :param str outfile: File name to write
@@ -285,28 +474,105 @@ def gen_prefixcount_timegraphs(bucket_matrix, filenamepfx, ipv6=False):
 
 def create_path_matrix(host, days, ipv6=False):
     """ Generate matrix: [t:buckets,...] where buckets (r) contains
-    r[16]=[x,y,z,...] ; x,y,z are ints. It means that there was
-    prefixes with netmask /16. One with AS-path length x, another y, ...
+    r[16]=PathLenBucket of prefixes with netmask /16 (see gen_buckets()).
 
     :param str host: Host name to analyze
     :param days: List of Day obj. to analyze
     :param bool ipv6: IPv6 flag
     :returns: Bucket matrix
     """
-    bucket_matrix={}
-
+    a=PathLengthAnalysis(host, ipv6)
     for t in days:
-        bgpfile=bgpdump_pickle(t, host, ipv6)
-        if not bgpfile:
-            common.d("bgp.create_path_matrix skipping time "+str(t)+"...")
-            continue
+        a.visit(common.DayContext(t, host, ipv6))
+    return a.matrix
 
-        common.d("bgp.create_path_matrix processing time "+str(t)+"...")
 
-        bgpdump=common.load_pickle(bgpfile)
-        bucket_matrix[t]=gen_buckets(bgpdump, ipv6, bestonly=True)
+def gen_rir_counts(bgpdump, ianadir):
+    """ Match BGP prefixes in IANA's directory and count them for each RIR.
 
-    return bucket_matrix
+    :param bgpdump: List of paths to match
+    :param ianadir: ianaspace.IanaDirectory object
+    :returns: Dict RIR -> (count of prefixes, sum of prefix lengths)
+    """
+
+    return TableStats(bgpdump, ianadir.ipv6, ianadir).rir_counts()
+
+
+def gen_summary(bgpdump, ipv6=False, ianadir=None):
+    """ Summarize best routes of a BGP dump for timeline statistics.
+    The dump is scanned once (see TableStats).
+
+    :param bgpdump: Data structure of parsed show ip bgp dump
+    :param bool ipv6: IPv6 flag
+    :param ianadir: ianaspace.IanaDirectory object or None to skip RIR counts
+    :returns: Dict with 'buckets' (see gen_buckets()) and 'rir' (see \
+    gen_rir_counts() or None)
+    """
+
+    stats=TableStats(bgpdump, ipv6, ianadir, bestonly=True)
+    return {'buckets': stats.buckets(),
+            'rir': (stats.rir_counts() if ianadir else None)}
+
+
+def gen_summary_pickle(day, host, ipv6, ianadir):
+    """ Summarize the BGP dump of a day (see gen_summary()) and save the
+    summary to summary_pickle().
+
+    :param Day day: Day
+    :param str host: BGP host
+    :param bool ipv6: IPv6 flag
+    :param ianadir: ianaspace.IanaDirectory object
+    """
+
+    bgpfile=bgpdump_pickle(day, host, ipv6)
+    if not bgpfile:
+        raise Exception('Can not load BGP dump of %s %s'%(str(day), host))
+    common.save_pickle(gen_summary(common.load_pickle(bgpfile), ipv6, ianadir),
+                       summary_pickle(day, host, ipv6, False))
+
+
+
+class PathLengthAnalysis(object):
+    """ Path length analysis of a BGP host (see common.visit_days()).
+    Visits collect the bucket matrix (see create_path_matrix()), finish()
+    generates the text files and graphs.
+    """
+
+    def __init__(self, host, ipv6=False):
+        """
+        :param str host: Host name to analyze
+        :param bool ipv6: IPv6 flag
+        """
+        self.host=host
+        self.ipv6=ipv6
+        self.days=[]
+        self.matrix={}
+
+    def visit(self, ctx):
+        """
+        :param ctx: common.DayContext of the day
+        """
+        summary=ctx.get('bgp-summary')
+        if summary == None:
+            common.d("bgp.create_path_matrix skipping time "+str(ctx.day)+"...")
+            return
+
+        common.d("bgp.create_path_matrix processing time "+str(ctx.day)+"...")
+        self.days.append(ctx.day)
+        self.matrix[ctx.day]=summary['buckets']
+
+    def finish(self):
+        """ Generate results of all visited days.
+        """
+        gen_pathlen_timegraphs(self.matrix, common.resultdir(), self.ipv6)
+        gen_prefixcount_timegraphs(self.matrix, common.resultdir(), self.ipv6)
+
+        for d in self.days:
+            resultdir=common.resultdir(d)
+            outfile='%s/%s-pathlen%d.txt'%(resultdir, self.host, (6 if self.ipv6 else 4))
+            gen_pathlen_textfile(self.matrix[d], outfile, self.ipv6)
+            outfilepfx='%s/%s-pathlen%d'%(resultdir, self.host, (6 if self.ipv6 else 4))
+            gen_pathlen_graph(self.matrix[d], outfilepfx, self.ipv6)
 
 
 
@@ -330,6 +596,25 @@ def bgpdump_pickle(day,host,ipv6=False,check_exist=True):
                 return fn
 
 
+def summary_pickle(day,host,ipv6=False,check_exist=True):
+        """ Get Day object and return filename of the summary pickle (see
+        gen_summary_pickle()).
+
+        :param Day day: Day to find
+        :param bool ipv6: IPv6 flag
+        :param bool check_exist: if True check existence of the picke file and \
+        return None when the file does not exist. If false return the filename \
+        anyway.
+        :returns: Filename of the corresponding file
+        """
+
+        fn = '%s/bgpsummary%d-%s.pickle'%(common.resultdir(day), (6 if ipv6 else 4), host)
+        if check_exist and not os.path.isfile(fn):
+                return None
+        else:
+                return fn
+
+
 def decode_bgp_filename(filename):
     """ Decode BGP filename to tuple.
 
@@ -355,6 +640,51 @@ def decode_bgp_filename(filename):
     return (ipv6,int(g[2]),int(g[3]),int(g[4]),int(g[5]),int(g[6]),int(g[7]))
 
 
+# Day context items
+
+def _context_bgpdump(ctx):
+    """ Day context item 'bgpdump': parsed BGP dump or None. It is not kept
+    in the context, use 'bgp-best' when best routes are enough.
+    """
+    bgpfile=bgpdump_pickle(ctx.day, ctx.host, ctx.ipv6)
+    if not bgpfile:
+        return None
+    return common.load_pickle(bgpfile)
+
+def _context_best(ctx):
+    """ Day context item 'bgp-best': best routes of the BGP dump or None.
+    """
+    bgpdump=ctx.get('bgpdump')
+    if bgpdump == None:
+        return None
+    return [pv for pv in bgpdump if pv[0] and '>' in pv[0]]
+
+def _context_summary(ctx):
+    """ Day context item 'bgp-summary': summary of the BGP dump (see
+    gen_summary()) or None. The summary is read from summary_pickle(),
+    when it is missing or older than the BGP dump, it is created from the
+    dump and saved.
+    """
+    fn=summary_pickle(ctx.day, ctx.host, ctx.ipv6)
+    bgpfile=bgpdump_pickle(ctx.day, ctx.host, ctx.ipv6)
+    if fn and (not bgpfile or os.path.getmtime(fn) >= os.path.getmtime(bgpfile)):
+        summary=common.load_pickle(fn)
+        if summary['rir'] != None or ctx.ianadir == None:
+            return summary
+
+    best=ctx.get('bgp-best')
+    if best == None:
+        return None
+    summary=gen_summary(best, ctx.ipv6, ctx.ianadir)
+    if ctx.ianadir:
+        common.save_pickle(summary, summary_pickle(ctx.day, ctx.host, ctx.ipv6, False))
+    return summary
+
+common.DayContext.register('bgpdump', _context_bgpdump, False)
+common.DayContext.register('bgp-best', _context_best)
+common.DayContext.register('bgp-summary', _context_summary)
+
+
 # Module interface
 
 
@@ -402,24 +732,82 @@ def module_preprocess(bgp_hosts, bgp_data, ipv6=False):
 
 
 
+def preprocess_node(day, host, ipv6=False):
+        """
+        :returns: Name of the build node that parses BGP dump of the day (see \
+        module_preprocess_nodes())
+        """
+        return 'bgp-preprocess-%s-%s-%s'%(str(day), host, ('ipv6' if ipv6 else 'ipv4'))
+
+
+def module_preprocess_nodes(bgp_hosts, bgp_data, ipv6=False):
+        """ Create build nodes (see common.run_graph()) of module_preprocess().
+        A node parses the BGP dump of a day and host and it is rebuilt when
+        the dump or the parser (cisco.py) changes.
+
+        :param bgp_hosts: list of hostnames
+        :param bgp_data: hash bgp_host -> source directory
+        :param bool ipv6: IPv6 flag
+        :returns: List of common.BuildNode objects
+        """
+
+        code=common.code_fingerprint([cisco])
+        nodes=[]
+        names=set()
+        for host in bgp_hosts:
+            for t,fn in sorted(module_listdays([host], bgp_data, ipv6)):
+                name=preprocess_node(t, host, ipv6)
+                if name in names:
+                    continue # the first dump of the day is used
+                names.add(name)
+                outfile=bgpdump_pickle(t, host, ipv6, False)
+                nodes.append(common.BuildNode(name, cisco.gen_bgpdump_pickle, (fn, outfile, ipv6), [outfile],
+                                              [fn], [], code, 'bgp-preprocess', os.path.getsize(fn)))
+        return nodes
+
+
+def summary_node(day, host, ipv6=False):
+        """
+        :returns: Name of the build node that summarizes BGP dump of the day \
+        (see module_summary_nodes())
+        """
+        return 'bgp-summary-%s-%s-%s'%(str(day), host, ('ipv6' if ipv6 else 'ipv4'))
+
+
+def module_summary_nodes(days, ianadir, host, ipv6=False):
+        """ Create build nodes (see common.run_graph()) that summarize BGP
+        dumps of the days for postprocess (see gen_summary_pickle()). A node
+        depends on the BGP dump of the day and the IANA file.
+
+        :param days: List of Day objects
+        :param ianadir: ianaspace.IanaDirectory object
+        :param str host: BGP host
+        :param bool ipv6: IPv6 flag
+        :returns: List of common.BuildNode objects
+        """
+
+        code=common.code_fingerprint([sys.modules[__name__], sys.modules[type(ianadir).__module__]])
+        nodes=[]
+        for d in days:
+            fn=bgpdump_pickle(d, host, ipv6)
+            nodes.append(common.BuildNode(summary_node(d, host, ipv6), gen_summary_pickle, (d, host, ipv6, ianadir),
+                                          [summary_pickle(d, host, ipv6, False)], [ianadir.listfile],
+                                          [preprocess_node(d, host, ipv6)], code, 'bgp-summary',
+                                          (os.path.getsize(fn) if fn else 0)))
+        return nodes
+
+
 def module_postprocess(host, days, ipv6=False):
     """ Main function to be called from run_all.
     Returns nothing but generates a lot of result files.
+    run_all visits days with PathLengthAnalysis together with other analyses
+    instead (see common.visit_days()).
 
     :param hosts: list of hostnames
     :param days: list of days
     :param bool ipv6: IPv6 flag
     """
-    m=create_path_matrix(host, days, ipv6)
-    gen_pathlen_timegraphs(m, common.resultdir(), ipv6)
-    gen_prefixcount_timegraphs(m, common.resultdir(), ipv6)
-
-    for d in days:
-        resultdir=common.resultdir(d)
-        outfile='%s/%s-pathlen%d.txt'%(resultdir, host, (6 if ipv6 else 4))
-        gen_pathlen_textfile(m[d], outfile, ipv6)
-        outfilepfx='%s/%s-pathlen%d'%(resultdir, host, (6 if ipv6 else 4))
-        gen_pathlen_graph(m[d], outfilepfx, ipv6)
+    common.visit_days(days, host, ipv6, [PathLengthAnalysis(host, ipv6)])
         
 
 
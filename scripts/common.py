@@ -30,8 +30,18 @@ import sys
 import re
 import os
 import tempfile
+import socket
+import struct
 import cPickle as pickle
 import ipaddr
+import multiprocessing
+import Queue
+import traceback
+import resource
+import time
+import errno
+import threading
+import hashlib
 
 
 # Constants
@@ -42,6 +52,25 @@ DEBUG=True
 BIN_TAR='/bin/tar'
 BIN_RM='/bin/rm'
 
+PREFIX_CACHE_LIMIT=65536 # max. number of prefixes cached by prefix_to_int()
+
+MEM_PROFILE_PICKLE='/memprofile.pickle' # peak RSS of task classes, see run_tasks()
+MEM_PROFILE_RUNS=5 # number of recent runs that the peak RSS of a task class is taken from
+
+CLUSTER_DIR='/cluster' # shared work queue of nodes, see run_cluster_worker()
+CLUSTER_TASKS_PICKLE='/tasks.pickle'
+CLUSTER_LOCK_DIR='/locks'
+CLUSTER_DONE_DIR='/done'
+CLUSTER_LEASE=900 # seconds before a lock of a silent node expires
+CLUSTER_POLL=10 # seconds between checks of the work queue
+
+BUILD_DIR='/build' # build records of artifacts, see run_graph()
+BUILD_HASHES_PICKLE='/hashes.pickle' # cache of input file hashes
+
+RECORD_MAGIC='BGPCREC1' # header of record files, see RecordWriter
+RECORD_BATCH=1000 # records per frame of a record file
+RECORD_CHECKPOINT=60 # seconds between checkpoints of a record file
+
 
 
 
@@ -193,7 +222,53 @@ def normalize_ipv4_prefix(pfx):
         m = resolve_mask(a)
 
     return str(a)+'/'+str(m)
-    
+
+
+# cache of parsed prefixes, see prefix_to_int()
+_glob_prefix_cache={}
+
+def prefix_to_int(pfx):
+    """ Convert prefix in text form to integers. Results are cached
+    (the same prefix is usually tested against many filters in a row).
+
+    :param str pfx: Prefix in the text form, i.e. 192.168.1.0/24 or 2001:db8::/32
+    :returns: Tuple (ipv6, network, prefixlen) where ipv6 is bool, network \
+    is int with host bits cleared and prefixlen is int
+    """
+
+    if pfx in _glob_prefix_cache:
+        return _glob_prefix_cache[pfx]
+
+    if len(_glob_prefix_cache) >= PREFIX_CACHE_LIMIT:
+        _glob_prefix_cache.clear()
+
+    s=pfx.strip()
+    if s.find(':') < 0 and s.find('/') < 0:
+        s=normalize_ipv4_prefix(s)
+    addr,plen=s.split('/')
+    plen=int(plen)
+
+    if addr.find(':') > -1:
+        hi,lo=struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, addr))
+        r=(True, ((hi << 64) | lo) & prefixlen_to_mask(plen, True), plen)
+    else:
+        r=(False, struct.unpack('!I', socket.inet_aton(addr))[0] & prefixlen_to_mask(plen, False), plen)
+
+    _glob_prefix_cache[pfx]=r
+    return r
+
+
+def prefixlen_to_mask(plen, ipv6=False):
+    """ Convert prefix length to integer netmask.
+
+    :param int plen: Prefix length
+    :param bool ipv6: IPv6 flag
+    :returns: int netmask
+    """
+
+    bits=(128 if ipv6 else 32)
+    return ((1 << plen) - 1) << (bits - plen)
+
 
 def unpack_ripe_file(filename):
     """ Decompress .tar.bz2 file that contains RIPE DB tree into a temp dir.
@@ -268,10 +343,1039 @@ def intersect(l1, l2):
         if i in l2:
             yield i
 
+
+
+# Task scheduling
+
+def _run_steps(steps, report):
+    """ Internal function. Do not use.
+    Run steps of a task in order, a failed step does not stop the others.
+
+    :param steps: List of (name, function, args)
+    :param report: Function to call with (name, error message or None)
+    """
+    for (name, fnc, args) in steps:
+        try:
+            fnc(*args)
+            report(name, None)
+        except Exception as e:
+            traceback.print_exc()
+            report(name, str(e) or e.__class__.__name__)
+
+
+def mem_profile_pickle():
+    """
+    :returns: File name of the pickle with peak RSS of task classes
+    """
+    return resultdir()+MEM_PROFILE_PICKLE
+
+
+def load_mem_profile():
+    """
+    :returns: dict task class -> list of peak RSS in kB of the last \
+    MEM_PROFILE_RUNS runs, the oldest first
+    """
+    try:
+        profile=load_pickle(mem_profile_pickle())
+    except Exception:
+        return {}
+    # older versions kept a single peak of all runs
+    return dict([(c, (p if isinstance(p, list) else [p])) for (c, p) in profile.iteritems()])
+
+
+def save_mem_profile(profile):
+    """ Save peak RSS of task classes for future runs.
+
+    :param profile: dict task class -> list of peak RSS in kB, see load_mem_profile()
+    """
+    fn=mem_profile_pickle()
+    save_pickle(profile, fn+'.%d.tmp'%os.getpid())
+    os.rename(fn+'.%d.tmp'%os.getpid(), fn)
+
+
+def run_tasks(tasks, thrnum=1, memclass=None, budget=None):
+    """ Run tasks in up to thrnum processes, one process per task. Tasks
+    wait in a queue, the most expensive tasks go first, so that the cheap
+    ones fill the gaps at the end. A task is a list of steps that have to
+    run in order by one process (i.e. days that depend on the preceding
+    day). Failures are reported per step.
+
+    When budget is given, a task is started only when the peak RSS of the
+    running tasks and the new one fits the budget. Peak RSS of the task
+    class is the maximum of recent runs (see load_mem_profile()), memory
+    a task shares with the parent process at start is not counted. When it
+    is unknown the first task of the class runs alone to measure it.
+
+    :param tasks: List of (cost, steps) where steps is a list of \
+    (name, function, args)
+    :param int thrnum: Number of concurrent processes
+    :param str memclass: Name of the task class for memory accounting
+    :param int budget: Memory budget in MB or None
+    :returns: List of (name, error message) of the failed steps
+    """
+    return _schedule_tasks([(cost, memclass, steps, [], []) for (cost, steps) in tasks], thrnum, budget)
+
+
+def _rss():
+    """ Internal function. Do not use.
+
+    :returns: Current RSS of the process in kB
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*resource.getpagesize()/1024
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _schedule_tasks(tasks, thrnum=1, budget=None):
+    """ Internal function. Do not use.
+    Run tasks in up to thrnum processes (see run_tasks()). A task starts
+    as soon as the tasks it waits for are finished, ready tasks start the
+    most expensive first. Running tasks of all classes share the memory
+    budget. A task that depends on a failed task does not run, its steps
+    fail.
+
+    :param tasks: List of (cost, memclass, steps, deps, after), deps and \
+    after are lists of indexes of tasks to wait for, a failure of a task \
+    in deps fails the task
+    :param int thrnum: Number of concurrent processes
+    :param int budget: Memory budget in MB or None
+    :returns: List of (name, error message) of the failed steps
+    """
+    failed=[]
+    broken=set()
+    done=set()
+    waiting=set(range(len(tasks)))
+
+    def report(i, name, err):
+        if err != None:
+            w("Task", name, "failed:", err)
+            failed.append((name, err))
+            broken.add(i)
+
+    def ready():
+        """ Fail tasks with a failed dependency.
+
+        :returns: List of tasks that can start, the most expensive first
+        """
+        res=None
+        while res == None:
+            res=[]
+            for i in sorted(waiting, key=lambda i: (-tasks[i][0], i)):
+                (cost, memclass, steps, deps, after)=tasks[i]
+                if [j for j in deps if j in broken]:
+                    waiting.discard(i)
+                    for (name, fnc, args) in steps:
+                        report(i, name, "dependency failed")
+                    broken.add(i)
+                    done.add(i)
+                    res=None # dependents of i fail as well
+                    break
+                if not [j for j in deps+after if not j in done]:
+                    res.append(i)
+        return res
+
+    if thrnum <= 1:
+        while waiting:
+            r=ready()
+            if not r:
+                raise Exception("Task dependency cycle")
+            waiting.discard(r[0])
+            _run_steps(tasks[r[0]][2], lambda name, err: report(r[0], name, err))
+            done.add(r[0])
+        return failed
+
+    profile=load_mem_profile()
+    measured={}
+    results=multiprocessing.Queue()
+
+    def worker(i):
+        # pages inherited from the parent are accounted to the parent
+        base=_rss()
+        _run_steps(tasks[i][2], lambda name, err: results.put(('step', i, name, err)))
+        results.put(('rss', i, max(0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-base)))
+
+    def handle(msg):
+        """ Process a message from a worker
+
+        :param msg: ('step', task, name, error message or None) or ('rss', task, peak RSS)
+        """
+        if msg[0] == 'step':
+            pending[msg[1]].discard(msg[2])
+            report(msg[1], msg[2], msg[3])
+        else:
+            measured.setdefault(tasks[msg[1]][1], []).append(msg[2])
+
+    def peak(memclass):
+        """
+        :returns: Peak RSS of the class in recent runs and this one or None
+        """
+        peaks=profile.get(memclass, [])+measured.get(memclass, [])
+        return (max(peaks) if peaks else None)
+
+    def admit(i):
+        """
+        :returns: True when task i fits the budget
+        """
+        if len(running) >= thrnum:
+            return False
+        if budget == None or not running:
+            return True
+        peaks=[peak(tasks[j][1]) for j in running.keys()+[i]]
+        if None in peaks:
+            return False # calibrating
+        return sum(peaks) <= budget*1024
+
+    running={}
+    pending={} # task -> names of unfinished steps
+    while waiting or running:
+        r=ready()
+        if not r and not running and waiting:
+            raise Exception("Task dependency cycle")
+        for i in r:
+            if admit(i):
+                waiting.discard(i)
+                pending[i]=set([name for (name, fnc, args) in tasks[i][2]])
+                p=multiprocessing.Process(target=worker, args=[i])
+                p.start()
+                running[i]=p
+
+        try:
+            handle(results.get(True, 0.2))
+        except Queue.Empty:
+            pass
+
+        finished=[i for (i, p) in running.items() if not p.is_alive()]
+
+        # read the last messages of finished processes (steps, peak RSS)
+        # before starting more tasks
+        while finished:
+            try:
+                handle(results.get(True, 0.1))
+            except Queue.Empty:
+                break
+
+        for i in finished:
+            running.pop(i).join()
+            # steps of a process that died
+            for name in sorted(pending.pop(i)):
+                report(i, name, "worker process died")
+            done.add(i)
+
+    for memclass in sorted(measured.keys()):
+        d("Peak RSS of", memclass, "tasks:", max(measured[memclass]), "kB")
+        profile[memclass]=(profile.get(memclass, [])+[max(measured[memclass])])[-MEM_PROFILE_RUNS:]
+    if measured:
+        save_mem_profile(profile)
+
+    return failed
+
+
+# Cluster coordination
+#
+# Nodes sharing the result directory (i.e. over NFS) process a common
+# work queue. The coordinator publishes tasks to CLUSTER_DIR, workers claim
+# them by creating lock files (O_EXCL) and touch the locks while working.
+# A lock that has not been touched for the lease time belongs to a dead
+# node and it is reclaimed. Finished tasks get a done marker. Clocks of
+# the nodes and the file server have to be in sync (much better than the
+# lease time).
+
+def cluster_dir(sub=''):
+    """
+    :param str sub: Subdirectory or ''
+    :returns: (Existing) directory of the cluster work queue
+    """
+    checkcreatedir(resultdir()+CLUSTER_DIR)
+    return checkcreatedir(resultdir()+CLUSTER_DIR+sub)
+
+
+def cluster_owner():
+    """
+    :returns: Identification of this process written to locks and markers
+    """
+    return '%s:%d'%(socket.gethostname(), os.getpid())
+
+
+def _save_pickle_atomic(obj, outfile):
+    """ Internal function. Do not use.
+    Save pickle under a temporary name and rename it, so that the other
+    nodes never read a partial file.
+    """
+    tmp=outfile+'.%s.tmp'%cluster_owner()
+    save_pickle(obj, tmp)
+    os.rename(tmp, outfile)
+
+
+def publish_cluster_tasks(tasks, stale=[]):
+    """ Publish tasks to the cluster work queue. Tasks that are done
+    already stay done, failed and stale tasks are cleared to be run again.
+
+    :param tasks: List of (name, cost, spec), name has to be usable \
+    as a file name, spec is a picklable description of the task for the \
+    workers
+    :param stale: List of names of tasks whose results are stale
+    """
+    donedir=cluster_dir(CLUSTER_DONE_DIR)
+    stale=set(stale)
+    for (name, cost, spec) in tasks:
+        fn=donedir+'/'+name
+        if os.path.isfile(fn) and (name in stale or load_pickle(fn)[1] != None):
+            os.unlink(fn)
+    _save_pickle_atomic(tasks, cluster_dir()+CLUSTER_TASKS_PICKLE)
+    d("Published", len(tasks), "cluster tasks")
+
+
+def unpublish_cluster_tasks():
+    """ Withdraw published tasks, workers wait for the next publishing.
+    """
+    fn=cluster_dir()+CLUSTER_TASKS_PICKLE
+    if os.path.isfile(fn):
+        os.unlink(fn)
+
+
+def load_cluster_tasks():
+    """
+    :returns: List of published (name, cost, spec) or None
+    """
+    fn=cluster_dir()+CLUSTER_TASKS_PICKLE
+    if os.path.isfile(fn):
+        return load_pickle(fn)
+    return None
+
+
+def cluster_done():
+    """
+    :returns: Set of names of finished tasks
+    """
+    return set(os.listdir(cluster_dir(CLUSTER_DONE_DIR)))
+
+
+def _lease_expired(filename, lease):
+    """ Internal function. Do not use.
+
+    :returns: True when the file exists and it has not been touched for lease seconds
+    """
+    try:
+        return time.time()-os.stat(filename).st_mtime > lease
+    except OSError:
+        return False
+
+
+def _lock_owner(lockfn):
+    """ Internal function. Do not use.
+
+    :returns: Owner written in the lock or None
+    """
+    try:
+        with open(lockfn, 'r') as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def claim_cluster_task(name, lease=CLUSTER_LEASE):
+    """ Try to claim a task. An expired lock is reclaimed, one node at
+    a time holding the reclaim lock.
+
+    :param str name: Task name
+    :param int lease: Lease time in seconds
+    :returns: True when the task is ours
+    """
+    lockfn=cluster_dir(CLUSTER_LOCK_DIR)+'/'+name
+    for attempt in range(0, 2):
+        try:
+            fd=os.open(lockfn, os.O_CREAT|os.O_EXCL|os.O_WRONLY, 0644)
+            os.write(fd, cluster_owner())
+            os.close(fd)
+            return True
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        if attempt > 0 or not _lease_expired(lockfn, lease):
+            return False
+
+        reclaimfn=lockfn+'.reclaim'
+        if _lease_expired(reclaimfn, lease):
+            try:
+                os.unlink(reclaimfn) # the reclaiming node died
+            except OSError:
+                pass
+        try:
+            os.close(os.open(reclaimfn, os.O_CREAT|os.O_EXCL|os.O_WRONLY, 0644))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        try:
+            if _lease_expired(lockfn, lease):
+                w("Reclaiming expired cluster task", name, "of", _lock_owner(lockfn))
+                os.unlink(lockfn)
+        finally:
+            os.unlink(reclaimfn)
+    return False
+
+
+def finish_cluster_task(name, err=None):
+    """ Mark the task done and release its lock.
+
+    :param str name: Task name
+    :param str err: Error message of a failed task or None
+    """
+    _save_pickle_atomic((cluster_owner(), err), cluster_dir(CLUSTER_DONE_DIR)+'/'+name)
+    release_cluster_task(name)
+
+
+def release_cluster_task(name):
+    """ Release lock of the task, when it is still ours.
+
+    :param str name: Task name
+    """
+    lockfn=cluster_dir(CLUSTER_LOCK_DIR)+'/'+name
+    if _lock_owner(lockfn) == cluster_owner():
+        os.unlink(lockfn)
+
+
+def cluster_failures():
+    """
+    :returns: List of (name, error message) of the failed tasks
+    """
+    donedir=cluster_dir(CLUSTER_DONE_DIR)
+    failed=[]
+    for name in sorted(os.listdir(donedir)):
+        (owner, err)=load_pickle(donedir+'/'+name)
+        if err != None:
+            failed.append((name, '%s (on %s)'%(err, owner)))
+    return failed
+
+
+def _keep_lease(lockfn, interval, stop):
+    """ Internal function. Do not use.
+    Touch our lock every interval seconds until stop is set.
+    """
+    owner=cluster_owner()
+    while not stop.wait(interval):
+        if _lock_owner(lockfn) != owner:
+            w("Lost lease", lockfn, "- the task is going to run twice")
+            return
+        os.utime(lockfn, None)
+
+
+def _cluster_worker(run, lease, poll):
+    """ Internal function. Do not use.
+    Claim and run published tasks, the most expensive first, until all
+    of them are done.
+    """
+    while True:
+        tasks=load_cluster_tasks()
+        if tasks == None:
+            time.sleep(poll)
+            continue
+
+        done=cluster_done()
+        todo=sorted([t for t in tasks if not t[0] in done], key=lambda t: -t[1])
+        if not todo:
+            return
+
+        claimed=False
+        for (name, cost, spec) in todo:
+            if not claim_cluster_task(name, lease):
+                continue
+            if name in cluster_done():
+                release_cluster_task(name) # finished meanwhile by the previous owner
+                continue
+
+            claimed=True
+            d("Running cluster task", name, "on", cluster_owner())
+            stop=threading.Event()
+            keeper=threading.Thread(target=_keep_lease,
+                                    args=[cluster_dir(CLUSTER_LOCK_DIR)+'/'+name, lease/4.0, stop])
+            keeper.daemon=True
+            keeper.start()
+            err=None
+            try:
+                run(spec)
+            except Exception as e:
+                traceback.print_exc()
+                err=str(e) or e.__class__.__name__
+            stop.set()
+            keeper.join()
+            finish_cluster_task(name, err)
+            break
+
+        if not claimed:
+            time.sleep(poll) # the rest is running elsewhere, wait for expired locks
+
+
+def run_cluster_worker(run, thrnum=1, lease=CLUSTER_LEASE, poll=CLUSTER_POLL):
+    """ Work on the cluster work queue in thrnum processes until all
+    published tasks are done. Waits for tasks to be published first.
+
+    :param run: Function to call with spec of a task (see \
+    publish_cluster_tasks()), it raises an exception when the task fails
+    :param int thrnum: Number of processes
+    :param int lease: Lease time in seconds
+    :param int poll: Seconds to sleep when there is nothing to claim
+    """
+    if thrnum <= 1:
+        _cluster_worker(run, lease, poll)
+        return
+
+    procs=[multiprocessing.Process(target=_cluster_worker, args=[run, lease, poll]) for i in range(0, thrnum)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+
+def wait_cluster_tasks(poll=CLUSTER_POLL):
+    """ Wait until all published tasks are done.
+
+    :param int poll: Seconds between checks
+    :returns: List of (name, error message) of the failed tasks or None \
+    when no tasks are published
+    """
+    while True:
+        tasks=load_cluster_tasks()
+        if tasks == None:
+            return None
+        names=set([t[0] for t in tasks])
+        if not names-cluster_done():
+            return [(name, err) for (name, err) in cluster_failures() if name in names]
+        time.sleep(poll)
+
+
+
+# Build graph
+#
+# Artifacts are built by nodes of a graph (see BuildNode). Each node
+# records the keys it was built with in BUILD_DIR: data key is the hash
+# of its input files and data keys of its dependencies, code key is the
+# fingerprint of its code and code keys of its dependencies. A node is
+# rebuilt when its outputs are missing, when a key changed or when
+# a dependency is rebuilt.
+
+def build_dir():
+    """
+    :returns: (Existing) directory of build records
+    """
+    return checkcreatedir(resultdir()+BUILD_DIR)
+
+
+def build_record_pickle(name):
+    """
+    :param str name: Node name
+    :returns: File name of the build record of the node
+    """
+    return build_dir()+'/'+name+'.pickle'
+
+
+def _md5_file(filename):
+    """ Internal function. Do not use.
+
+    :returns: Hex MD5 digest of the file content
+    """
+    h=hashlib.md5()
+    with open(filename, 'rb') as f:
+        while True:
+            data=f.read(1<<20)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def file_hashes(filenames):
+    """ Hash content of files. Hashes are cached and a file is hashed
+    again only when its size or mtime changes.
+
+    :param filenames: List of file names
+    :returns: dict file name -> hex MD5 digest or None for missing files
+    """
+    cachefn=build_dir()+BUILD_HASHES_PICKLE
+    try:
+        cache=load_pickle(cachefn)
+    except Exception:
+        cache={}
+
+    hashes={}
+    changed=False
+    for fn in filenames:
+        try:
+            st=os.stat(fn)
+        except OSError:
+            hashes[fn]=None
+            continue
+        c=cache.get(fn)
+        if c == None or c[0] != st.st_size or c[1] != st.st_mtime:
+            d("Hashing", fn)
+            c=(st.st_size, st.st_mtime, _md5_file(fn))
+            cache[fn]=c
+            changed=True
+        hashes[fn]=c[2]
+
+    if changed:
+        _save_pickle_atomic(cache, cachefn)
+    return hashes
+
+
+# cache of source hashes, see code_fingerprint()
+_glob_source_hashes={}
+
+def code_fingerprint(modules):
+    """ Fingerprint code of modules by hashing their source files.
+
+    :param modules: List of module objects
+    :returns: Hex MD5 digest
+    """
+    h=hashlib.md5()
+    for m in modules:
+        fn=m.__file__
+        if fn.endswith('.pyc') or fn.endswith('.pyo'):
+            fn=fn[:-1]
+        if not fn in _glob_source_hashes:
+            _glob_source_hashes[fn]=_md5_file(fn)
+        h.update(_glob_source_hashes[fn])
+    return h.hexdigest()
+
+
+def _md5_repr(obj):
+    """ Internal function. Do not use.
+
+    :returns: Hex MD5 digest of repr of the object
+    """
+    return hashlib.md5(repr(obj)).hexdigest()
+
+
+def plan_graph(nodes, targets=None, codecheck=True):
+    """ Find nodes that have to be built to get targets up to date.
+    Outputs of nodes without build record (i.e. built by older versions)
+    are taken as they are and the record is created.
+
+    :param nodes: List of BuildNode objects
+    :param targets: List of names of nodes to build or None for all nodes
+    :param bool codecheck: Rebuild artifacts built by a different code
+    :returns: (stale, keys, missing), stale is list of names to build in \
+    topological order, keys is dict name -> (data key, code key), missing \
+    is list of (name, error message) of nodes with unknown dependencies
+    """
+    byname={}
+    for n in nodes:
+        if n.name in byname:
+            raise Exception("Duplicate build node "+n.name)
+        byname[n.name]=n
+
+    # nodes needed for targets
+    missing=[]
+    needed=set()
+    todo=list(targets if targets != None else byname.keys())
+    while todo:
+        name=todo.pop()
+        if name in needed:
+            continue
+        needed.add(name)
+        for dep in byname[name].deps:
+            if dep in byname:
+                todo.append(dep)
+            else:
+                missing.append((name, "missing dependency "+dep))
+
+    # topological order
+    order=[]
+    state={}
+    for name in sorted(needed):
+        stack=[(name, False)]
+        while stack:
+            (n, expanded)=stack.pop()
+            if expanded:
+                state[n]=True
+                order.append(n)
+                continue
+            if n in state:
+                if state[n] == False:
+                    raise Exception("Build graph cycle at "+n)
+                continue
+            state[n]=False
+            stack.append((n, True))
+            for dep in reversed(byname[n].deps+byname[n].after):
+                if dep in needed and not state.get(dep):
+                    stack.append((dep, False))
+
+    hashes=file_hashes(sorted(set([fn for name in needed for fn in byname[name].inputs])))
+    keys={}
+    stale=[]
+    broken=set([name for (name, err) in missing])
+    for name in order:
+        n=byname[name]
+        deps=[dep for dep in n.deps if dep in byname]
+        keys[name]=(_md5_repr([(fn, hashes[fn]) for fn in n.inputs]+[keys[dep][0] for dep in deps]),
+                    _md5_repr([n.code]+[keys[dep][1] for dep in deps]))
+        if name in broken or [dep for dep in deps if dep in broken]:
+            broken.add(name)
+            continue
+
+        reason=None
+        rec=None
+        if os.path.isfile(build_record_pickle(name)):
+            rec=load_pickle(build_record_pickle(name))
+        if [dep for dep in deps if dep in stale]:
+            reason="dependency rebuilt"
+        elif [fn for fn in n.outputs if not os.path.exists(fn)]:
+            reason="missing output"
+        elif rec == None:
+            d("Adopting existing outputs of", name)
+            _save_pickle_atomic({'data': keys[name][0], 'code': keys[name][1]}, build_record_pickle(name))
+        elif rec['data'] != keys[name][0]:
+            reason="input changed"
+        elif codecheck and rec['code'] != keys[name][1]:
+            reason="code changed"
+
+        if reason:
+            d("Stale", name, ":", reason)
+            stale.append(name)
+
+    return (stale, keys, missing)
+
+
+def _build_node(node, key):
+    """ Internal function. Do not use.
+    Remove old outputs of the node, build it and save its build record.
+    Unfinished record files (see RecordWriter) of outputs are kept only
+    when the previous build had the same keys, so that it resumes.
+    """
+    buildingfn=build_record_pickle(node.name)+'.building'
+    resume=(os.path.isfile(buildingfn) and load_pickle(buildingfn) == key)
+    for fn in node.outputs+node.clean+([] if resume else [p for o in node.outputs for p in record_partials(o)]):
+        if os.path.exists(fn):
+            os.unlink(fn)
+    _save_pickle_atomic(key, buildingfn)
+    node.fnc(*node.args)
+    _save_pickle_atomic({'data': key[0], 'code': key[1]}, build_record_pickle(node.name))
+    os.unlink(buildingfn)
+
+
+def run_graph(nodes, targets=None, thrnum=1, budget=None, codecheck=True):
+    """ Build stale nodes needed for targets (see plan_graph()) in thrnum
+    processes. A node starts as soon as its stale dependencies and after
+    nodes are built (see common.run_tasks()). Nodes that depend on a failed
+    node fail as well.
+
+    :param nodes: List of BuildNode objects
+    :param targets: List of names of nodes to build or None for all nodes
+    :param int thrnum: Number of concurrent processes
+    :param int budget: Memory budget in MB or None
+    :param bool codecheck: Rebuild artifacts built by a different code
+    :returns: List of (name, error message) of failed nodes
+    """
+    byname=dict([(n.name, n) for n in nodes])
+    (stale, keys, missing)=plan_graph(nodes, targets, codecheck)
+    failed=list(missing)
+    broken=set([name for (name, err) in missing])
+
+    todo=[]
+    for name in stale:
+        if [dep for dep in byname[name].deps if dep in broken]:
+            failed.append((name, "dependency failed"))
+            broken.add(name)
+        else:
+            todo.append(name)
+
+    index=dict([(name, i) for (i, name) in enumerate(todo)])
+    tasks=[]
+    for name in todo:
+        n=byname[name]
+        tasks.append((n.cost, n.memclass, [(name, _build_node, (n, keys[name]))],
+                      [index[dep] for dep in n.deps if dep in index],
+                      [index[dep] for dep in n.after if dep in index]))
+
+    return failed+_schedule_tasks(tasks, thrnum, budget)
+
+
+
+# Record files
+#
+# Long lists of results are written as record files: RECORD_MAGIC followed
+# by frames, each frame is 4 bytes of length and pickled (records, extra).
+# See RecordWriter and read_records().
+
+def record_partials(filename):
+    """
+    :param str filename: Record file name
+    :returns: (part file, checkpoint file) used while the file is written
+    """
+    return (filename+'.part', filename+'.checkpoint')
+
+
+def read_record_frames(filename, end=None):
+    """ Read frames of a record file.
+
+    :param str filename: Record file name
+    :param int end: Offset to stop at or None to read the whole file
+    :returns: Iterator of (records, extra)
+    :raises Exception: When the file is not a record file or it is truncated
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise Exception("Not a record file: "+filename)
+        while end == None or f.tell() < end:
+            hdr=f.read(4)
+            if not hdr:
+                break
+            if len(hdr) < 4:
+                raise Exception("Truncated record file: "+filename)
+            length=struct.unpack('!I', hdr)[0]
+            data=f.read(length)
+            if len(data) < length:
+                raise Exception("Truncated record file: "+filename)
+            yield pickle.loads(data)
+
+
+def read_records(filename):
+    """ Stream records of a record file. Files written by older versions
+    as a single pickle are loaded at once, items of a list or of a dict
+    are the records then.
+
+    :param str filename: Record file name
+    :returns: Iterator of records
+    """
+    with open(filename, 'rb') as f:
+        magic=f.read(len(RECORD_MAGIC))
+
+    if magic != RECORD_MAGIC:
+        o=load_pickle(filename)
+        for r in (o.iteritems() if isinstance(o, dict) else o):
+            yield r
+        return
+
+    for (records, extra) in read_record_frames(filename):
+        for r in records:
+            yield r
+
+
+
+# Day contexts
+
+def visit_days(days, host, ipv6, analyses, ianadir=None):
+    """ Visit days in order and run all analyses on each day, so that data
+    of a day are loaded once for all of them. An analysis is an object with
+    methods visit(ctx) called with DayContext of each day and finish()
+    called at the end.
+
+    :param days: List of Day objects
+    :param str host: BGP host
+    :param bool ipv6: IPv6 flag
+    :param analyses: List of analysis objects
+    :param ianadir: IanaDirectory object for RIR resolution or None
+    """
+    for day in days:
+        ctx=DayContext(day, host, ipv6, ianadir)
+        for a in analyses:
+            a.visit(ctx)
+        # release data of the day before the next one is loaded
+        ctx=None
+
+    for a in analyses:
+        a.finish()
+
+
     
 # Exported classes
 
 
+class BuildNode(object):
+    """ Node of the build graph, see run_graph(). It builds its outputs
+    by calling fnc(*args).
+    """
+
+    def __init__(self, name, fnc, args, outputs, inputs=[], deps=[], code=None,
+                 memclass=None, cost=0, clean=[], after=[]):
+        """
+        :param str name: Unique name usable as a file name
+        :param fnc: Function that builds the outputs
+        :param args: Arguments of fnc
+        :param outputs: List of files that the node builds
+        :param inputs: List of source files the outputs are built from
+        :param deps: List of names of nodes the outputs are built from
+        :param str code: Fingerprint of the code (see code_fingerprint())
+        :param str memclass: Task class for memory accounting (see run_tasks())
+        :param cost: Cost estimate
+        :param clean: List of other files to remove before building
+        :param after: List of names of nodes to run after when they \
+        are built as well, they do not affect outputs of the node
+        """
+        self.name=name
+        self.fnc=fnc
+        self.args=args
+        self.outputs=outputs
+        self.inputs=inputs
+        self.deps=deps
+        self.code=code
+        self.memclass=memclass
+        self.cost=cost
+        self.clean=clean
+        self.after=after
+
+    def __str__(self):
+        """
+        :returns: Node name
+        """
+        return self.name
+
+
+class RecordWriter(object):
+    """ Append-only writer of a record file (see read_records()). Records
+    are written in frames of RECORD_BATCH records to a part file. At most
+    every RECORD_CHECKPOINT seconds the part file is synced to disk and
+    a checkpoint (offset and number of records) is saved. A writer of
+    an unfinished file resumes after the last checkpoint, the caller skips
+    the first count records then. close() renames the part file to the
+    record file.
+    """
+
+    def __init__(self, filename, extra=None, batch=RECORD_BATCH, interval=RECORD_CHECKPOINT):
+        """
+        :param str filename: Record file name
+        :param extra: Function returning extra data saved with each frame or None
+        :param int batch: Records per frame
+        :param int interval: Seconds between checkpoints or None to save \
+        checkpoints only by calling checkpoint()
+        """
+        self.filename=filename
+        (self.partfn, self.checkpointfn)=record_partials(filename)
+        self.extra=extra
+        self.batch=batch
+        self.interval=interval
+        self.records=[]
+        self.count=0
+        self.offset=None
+
+        if os.path.isfile(self.partfn) and os.path.isfile(self.checkpointfn):
+            (self.offset, self.count)=load_pickle(self.checkpointfn)
+            d("Resuming", filename, "after", self.count, "records")
+            self.f=open(self.partfn, 'r+b')
+            self.f.truncate(self.offset)
+            self.f.seek(self.offset)
+        else:
+            self.f=open(self.partfn, 'wb')
+            self.f.write(RECORD_MAGIC)
+        self.last=time.time()
+
+    def frames(self):
+        """
+        :returns: Iterator of (records, extra) of frames saved before \
+        the resumed checkpoint
+        """
+        if self.offset == None:
+            return iter([])
+        return read_record_frames(self.partfn, self.offset)
+
+    def write(self, record):
+        """
+        :param record: Picklable record to write
+        :returns: True when a frame has been written
+        """
+        self.records.append(record)
+        if len(self.records) >= self.batch:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """ Write buffered records as a frame and save a checkpoint when
+        it is time to.
+        """
+        if not self.records:
+            return
+        data=pickle.dumps((self.records, (self.extra() if self.extra else None)), pickle.HIGHEST_PROTOCOL)
+        self.f.write(struct.pack('!I', len(data)))
+        self.f.write(data)
+        self.count+=len(self.records)
+        self.records=[]
+        if self.interval != None and time.time()-self.last >= self.interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """ Sync the part file and save the checkpoint.
+        """
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        _save_pickle_atomic((self.f.tell(), self.count), self.checkpointfn)
+        self.last=time.time()
+
+    def close(self):
+        """ Write the rest and finish the record file.
+        """
+        self.flush()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        os.rename(self.partfn, self.filename)
+        if os.path.isfile(self.checkpointfn):
+            os.unlink(self.checkpointfn)
+
+    def abort(self):
+        """ Drop the unfinished record file together with its checkpoint.
+        """
+        self.f.close()
+        for fn in (self.partfn, self.checkpointfn):
+            if os.path.isfile(fn):
+                os.unlink(fn)
+
+
+class DayContext(object):
+    """ Data of a day and BGP host shared by analyses (see visit_days()).
+    Items are loaded by registered loaders (see register()) on first use.
+    """
+
+    # dict item name -> (loader, cache)
+    loaders={}
+
+    def __init__(self, day, host, ipv6, ianadir=None):
+        """
+        :param Day day: Day
+        :param str host: BGP host
+        :param bool ipv6: IPv6 flag
+        :param ianadir: IanaDirectory object for RIR resolution or None
+        """
+        self.day=day
+        self.host=host
+        self.ipv6=ipv6
+        self.ianadir=ianadir
+        self.items={}
+
+    @staticmethod
+    def register(name, loader, cache=True):
+        """ Register loader of an item.
+
+        :param str name: Item name
+        :param loader: Function that gets the DayContext and returns the item
+        :param bool cache: Keep the item in the context, use False for \
+        iterators that stream data from files
+        """
+        DayContext.loaders[name]=(loader, cache)
+
+    def get(self, name):
+        """
+        :param str name: Item name
+        :returns: The item
+        """
+        if name in self.items:
+            return self.items[name]
+        (loader, cache)=DayContext.loaders[name]
+        item=loader(self)
+        if cache:
+            self.items[name]=item
+        return item
+
+    def __str__(self):
+        """
+        :returns: Day, host and AF of the context
+        """
+        return '%s %s %s'%(str(self.day), self.host, ('IPv6' if self.ipv6 else 'IPv4'))
+
+
 class Day(object):
     """ Day representation in compact form. The
     object basically contains only the date but it can be converted
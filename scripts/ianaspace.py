@@ -115,68 +115,149 @@ class IanaDirectory(object):
                 #                return n
                 #return None
 
+        def resolve_rir(self,net):
+                """ Resolve network to the RIR that administers it.
 
-# Module interface
+                :param net: ipaddr.IPv[46]Network instance or string
+                :returns: RIR ID (see RIRS) or 'LEGACY' or None when the \
+                network is not in the directory
+                """
 
-def module_process(ianadir, host, days, ipv6=False, bestonly=False):
-        """
-        Match BGP prefixes in IANA's directory and generate text
-        outputs and stats that determine average active prefix counts
-        and average de-aggregation for each RIR.
+                r=self.resolve_network(net)
+                if not r:
+                        return None
+                name=r[2]
+                if r[1] == 'LEGACY' and not name in RIRS:
+                        name='LEGACY'
+                return name
+                
 
-        :param IanaDirectory ianadir: IanaDirectory instance to match agains
-        :param str host: Host to take BGP feeds from
-        :param days: List of days to analyze
+
+# IANA directories built by iana_directory()
+_glob_iana_directories={}
+
+def iana_directory(listfile, ipv6):
+        """ Get IanaDirectory of the file. The directory is built once and
+        shared by all callers.
+
+        :param str listfile: File to read
         :param bool ipv6: IPv6 flag
-        :param bool bestonly: Take only best BGP paths into account
+        :returns: IanaDirectory instance
         """
 
-        timeline=[]
-        timelineavg=[]
+        key=(listfile, ipv6)
+        if not key in _glob_iana_directories:
+                _glob_iana_directories[key]=IanaDirectory(listfile, ipv6)
+        return _glob_iana_directories[key]
 
-        for t in days:
-                rirpfxlens={}
-                ifn = bgp.bgpdump_pickle(t, host, ipv6)
-                if not ifn:
-                        continue
-                bgpdump=common.load_pickle(ifn)
-                common.d("ianaspace.module_run: matching prefixes in a tree (%d)"%len(bgpdump))
 
-                for pv in bgpdump:
-                        if bestonly and not (pv[0] and '>' in pv[0]):
-                                continue
 
-                        net = ipaddr.IPNetwork(pv[1])
-                        r=ianadir.resolve_network(net)
-                        if not r:
-                                common.w("No IANA assignment for", str(pv[1]))
-                                continue
-                        name=r[2]
-                        if r[1] == 'LEGACY' and not name in RIRS:
-                                name='LEGACY'
-                        if not name in rirpfxlens:
-                                rirpfxlens[name]=[]
-                        rirpfxlens[name].append(net.prefixlen)
-                timeline.append([str(t)]+[len(rirpfxlens[n]) for n in RIRS])
-                timelineavg.append([str(t)]+[(reduce(lambda x, y: x + y, rirpfxlens[n])/
-                                             float(len(rirpfxlens[n]))) for n in RIRS])
-
-                outtxt = '%s/rirstats%d-%s.txt'%(common.resultdir(t), (6 if ipv6 else 4), host)
+# Day context items
+
+def _context_rir_best(ctx):
+        """ Day context item 'rir-best': RIR -> (prefix count, sum of prefix
+        lengths) of best BGP paths (see bgp.gen_rir_counts()) or None. It
+        comes from the summary of the day (see bgp.gen_summary()).
+        """
+
+        summary=ctx.get('bgp-summary')
+        if summary == None:
+                return None
+        return summary['rir']
+
+def _context_rir_all(ctx):
+        """ Day context item 'rir-all': RIR -> (prefix count, sum of prefix
+        lengths) of all BGP paths or None.
+        """
+
+        bgpdump=ctx.get('bgpdump')
+        if bgpdump == None:
+                return None
+        return bgp.gen_rir_counts(bgpdump, ctx.ianadir)
+
+common.DayContext.register('rir-best', _context_rir_best)
+common.DayContext.register('rir-all', _context_rir_all)
+
+
+
+# Module interface
+
+class RirAnalysis(object):
+        """ RIR statistics of a BGP host (see common.visit_days() and
+        module_process()). Days have to be visited with the IanaDirectory
+        in the context.
+        """
+
+        def __init__(self, host, ipv6=False, bestonly=False):
+                """
+                :param str host: Host to take BGP feeds from
+                :param bool ipv6: IPv6 flag
+                :param bool bestonly: Take only best BGP paths into account
+                """
+
+                self.host=host
+                self.ipv6=ipv6
+                self.bestonly=bestonly
+                self.timeline=[]
+                self.timelineavg=[]
+
+
+        def visit(self, ctx):
+                """ Generate text output of the day.
+
+                :param ctx: common.DayContext of the day
+                """
+
+                rircounts=ctx.get('rir-best' if self.bestonly else 'rir-all')
+                if rircounts == None:
+                        return
+
+                t=ctx.day
+                timeline=self.timeline
+                timelineavg=self.timelineavg
+                timeline.append([str(t)]+[rircounts[n][0] for n in RIRS])
+                timelineavg.append([str(t)]+[(rircounts[n][1]/float(rircounts[n][0])) for n in RIRS])
+
+                outtxt = '%s/rirstats%d-%s.txt'%(common.resultdir(t), (6 if self.ipv6 else 4), self.host)
                 common.d("Generating output RIR stats text "+outtxt)
                 with open(outtxt,'w') as f:
                         for i,k in enumerate(RIRS):
                                 f.write('%s: %d (avg pfxlen: %.2f)\n'%(str(k), timeline[-1][1+i],
                                                                        round(timelineavg[-1][1+i], 2)))
 
-        if timeline:
-                outgraph = '%s/rirpfxcount%d-%s'%(common.resultdir(), (6 if ipv6 else 4), host)
-                common.d("Generating output RIR pfxcount graph with prefix "+outgraph)
-                graph.gen_multilineplot(timeline, outgraph, legend=RIRS, ylabel='Pfx count')
 
-        if timelineavg:
-                outgraph = '%s/rirpfxlen%d-%s'%(common.resultdir(), (6 if ipv6 else 4), host)
-                common.d("Generating output RIR pfxlen graph with prefix "+outgraph)
-                graph.gen_multilineplot(timelineavg, outgraph, legend=RIRS, ylabel='Avg pfx len')
+        def finish(self):
+                """ Generate timeline graphs of all visited days.
+                """
+
+                if self.timeline:
+                        outgraph = '%s/rirpfxcount%d-%s'%(common.resultdir(), (6 if self.ipv6 else 4), self.host)
+                        common.d("Generating output RIR pfxcount graph with prefix "+outgraph)
+                        graph.gen_multilineplot(self.timeline, outgraph, legend=RIRS, ylabel='Pfx count')
+
+                if self.timelineavg:
+                        outgraph = '%s/rirpfxlen%d-%s'%(common.resultdir(), (6 if self.ipv6 else 4), self.host)
+                        common.d("Generating output RIR pfxlen graph with prefix "+outgraph)
+                        graph.gen_multilineplot(self.timelineavg, outgraph, legend=RIRS, ylabel='Avg pfx len')
+
+
+
+def module_process(ianadir, host, days, ipv6=False, bestonly=False):
+        """
+        Match BGP prefixes in IANA's directory and generate text
+        outputs and stats that determine average active prefix counts
+        and average de-aggregation for each RIR. run_all visits days with
+        RirAnalysis together with other analyses instead (see
+        common.visit_days()).
+
+        :param IanaDirectory ianadir: IanaDirectory instance to match agains
+        :param str host: Host to take BGP feeds from
+        :param days: List of days to analyze
+        :param bool ipv6: IPv6 flag
+        :param bool bestonly: Take only best BGP paths into account
+        """
+
+        common.visit_days(days, host, ipv6, [RirAnalysis(host, ipv6, bestonly)], ianadir)
 
 
 
@@ -33,14 +33,21 @@ import ipaddr
 import traceback
 import multiprocessing
 import gc
+import hashlib
+import copy
+import cPickle
+import collections
+import Queue
+import array
+import itertools
+import time
+import datetime
 
 import common
 import graph
 import ianaspace
 import bgp
 
-filterdebug=None
-
 # Constants
 
 MY_ASN=None # or 'AS29134'
@@ -60,6 +67,7 @@ RIPE_DB_ASSET_PICKLE='/ripe.asset.pickle'
 RIPE_DB_FILTERSET_PICKLE='/ripe.filterset.pickle'
 RIPE_DB_ROUTESET_PICKLE='/ripe.routeset.pickle'
 RIPE_DB_PEERINGSET_PICKLE='/ripe.peeringset.pickle'
+RIPE_DB_FINGERPRINT_PICKLE='/ripe.fingerprint.pickle'
 
 RIPE_BGP2ROUTES4_TXT='/bgp2routes.txt'
 RIPE_BGP2ROUTES4_PICKLE='/bgp2routes.pickle'
@@ -73,6 +81,12 @@ RIPE_BGP2PATHS6_TXT='/bgp2paths6.txt'
 RIPE_BGP2PATHS6_PICKLE='/bgp2paths6.pickle'
 RIPE_BGP2PATHS6_GRAPH='/bgp2paths6'
 
+RIPE_BGP2PATHS4_HOPREFS_PICKLE='/bgp2paths.hoprefs.pickle'
+RIPE_BGP2PATHS6_HOPREFS_PICKLE='/bgp2paths6.hoprefs.pickle'
+
+SHARD_QUEUE_DEPTH=4 # batches of results a shard process may send ahead of the merge
+SHARD_POLL=10 # seconds between liveness checks of shard processes
+
 RIPE_ROUTE_VIOLATION_TIMELINE='/route_violations_timeline.txt'
 RIPE_ROUTE6_VIOLATION_TIMELINE='/route6_violations_timeline.txt'
 
@@ -108,6 +122,17 @@ class RpslObject(object):
         """
         raise Exception("This is abstract object. Dunno what my key is!")
 
+    def dayCopy(self):
+        """ Get the object to be used in directories of a day. Objects
+        are shared among days by RpslObjectStore and the copy separates
+        state that depends on other objects of the day (set members added
+        from member-of, closures, compiled references). Objects without
+        such state are returned as they are.
+
+        :returns: RpslObject
+        """
+        return self
+
     
     @staticmethod
     def cleanupLines(text):
@@ -160,27 +185,25 @@ class RpslObject(object):
         if len(buf[0].strip())>0:
             yield buf
 
-    @staticmethod    
-    def parseRipeFile(filename, targetClass):
-        """ Parse RIPE object file of a targetClass. Theoretically more
-        types might be  supported and modifier to __init__ of each class
-        has to be created.
+    @staticmethod
+    def splitRipeFile(filename):
+        """ Split RIPE object file to objects without parsing them.
 
         :param str filename: Name of file to read
-        :param targetClass: Class
-        :returns: Iterator that returns the objects
+        :returns: Iterator that returns lists of clean lines (see \
+        cleanupLines()) of the objects
         """
 
         def flushrobj(ot):
-            """ Generate object from the lines
+            """ Clean the object lines
 
             :param str ot: Object text
-            :returns: Object
+            :returns: List of lines or None
             """
             if ot:
                 otl = list(RpslObject.cleanupLines(ot))
                 if otl:
-                    return targetClass(otl)
+                    return otl
     
         with open(filename, 'r') as sf:
             objecttext=[]
@@ -199,6 +222,20 @@ class RpslObject(object):
             if o:
                 yield o
 
+    @staticmethod    
+    def parseRipeFile(filename, targetClass):
+        """ Parse RIPE object file of a targetClass. Theoretically more
+        types might be  supported and modifier to __init__ of each class
+        has to be created.
+
+        :param str filename: Name of file to read
+        :param targetClass: Class
+        :returns: Iterator that returns the objects
+        """
+
+        for otl in RpslObject.splitRipeFile(filename):
+            yield targetClass(otl)
+
 
 
 
@@ -272,15 +309,18 @@ class RouteObjectDir(object):
     other (origin -> list of route objects).
     """
 
-    def __init__(self,filename,ipv6=False):
+    def __init__(self,filename,ipv6=False,objs=None):
         """ Init the RouteObjecDir from text file.
 
-        :param str filename: Name of file to parse
+        :param str filename: Name of file to parse or None to use objs
         :param bool ipv6: IPv6 flag
+        :param objs: List of RouteObjects to use instead of parsing the file
         """
         
         self.originTable={}
-        if ipv6:
+        if filename == None:
+            self._initTreeAndTable(objs or [], ipv6)
+        elif ipv6:
             self._initTreeAndTable(RpslObject.parseRipeFile(filename, Route6Object), ipv6)
         else:
             self._initTreeAndTable(RpslObject.parseRipeFile(filename, RouteObject), ipv6)
@@ -337,16 +377,925 @@ AFI_MATCH=re.compile('^AFI\s+([^\s]+)\s+(.*)$')
 AFI_MATCH_HACK=re.compile('^AFI\s+(IPV6.UNICAST)(FROM.*)$')
 ################# END OF HACK
 
-IMPORT_FACTOR_MATCH=re.compile('^FROM\s+([^\s]+)(\s+(.*)?\s?ACCEPT(.+))?$')
-EXPORT_FACTOR_MATCH=re.compile('^TO\s+([^\s]+)(\s+(.*)?\s?ANNOUNCE(.+))?$')
-DEFAULT_FACTOR_MATCH=re.compile('^TO\s+([^\s]+)(\s+(.*)?\s?NETWORKS(.+)|.*)?$')
+IMPORT_FACTOR_MATCH=re.compile('^FROM\s+([^\s]+)(\s+(.*)?\s?ACCEPT(.+))?$')
+EXPORT_FACTOR_MATCH=re.compile('^TO\s+([^\s]+)(\s+(.*)?\s?ANNOUNCE(.+))?$')
+DEFAULT_FACTOR_MATCH=re.compile('^TO\s+([^\s]+)(\s+(.*)?\s?NETWORKS(.+)|.*)?$')
+
+ASN_MATCH=re.compile('^AS[0-9]+$')
+PFX_FLTR_MATCH=re.compile('^\{([^}]*)\}(\^[0-9\+-]+)?$')
+PFX_FLTR_PARSE=re.compile('^([0-9A-F:\.]+/[0-9]+)(\^[0-9\+-]+)?$')
+REGEXP_FLTR_PARSE=re.compile('^<([^>]+)>$')
+
+PARSE_RANGE=re.compile('^\^([0-9]+)-([0-9]+)$')
+SET_RANGE_PARSE=re.compile('^([^\^]+)(\^[0-9\+-]+)$')
+
+# filter dependence flags, see FilterNode.getDeps()
+FILTER_DEP_PREFIX=1 # verdict depends on the prefix
+FILTER_DEP_ENDS=2 # verdict depends on the first and the last (=origin) AS of the path
+FILTER_DEP_ASPATH=4 # verdict depends on the whole AS path
+FILTER_DEP_ALL=FILTER_DEP_PREFIX|FILTER_DEP_ENDS|FILTER_DEP_ASPATH
+
+PATH_STEP_CACHE_LIMIT=1000000 # max. number of verdicts held by PathStepCache
+FILTER_CACHE_LIMIT=100000 # max. number of compiled filters held by _glob_filter_cache
+RULE_CACHE_LIMIT=200000 # max. number of parsed rules held by _glob_rule_cache
+PFXFLTR_CACHE_LIMIT=100000 # max. number of prefix filters held by _glob_pfxfltr_cache
+REGEXP_CACHE_LIMIT=10000 # max. number of AS-path regexps held by _glob_regexp_cache
+
+# memo of compiled filters, key is the normalized filter text
+_glob_filter_cache={}
+
+# memo of parsed aut-num rules, key is (rule class, mp flag, rule text)
+_glob_rule_cache={}
+
+# memo of compiled prefix filters, key is the filter text
+_glob_pfxfltr_cache={}
+
+# memo of compiled AS-path regexps, key is the regexp text
+_glob_regexp_cache={}
+
+
+# AS-path regular expression machinery
+
+ASPATH_RE_TOKEN=re.compile('\s*(~[*+]|~?\{[0-9]*(,[0-9]*)?\}|[()|*+?^$.\[\]]|[A-Z0-9_:-]+)')
+ASPATH_RE_RANGE=re.compile('^AS([0-9]+)-AS([0-9]+)$')
+ASPATH_RE_REPEAT=re.compile('^~?\{([0-9]*)(,([0-9]*))?\}$')
+
+class AsPathRegExp(object):
+    """ Compiled RPSL AS-path regular expression (RFC 2622, section 5.4).
+    The expression is tokenized on ASNs (not on characters), parsed and
+    turned into NFA that is simulated over the AS path. Supported atoms
+    are ASN, as-set, PeerAS, . and [...] sets (with ASN ranges and ^
+    complement), operators are *, +, ?, {m,n}, ~*, ~+, ~{m,n}, | and
+    parentheses, anchors are ^ and $.
+
+    Use AsPathRegExp.compile() that caches the compiled expressions.
+    """
+
+    # NFA state kinds
+    ST_TOKEN=0 # consume one ASN matching the atom
+    ST_SPLIT=1 # epsilon transitions to all outs
+    ST_BOL=2 # assert beginning of the AS path
+    ST_EOL=3 # assert end of the AS path
+    ST_SAME=4 # consume run of the same ASN matching the atom (~ operators)
+    ST_MATCH=5 # accept
+
+    def __init__(self, text):
+        """ Compile the expression.
+
+        :param str text: Expression without the <> brackets
+        :raises: Exception when the expression can not be parsed
+        """
+
+        self.text=text
+        self.uses_asset=False
+        self.uses_peeras=False
+        self.assets=set() # names of referenced as-sets
+        self.states=[]
+
+        self.tokens=[]
+        pos=0
+        text=text.strip()
+        while pos < len(text):
+            m=ASPATH_RE_TOKEN.match(text, pos)
+            if not m:
+                raise Exception("Can not tokenize AS-path regexp: "+text)
+            self.tokens.append(m.group(1))
+            pos=m.end()
+        self.pos=0
+
+        ast=self._parseAlt()
+        if self.pos != len(self.tokens):
+            raise Exception("Unexpected token %s in AS-path regexp: %s"%(self.tokens[self.pos], text))
+        del self.tokens
+
+        self.start=self._build(ast, self._newState(self.ST_MATCH))
+
+    @staticmethod
+    def compile(text):
+        """ Compile expression or take it from the cache.
+
+        :param str text: Expression without the <> brackets
+        :returns: AsPathRegExp instance or None when the expression can not be parsed
+        """
+
+        if text in _glob_regexp_cache:
+            return _glob_regexp_cache[text]
+
+        try:
+            r=AsPathRegExp(text)
+        except Exception as e:
+            common.w("Can not compile AS-path regexp:", text, str(e))
+            r=None
+
+        if len(_glob_regexp_cache) >= REGEXP_CACHE_LIMIT:
+            _glob_regexp_cache.clear()
+        _glob_regexp_cache[text]=r
+        return r
+
+    # Parser
+
+    def _peek(self):
+        """ :returns: Current token or None """
+        return (self.tokens[self.pos] if self.pos < len(self.tokens) else None)
+
+    def _next(self):
+        """ :returns: Current token and move to the next one """
+        t=self._peek()
+        if t == None:
+            raise Exception("Unexpected end of AS-path regexp: "+self.text)
+        self.pos+=1
+        return t
+
+    def _parseAlt(self):
+        """ alt := concat ('|' concat)* """
+        alts=[self._parseConcat()]
+        while self._peek() == '|':
+            self._next()
+            alts.append(self._parseConcat())
+        return (alts[0] if len(alts) == 1 else ('alt', alts))
+
+    def _parseConcat(self):
+        """ concat := repeat* """
+        items=[]
+        while not self._peek() in (None, '|', ')'):
+            items.append(self._parseRepeat())
+        return ('cat', items)
+
+    def _parseRepeat(self):
+        """ repeat := primary postfix* """
+        node=self._parsePrimary()
+        while True:
+            t=self._peek()
+            if t == '*':
+                node=('rep', node, 0, None)
+            elif t == '+':
+                node=('rep', node, 1, None)
+            elif t == '?':
+                node=('rep', node, 0, 1)
+            elif t != None and (t[0] == '{' or t[0] == '~'):
+                if t == '~*':
+                    mn,mx=0,None
+                elif t == '~+':
+                    mn,mx=1,None
+                else:
+                    m=ASPATH_RE_REPEAT.match(t)
+                    mn=(int(m.group(1)) if m.group(1) else 0)
+                    if not m.group(2):
+                        mx=mn
+                    else:
+                        mx=(int(m.group(3)) if m.group(3) else None)
+                if t[0] == '~':
+                    if node[0] != 'atom':
+                        raise Exception("Operator %s is supported only on single atom in: %s"%(t, self.text))
+                    node=('same', node[1], mn, mx)
+                else:
+                    node=('rep', node, mn, mx)
+            else:
+                return node
+            self._next()
+
+    def _parsePrimary(self):
+        """ primary := '(' alt ')' | '[' set ']' | '^' | '$' | atom """
+        t=self._next()
+        if t == '(':
+            node=self._parseAlt()
+            if self._next() != ')':
+                raise Exception("Missing ) in AS-path regexp: "+self.text)
+            return node
+        elif t == '[':
+            complement=False
+            if self._peek() == '^':
+                self._next()
+                complement=True
+            atoms=[]
+            while self._peek() != ']':
+                atoms.append(self._parseAtom(self._next()))
+            self._next()
+            return ('atom', ('set', complement, atoms))
+        elif t == '^':
+            return ('bol',)
+        elif t == '$':
+            return ('eol',)
+        else:
+            return ('atom', self._parseAtom(t))
+
+    def _parseAtom(self, t):
+        """ Parse atom token.
+
+        :param str t: Token
+        :returns: Atom tuple
+        """
+        if t == '.' or t == 'AS-ANY':
+            return ('any',)
+        elif t == 'PEERAS':
+            self.uses_peeras=True
+            return ('peeras',)
+        elif AutNumRule.isASN(t):
+            return ('asn', t)
+        elif ASPATH_RE_RANGE.match(t):
+            m=ASPATH_RE_RANGE.match(t)
+            return ('range', int(m.group(1)), int(m.group(2)))
+        elif AsSetObject.isAsSet(t):
+            self.uses_asset=True
+            self.assets.add(t)
+            return ('asset', t)
+        else:
+            raise Exception("Unknown atom %s in AS-path regexp: %s"%(t, self.text))
+
+    # NFA construction
+
+    def _newState(self, kind, arg=None, outs=None):
+        """ Create NFA state.
+
+        :returns: State index
+        """
+        self.states.append([kind, arg, (outs if outs else [])])
+        return len(self.states)-1
+
+    def _build(self, node, nxt):
+        """ Build NFA fragment for the AST node that continues to nxt.
+
+        :param node: AST node
+        :param int nxt: State that follows the fragment
+        :returns: Starting state of the fragment
+        """
+
+        if node[0] == 'atom':
+            return self._newState(self.ST_TOKEN, node[1], [nxt])
+
+        elif node[0] == 'cat':
+            for n in reversed(node[1]):
+                nxt=self._build(n, nxt)
+            return nxt
+
+        elif node[0] == 'alt':
+            return self._newState(self.ST_SPLIT, None, [self._build(n, nxt) for n in node[1]])
+
+        elif node[0] == 'rep':
+            (child, mn, mx)=node[1:]
+            if mx == None:
+                s=self._newState(self.ST_SPLIT)
+                self.states[s][2]=[self._build(child, s), nxt]
+                cur=s
+            else:
+                cur=nxt
+                for i in range(mx-mn):
+                    cur=self._newState(self.ST_SPLIT, None, [self._build(child, cur), nxt])
+            for i in range(mn):
+                cur=self._build(child, cur)
+            return cur
+
+        elif node[0] == 'same':
+            return self._newState(self.ST_SAME, node[1:], [nxt])
+
+        elif node[0] == 'bol':
+            return self._newState(self.ST_BOL, None, [nxt])
+
+        elif node[0] == 'eol':
+            return self._newState(self.ST_EOL, None, [nxt])
+
+        raise Exception("Unknown AST node: "+str(node))
+
+    # Matching
+
+    @staticmethod
+    def _matchAtom(atom, asn, peeras, assetDirectory):
+        """ Match one ASN to an atom.
+
+        :param atom: Atom tuple
+        :param str asn: ASN to match
+        :param str peeras: PeerAS
+        :param HashObjectDir assetDirectory: HashObjectDir instance that contains AsSet objs
+        :returns: True if the ASN matches
+        """
+        k=atom[0]
+        if k == 'asn':
+            return asn == atom[1]
+        elif k == 'any':
+            return True
+        elif k == 'peeras':
+            return asn == peeras
+        elif k == 'asset':
+            return (atom[1] in assetDirectory.table and
+                    assetDirectory.table[atom[1]].recursiveMatch(asn, assetDirectory))
+        elif k == 'range':
+            return asn[2:].isdigit() and atom[1] <= int(asn[2:]) <= atom[2]
+        elif k == 'set':
+            r=False
+            for a in atom[2]:
+                if AsPathRegExp._matchAtom(a, asn, peeras, assetDirectory):
+                    r=True
+                    break
+            return (not r if atom[1] else r)
+        raise Exception("Unknown atom: "+str(atom))
+
+    def _closure(self, configs, i, n):
+        """ Epsilon closure of NFA configurations at position i.
+
+        :param configs: List of configurations (state, memory)
+        :param int i: Position in the AS path
+        :param int n: Length of the AS path
+        :returns: (set of configurations, accepted) tuple
+        """
+
+        res=set()
+        stack=list(configs)
+        while stack:
+            c=stack.pop()
+            if c in res:
+                continue
+            res.add(c)
+            (kind, arg, outs)=self.states[c[0]]
+            if kind == self.ST_MATCH:
+                return (res, True)
+            elif kind == self.ST_SPLIT:
+                stack.extend([(o, None) for o in outs])
+            elif kind == self.ST_BOL:
+                if i == 0:
+                    stack.append((outs[0], None))
+            elif kind == self.ST_EOL:
+                if i == n:
+                    stack.append((outs[0], None))
+            elif kind == self.ST_SAME:
+                cnt=(c[1][1] if c[1] else 0)
+                if cnt >= arg[1]:
+                    stack.append((outs[0], None))
+        return (res, False)
+
+    def match(self, asPath, assetDirectory=None):
+        """ Search for the expression in the AS path.
+
+        :param asPath: list of strings, AS path (first is the peer, last is the origin)
+        :param HashObjectDir assetDirectory: HashObjectDir instance that contains AsSet objs
+        :returns: True when the expression matches, False otherwise
+        """
+
+        peeras=(asPath[0] if asPath else None)
+        n=len(asPath)
+        configs=set()
+        for i in range(0, n+1):
+            # unanchored search: the expression might start at any position
+            configs.add((self.start, None))
+            (configs, accepted)=self._closure(configs, i, n)
+            if accepted:
+                return True
+            if i == n:
+                break
+
+            asn=asPath[i]
+            nc=set()
+            for (s, mem) in configs:
+                (kind, arg, outs)=self.states[s]
+                if kind == self.ST_TOKEN:
+                    if self._matchAtom(arg, asn, peeras, assetDirectory):
+                        nc.add((outs[0], None))
+                elif kind == self.ST_SAME:
+                    (atom, mn, mx)=arg
+                    if mem == None:
+                        if (mx == None or mx >= 1) and self._matchAtom(atom, asn, peeras, assetDirectory):
+                            nc.add((s, (asn, 1)))
+                    elif mem[0] == asn and (mx == None or mem[1] < mx):
+                        nc.add((s, (asn, mem[1]+1)))
+            configs=nc
+
+        return False
+
+    def __str__(self):
+        """ :returns: String representation """
+        return 'AsPathRegExp: <%s> (%d states)'%(self.text, len(self.states))
+
+    def __repr__(self):
+        """ :returns: String representation """
+        return self.__str__()
+
+
+
+# Compiled filter machinery
+
+class FilterDirs(object):
+    """ Bundle of directories that compiled filters resolve references in.
+    It is passed to FilterNode.evaluate() instead of the long list of
+    directories that AutNumRule.matchFilter() takes.
+    """
+
+    def __init__(self, asset_dir, fltrset_dir, rtset_dir, ipv6=False):
+        """
+        :param HashObjectDir asset_dir: HashObjectDir instance that contains AsSet objs
+        :param HashObjectDir fltrset_dir: HashObjectDir instance that contains FltrSet objs
+        :param HashObjectDir rtset_dir: HashObjectDir instance that contains RtSet objs
+        :param bool ipv6: IPv6 flag
+        """
+        self.asset_dir=asset_dir
+        self.fltrset_dir=fltrset_dir
+        self.rtset_dir=rtset_dir
+        self.ipv6=ipv6
+
+
+class PrefixRangeSet(object):
+    """ Compiled set of RPSL prefix ranges (i.e. { 1.2.0.0/16^24-32, 2001:db8::/32^+ }).
+    Each range is held as a tuple (network int, mask, min length, max length)
+    and membership tests work only with integers. Small sets are scanned
+    linearly, larger ones are indexed by prefix length so that a test costs
+    one hash lookup per distinct prefix length in the set.
+    """
+
+    LINEAR_LIMIT=8 # max. number of ranges per AF that are scanned linearly
+
+    def __init__(self):
+        self.ranges={False:[], True:[]}
+        self.index={False:None, True:None}
+
+    def __len__(self):
+        """ :returns: Number of ranges in the set """
+        return len(self.ranges[False])+len(self.ranges[True])
+
+    def add(self, ipv6, network, plen, minlen, maxlen):
+        """ Add a prefix range to the set.
+
+        :param bool ipv6: IPv6 flag
+        :param int network: Network address as int
+        :param int plen: Prefix length of the network
+        :param int minlen: Minimal prefix length of matching prefixes
+        :param int maxlen: Maximal prefix length of matching prefixes
+        """
+
+        # matching prefix has to be contained in the network
+        minlen=max(minlen, plen)
+        if minlen > maxlen:
+            return # can never match
+
+        mask=common.prefixlen_to_mask(plen, ipv6)
+        self.ranges[ipv6].append((network & mask, mask, minlen, maxlen))
+        self.index[ipv6]=None
+
+    def compact(self):
+        """ Remove duplicate ranges (i.e. after expansion of nested sets). """
+        for ipv6 in (False, True):
+            self.ranges[ipv6]=sorted(set(self.ranges[ipv6]))
+            self.index[ipv6]=None
+
+    def _buildIndex(self, ipv6):
+        """ Internal method. Do not use.
+        Build index: list of (mask, {network: [(minlen, maxlen), ...]})
+        sorted by the prefix length of the networks.
+
+        :param bool ipv6: IPv6 flag
+        :returns: The index
+        """
+
+        levels={}
+        for (network, mask, minlen, maxlen) in self.ranges[ipv6]:
+            if not mask in levels:
+                levels[mask]={}
+            if not network in levels[mask]:
+                levels[mask][network]=[]
+            levels[mask][network].append((minlen, maxlen))
+
+        self.index[ipv6]=[(m, levels[m]) for m in sorted(levels.keys())]
+        return self.index[ipv6]
+
+    def matchInt(self, ipv6, network, plen):
+        """ Test whether the prefix matches any range in the set.
+
+        :param bool ipv6: IPv6 flag
+        :param int network: Network address of the prefix as int
+        :param int plen: Prefix length
+        :returns: True when the prefix matches, False otherwise
+        """
+
+        ranges=self.ranges[ipv6]
+        if len(ranges) <= self.LINEAR_LIMIT:
+            for (n, mask, minlen, maxlen) in ranges:
+                if (network & mask) == n and minlen <= plen <= maxlen:
+                    return True
+            return False
+
+        index=self.index[ipv6]
+        if index is None:
+            index=self._buildIndex(ipv6)
+        for (mask, table) in index:
+            rl=table.get(network & mask)
+            if rl:
+                for (minlen, maxlen) in rl:
+                    if minlen <= plen <= maxlen:
+                        return True
+        return False
+
+    def match(self, prefix):
+        """ Test whether the prefix matches any range in the set.
+
+        :param str prefix: Prefix to match
+        :returns: True when the prefix matches, False otherwise
+        """
+        return self.matchInt(*common.prefix_to_int(prefix))
+
+    def __str__(self):
+        """ :returns: String representation of the set """
+        return 'PrefixRangeSet: %s'%str(self.ranges)
+
+    def __repr__(self):
+        """ :returns: String representation of the set """
+        return self.__str__()
+
+
+class FilterNode(object):
+    """ Abstract node of a compiled RPSL filter. Nodes are created by
+    AutNumRule.compileFilter() and shared among all rules that contain
+    the same filter text, so they must not hold any per-day state.
+    """
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ Evaluate the filter.
+
+        :param str prefix: Prefix to match
+        :param aspath: list of strings, Current AS path from the matching AS point of view
+        :param FilterDirs dirs: Directories to resolve references in
+        :returns: Error code, see AutNumRule.matchFilter() for details
+        """
+        raise Exception("This is abstract object. Dunno how to evaluate!")
+
+    def getChildren(self):
+        """
+        :returns: List of operand nodes
+        """
+        return []
+
+    def withChildren(self, children):
+        """ Copy the node with other operand nodes. Nodes are shared, therefore
+        a changed filter is built from copies instead of modifying the nodes.
+
+        :param children: List of FilterNode in the order of getChildren()
+        :returns: New FilterNode
+        """
+        return self
+
+    def getDeps(self, dirs):
+        """ Report inputs of evaluate() that the verdict depends on.
+
+        :param FilterDirs dirs: Directories to resolve references in
+        :returns: Bitmask of FILTER_DEP_* flags
+        """
+        deps=0
+        for c in self.getChildren():
+            deps|=c.getDeps(dirs)
+        return deps
+
+    def getRefs(self, dirs, refs):
+        """ Collect RPSL objects that the verdict might depend on.
+
+        :param FilterDirs dirs: Directories to resolve references in
+        :param refs: Set to add (class, key) tuples to, i.e. ('as-set', 'AS-FOO')
+        """
+        for c in self.getChildren():
+            c.getRefs(dirs, refs)
+
+    @staticmethod
+    def getOrigin(aspath):
+        """
+        :param aspath: list of strings, AS path
+        :returns: Origin ASN (the last one in the AS path) or ''
+        """
+        return (aspath[-1].strip() if aspath else '')
+
+    def __str__(self):
+        """ :returns: String representation of the node """
+        return '%s%s'%(self.__class__.__name__, str(self.__dict__))
+
+    def __repr__(self):
+        """ :returns: String representation of the node """
+        return self.__str__()
+
+
+class FilterOr(FilterNode):
+    """ Filter node: a OR b """
+
+    def __init__(self, a, b):
+        """
+        :param FilterNode a: Left operand
+        :param FilterNode b: Right operand
+        """
+        self.a=a
+        self.b=b
+
+    def getChildren(self):
+        """ See FilterNode.getChildren() """
+        return [self.a, self.b]
+
+    def withChildren(self, children):
+        """ See FilterNode.withChildren() """
+        return FilterOr(children[0], children[1])
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ See FilterNode.evaluate() """
+        a=self.a.evaluate(prefix, aspath, dirs)
+        if a == 0:
+            return 0
+        b=self.b.evaluate(prefix, aspath, dirs)
+        if a >= 20 and b >= 20:
+            return 20
+        return (0 if b == 0 else 9)
+
+
+class FilterAnd(FilterNode):
+    """ Filter node: a AND b """
+
+    def __init__(self, a, b):
+        """
+        :param FilterNode a: Left operand
+        :param FilterNode b: Right operand
+        """
+        self.a=a
+        self.b=b
+
+    def getChildren(self):
+        """ See FilterNode.getChildren() """
+        return [self.a, self.b]
+
+    def withChildren(self, children):
+        """ See FilterNode.withChildren() """
+        return FilterAnd(children[0], children[1])
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ See FilterNode.evaluate() """
+        a=self.a.evaluate(prefix, aspath, dirs)
+        if a >= 20:
+            return 20
+        b=self.b.evaluate(prefix, aspath, dirs)
+        if b >= 20:
+            return 20
+        return (0 if a == 0 and b == 0 else 9)
+
+
+class FilterNot(FilterNode):
+    """ Filter node: NOT a """
+
+    def __init__(self, a):
+        """
+        :param FilterNode a: Operand
+        """
+        self.a=a
+
+    def getChildren(self):
+        """ See FilterNode.getChildren() """
+        return [self.a]
+
+    def withChildren(self, children):
+        """ See FilterNode.withChildren() """
+        return FilterNot(children[0])
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ See FilterNode.evaluate() """
+        a=self.a.evaluate(prefix, aspath, dirs)
+        if a >= 20:
+            return 20
+        return (0 if not a == 0 else 9)
+
+
+class FilterList(FilterNode):
+    """ Filter node: list of identifiers (= from AS666 accept AS1 AS2 AS-HELL) """
+
+    def __init__(self, members):
+        """
+        :param members: List of FilterNode
+        """
+        self.members=members
+
+    def getChildren(self):
+        """ See FilterNode.getChildren() """
+        return self.members
+
+    def withChildren(self, children):
+        """ See FilterNode.withChildren() """
+        return FilterList(list(children))
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ See FilterNode.evaluate() """
+        for m in self.members:
+            if m.evaluate(prefix, aspath, dirs) == 0:
+                return 0
+        return 4 # most common use case is listing ASNs, therefore inherit ASN failure code
+
+
+class FilterAny(FilterNode):
+    """ Filter node: ANY or AS-ANY """
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ See FilterNode.evaluate() """
+        return 0
+
+
+class FilterPeerAS(FilterNode):
+    """ Filter node: PeerAS """
+
+    def getDeps(self, dirs):
+        """ See FilterNode.getDeps() """
+        return FILTER_DEP_ENDS
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ See FilterNode.evaluate() """
+        # allow as-path prepending, i.e. aspath can be [x,x,x,x] and origin x
+        if aspath and self.getOrigin(aspath) == aspath[0]:
+            return 0
+        else:
+            return 7
+
+
+class FilterASN(FilterNode):
+    """ Filter node: ASN (= i.e. AS1) """
+
+    def __init__(self, asn):
+        """
+        :param str asn: ASN
+        """
+        self.asn=asn
+
+    def getDeps(self, dirs):
+        """ See FilterNode.getDeps() """
+        return FILTER_DEP_ENDS
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ See FilterNode.evaluate() """
+        return (0 if self.asn == self.getOrigin(aspath) else 4)
+
+
+class FilterAsSetRef(FilterNode):
+    """ Filter node: reference to an as-set """
+
+    def __init__(self, name):
+        """
+        :param str name: as-set name
+        """
+        self.name=name
+
+    def getDeps(self, dirs):
+        """ See FilterNode.getDeps() """
+        return FILTER_DEP_ENDS
+
+    def getRefs(self, dirs, refs):
+        """ See FilterNode.getRefs() """
+        refs.add(('as-set', self.name))
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ See FilterNode.evaluate() """
+        if self.name in dirs.asset_dir.table:
+            # special recursion is used for speedup (otherwise
+            # recursion in the filter could do the job)
+            if dirs.asset_dir.table[self.name].recursiveMatch(self.getOrigin(aspath), dirs.asset_dir):
+                return 0
+            else:
+                return 5
+        else:
+            return 6
+
+
+class FilterPrefixSet(FilterNode):
+    """ Filter node: prefix filter (= i.e. { 1.2.3.0/16^23-24 }) """
+
+    def __init__(self, text):
+        """
+        :param str text: Prefix filter text
+        """
+        self.text=text
+        self.prs=AutNumRule.compilePfxFltr(text)
+
+    def getDeps(self, dirs):
+        """ See FilterNode.getDeps() """
+        return FILTER_DEP_PREFIX
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ See FilterNode.evaluate() """
+        if self.prs.match(prefix):
+            return 0
+        else:
+            return 8
+
+
+class FilterFltrSetRef(FilterNode):
+    """ Filter node: reference to a filter-set """
+
+    def __init__(self, name):
+        """
+        :param str name: filter-set name
+        """
+        self.name=name
+
+    def getDeps(self, dirs):
+        """ See FilterNode.getDeps() """
+        if not self.name in dirs.fltrset_dir.table:
+            return 0
+        nodes=getattr(dirs.fltrset_dir.table[self.name], 'nodes', None)
+        if nodes is not None:
+            return nodes[dirs.ipv6].getDeps(dirs)
+        return FILTER_DEP_ALL
+
+    def getRefs(self, dirs, refs):
+        """ See FilterNode.getRefs() """
+        key=('filter-set', self.name)
+        if key in refs:
+            return # already visited (or a loop)
+        refs.add(key)
+
+        if self.name in dirs.fltrset_dir.table:
+            fs=dirs.fltrset_dir.table[self.name]
+            nodes=getattr(fs, 'nodes', None)
+            if nodes is not None:
+                nodes[dirs.ipv6].getRefs(dirs, refs)
+            else:
+                AutNumRule.compileFilter(fs.mp_filter if dirs.ipv6 else fs.filter).getRefs(dirs, refs)
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ See FilterNode.evaluate() """
+        if self.name in dirs.fltrset_dir.table:
+            fs=dirs.fltrset_dir.table[self.name]
+            # use filters resolved by FilterSetObject.resolveDirectory()
+            nodes=getattr(fs, 'nodes', None)
+            if nodes is not None:
+                return nodes[dirs.ipv6].evaluate(prefix, aspath, dirs)
+            return AutNumRule.compileFilter(fs.mp_filter if dirs.ipv6 else fs.filter).evaluate(prefix, aspath, dirs)
+        else:
+            return 10
+
+
+class FilterRouteSetRef(FilterNode):
+    """ Filter node: reference to a route-set """
+
+    def __init__(self, name):
+        """
+        :param str name: route-set name
+        """
+        self.name=name
+
+    def getDeps(self, dirs):
+        """ See FilterNode.getDeps() """
+        if not self.name in dirs.rtset_dir.table:
+            return 0
+        return FILTER_DEP_PREFIX
+
+    def getRefs(self, dirs, refs):
+        """ See FilterNode.getRefs() """
+        refs.add(('route-set', self.name))
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ See FilterNode.evaluate()
+
+        :raises Exception: When the route-set has not been expanded \
+        (see RouteSetObject.expandDirectory())
+        """
+        if not self.name in dirs.rtset_dir.table:
+            return 11
+
+        prs=getattr(dirs.rtset_dir.table[self.name], 'prefixes', None)
+        if prs is None:
+            raise Exception("Route-set "+self.name+" has not been expanded")
+        return (0 if prs.match(prefix) else 11)
+
+
+class FilterAsPathRegex(FilterNode):
+    """ Filter node: <regular expression> """
+
+    def __init__(self, text):
+        """
+        :param str text: Regexp filter text including <>
+        """
+        self.text=text
+
+    def getDeps(self, dirs):
+        """ See FilterNode.getDeps() """
+        return FILTER_DEP_ASPATH
+
+    def getRefs(self, dirs, refs):
+        """ See FilterNode.getRefs() """
+        m=REGEXP_FLTR_PARSE.match(self.text)
+        r=(AsPathRegExp.compile(m.group(1)) if m else None)
+        if r:
+            for a in r.assets:
+                refs.add(('as-set', a))
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ See FilterNode.evaluate() """
+        r=AutNumRule.matchAsPathRegExp(self.text, aspath, dirs.asset_dir)
+        if r>20:
+            return 20
+        else:
+            return r
+
+
+class FilterUnknown(FilterNode):
+    """ Filter node that can not be decided. It always evaluates to
+    a constant code (i.e. 20=unknown filter, 22=community or 14=empty filter).
+    """
+
+    def __init__(self, code=20):
+        """
+        :param int code: Error code to return
+        """
+        self.code=code
+
+    def evaluate(self, prefix, aspath, dirs):
+        """ See FilterNode.evaluate() """
+        return self.code
 
-ASN_MATCH=re.compile('^AS[0-9]+$')
-PFX_FLTR_MATCH=re.compile('^\{([^}]*)\}(\^[0-9\+-]+)?$')
-PFX_FLTR_PARSE=re.compile('^([0-9A-F:\.]+/[0-9]+)(\^[0-9\+-]+)?$')
-REGEXP_FLTR_PARSE=re.compile('^<([^>]+)>$')
 
-PARSE_RANGE=re.compile('^\^([0-9]+)-([0-9]+)$')
 
 class AutNumRule(object):
     """ Abstract base for internal representation of a rule in an aut-num object. """
@@ -500,8 +1449,15 @@ class AutNumRule(object):
 
         afi is by default ipv4.unicast. For MP rules it is being parsed and
         filled in according to the rule content.
+
+        Results are memoized by the rule text (identical rules are shared
+        among aut-num objects and days), callers must not modify them.
         """
 
+        key=(self.__class__, self.mp, self.text)
+        if key in _glob_rule_cache:
+            return _glob_rule_cache[key]
+
         afi='IPV4.UNICAST'
         text=self.text
 #        common.d("_parseRule1 afi",afi,"text",text)
@@ -526,8 +1482,24 @@ class AutNumRule(object):
         defaultRule = (self.__class__.__name__ == 'AutNumDefaultRule')
         factors=AutNumRule._decomposeExpression(text, defaultRule)
 
-        return (afi,[AutNumRule._normalizeFactor(f, factors[1]) for f in factors[0]])
+        res=(afi,[AutNumRule._normalizeFactor(f, factors[1]) for f in factors[0]])
+        if len(_glob_rule_cache) >= RULE_CACHE_LIMIT:
+            _glob_rule_cache.clear()
+        _glob_rule_cache[key]=res
+        return res
+
 
+    @staticmethod
+    def matchAfi(afi, ipv6):
+        """ Test whether afi of the rule covers the address family.
+
+        :param str afi: AFI from _parseRule()
+        :param bool ipv6: IPv6 flag
+        :returns: True when the rule applies to the address family
+        """
+        if afi == 'ANY' or afi == 'ANY.UNICAST':
+            return True
+        return (afi == ('IPV6.UNICAST' if ipv6 else 'IPV4.UNICAST'))
 
     @staticmethod
     def isASN(asn):
@@ -558,79 +1530,104 @@ class AutNumRule(object):
         return PFX_FLTR_PARSE.match(pfx) != None
 
     @staticmethod
-    def matchPfxFltr(fltr, prefix, ipv6):
-        """ Try to match the prefix filter with the prefix.
+    def _parseRange(rng, lowbound, ipv6):
+        """ Internal function. Do not use.
+        Parse range in the RPSL prefix filter.
 
-        :param str fltr: Filter to match
-        :param str prefix: Prefix to match
+        :param str rng: Range string
+        :param int lowbound: Default low bound
         :param bool ipv6: IPv6 flag
-        :returns: True when prefix matches the filter, False otherwise
+        :returns: [min. prefix length, max. prefix length]
         """
-        #common.d("matchPfxFltr:", fltr, prefix)
-        
-        def _parseRange(rng, lowbound, ipv6):
-            """ Parse range in the RPSL prefix filter.
 
-            :param str rng: Range string
-            :param int lowbound: Default low bound
-            :param bool ipv6: IPv6 flag
-            """
+        maxpl = 128 if ipv6 else 32
+        rng=rng.strip()
 
-            maxpl = 128 if ipv6 else 32
-            rng=rng.strip()
-                
-            if rng == '^+':
-                return [int(lowbound), maxpl]
-            elif rng == '^-':
-                return [int(lowbound)+1, maxpl]
+        if rng == '^+':
+            return [int(lowbound), maxpl]
+        elif rng == '^-':
+            return [int(lowbound)+1, maxpl]
 
-            elif rng[1:].isdigit():
-                return [int(rng[1:]),int(rng[1:])]
-                
-            elif PARSE_RANGE.match(rng):
-                m=PARSE_RANGE.match(rng)
-                return [int(m.group(1)), int(m.group(2))]
+        elif rng[1:].isdigit():
+            return [int(rng[1:]),int(rng[1:])]
 
-            else:
-                common.w("Can not parse range:", rng)
-                return [0,maxpl]
+        elif PARSE_RANGE.match(rng):
+            m=PARSE_RANGE.match(rng)
+            return [int(m.group(1)), int(m.group(2))]
+
+        else:
+            common.w("Can not parse range:", rng)
+            return [0,maxpl]
+
+    @staticmethod
+    def addPfxRange(prs, pfx, grng=None):
+        """ Parse prefix range (i.e. 1.2.0.0/16^24-32) and add it to
+        a PrefixRangeSet.
+
+        :param PrefixRangeSet prs: Set to add the range to
+        :param str pfx: Prefix with optional range operator
+        :param str grng: Range operator applied to the whole filter or None
+        :returns: True when the range has been added, False when it can not be parsed
+        """
+
+        m=PFX_FLTR_PARSE.match(pfx.strip())
+        if not m:
+            return False
 
-        if fltr.strip() == '{}':
+        try:
+            (ipv6, network, plen)=common.prefix_to_int(m.group(1))
+        except Exception:
             return False
 
-        m=PFX_FLTR_MATCH.match(fltr.strip())
-        grng=None
+        # take into account possibility of multiple ranges,
+        # i.e. {1.2.0.0/16^+}^24-32 (use the most specific one, left-most)
+        # if no range is set, take the prefix as it is
+        rng=[plen, plen]
         if m.group(2):
-            grng = _parseRange(m.group(2), ipv6)
-
-        for f in m.group(1).strip().split(','):
-            f=f.strip()
-            m=PFX_FLTR_PARSE.match(f)
-            fnet=None
-            rng=None
-            if m:
-                fnet=ipaddr.IPNetwork(m.group(1))
-                if m.group(2):
-                    rng = _parseRange(m.group(2), fnet.prefixlen, ipv6)
-            else:
-                raise Exception("Can not parse filter: "+fltr+" matching with pfx "+prefix)
+            rng=AutNumRule._parseRange(m.group(2), plen, ipv6)
+        elif grng:
+            rng=AutNumRule._parseRange(grng, plen, ipv6)
 
-            pnet=ipaddr.IPNetwork(prefix)
+        prs.add(ipv6, network, plen, rng[0], rng[1])
+        return True
 
-            # take into account possibility of multiple ranges,
-            # i.e. {1.2.0.0/16^+}^24-32 (use the most specific one, left-most)
-            # if no range is set, take the prefix as it is
-            if not rng and grng:
-                rng=grng
-            if not rng:
-                rng=[fnet.prefixlen, fnet.prefixlen]
+    @staticmethod
+    def compilePfxFltr(fltr):
+        """ Compile prefix filter (i.e. { 1.2.0.0/16^24-32, 5.0.0.0/8 }) to
+        a PrefixRangeSet. Compiled filters are memoized by the filter text.
 
-            # finaly do the check
-            if (pnet in fnet) and (rng[0] <= pnet.prefixlen) and (rng[1] >= pnet.prefixlen):
-                return True
+        :param str fltr: Filter to compile
+        :returns: PrefixRangeSet instance
+        """
 
-        # no match means filter failed -> false
-        return False
+        fltr=fltr.strip()
+        if fltr in _glob_pfxfltr_cache:
+            return _glob_pfxfltr_cache[fltr]
+
+        prs=PrefixRangeSet()
+        m=PFX_FLTR_MATCH.match(fltr)
+        if m and m.group(1).strip():
+            for f in m.group(1).strip().split(','):
+                if not AutNumRule.addPfxRange(prs, f, m.group(2)):
+                    common.w("Can not parse prefix", f.strip(), "in filter:", fltr)
+
+        if len(_glob_pfxfltr_cache) >= PFXFLTR_CACHE_LIMIT:
+            _glob_pfxfltr_cache.clear()
+        _glob_pfxfltr_cache[fltr]=prs
+        return prs
+
+    @staticmethod
+    def matchPfxFltr(fltr, prefix, ipv6=False):
+        """ Try to match the prefix filter with the prefix.
+
+        :param str fltr: Filter to match
+        :param str prefix: Prefix to match
+        :param bool ipv6: IPv6 flag (unused, AF is taken from the prefixes)
+        :returns: True when prefix matches the filter, False otherwise
+        """
+        #common.d("matchPfxFltr:", fltr, prefix)
+
+        return AutNumRule.compilePfxFltr(fltr).match(prefix)
 
 
     @staticmethod
@@ -643,14 +1640,16 @@ class AutNumRule(object):
         return REGEXP_FLTR_PARSE.match(fltr) != None
 
     @staticmethod
-    def matchAsPathRegExp(fltr, asPath):
-        """ Apply regexp from regexp filter. This is a bit bold because
-        we just use Python's re.
+    def matchAsPathRegExp(fltr, asPath, assetDirectory=None):
+        """ Apply regexp from regexp filter. The regexp is compiled to NFA
+        over ASN tokens (see AsPathRegExp) and cached.
 
         Allocated failure code is 13 and dunno code 21. OK=0.
 
         :param str fltr: Filter string
         :param asPath: AS path to match
+        :param HashObjectDir assetDirectory: HashObjectDir instance that contains AsSet objs \
+        (needed only when the regexp refers as-sets)
         :returns: int, 0 if the AS-path matches the filter, non-zero error code otherwise
         """
 
@@ -658,241 +1657,177 @@ class AutNumRule(object):
             return 13
 
         ref = REGEXP_FLTR_PARSE.match(fltr).group(1) # should not fail... test it before
-        ref.replace('PEERAS', asPath[0])
-
-        if not ref.startswith('^'):
-            ref='.*'+ref
-        if not ref.endswith('$'):
-            ref+='.*'
-
-        if ref.find('AS-') > -1:
-            # can not recursively expand as-set names, return dunno
-            # this is potential problem of large scale, but it is more
-            # efficient to adress this by manual analysis or by own script
-            # because regexp parsing is anyway problematic when RPSL is
-            # being translated to Cisco/Juniper/... configs
-            common.w("matchAsPathRegExp shortcut. fltr:", fltr, "aspath", asPath)
-            return 21
+        r = AsPathRegExp.compile(ref)
+        if r == None:
+            return 21 # invalid or unsupported regexp (=dunno)
 
-        # Attempt the match
-        asps=''
-        for i,asn in enumerate(asPath):
-            asps+=(asn+' ')
-        asps=asps.strip()
-
-        try:
-            if re.match(ref, asps):
-                return 0
-        except:
-            common.w("matchAsPathRegExp failed due to invalid regexp. fltr:", fltr, "aspath", asPath)
+        if r.uses_asset and assetDirectory == None:
+            common.w("matchAsPathRegExp can not expand as-set without directory. fltr:", fltr, "aspath", asPath)
             return 21
 
+        if r.match(asPath, assetDirectory):
+            return 0
+
         # return not-match otherwise
         return 13
             
     @staticmethod
-    def matchFilter(fltr, prefix, currentAsPath, assetDirectory, fltrsetDirectory, rtsetDirectory, ipv6=False, recursion_list=None):
-        """ Matches filter fltr to prefix with currentAsPath.
-        Using assetDirectory, fltrsetDirectory and rtsetDirectory.
+    def _findOper(text, oper):
+        """ Internal function. Do not use.
+        Find the first occurance of operator that is out of the parentheses.
 
-        :param str fltr: Filter to match
-        :param str prefix: Prefix to match
-        :param currentAsPath: list of strings, Current AS from the matching AS point of view
-        :param HashObjectDir assetDirectory: HashObjectDir instance that contains AsSet objs
-        :param HashObjectDir fltrsetDirectory: HashObjectDir instance that contains FltrSet objs
-        :param HashObjectDir rtsetDirectory: HashObjectDir instance that contains RtSet objs
-        :param bool ipv6: IPv6 flag
-        :param recursion_list: list of keys of objects traversed because of recursion
-        :returns: Error code
+        :param str text: Filter text
+        :param str oper: Operator to find
+        :returns: Index of the operator or -1
+        """
+        pc=0
+        for i,c in enumerate(text):
+            if c == '(':
+                pc+=1
+            if c == ')':
+                pc-=1
+            if pc == 0 and text[i:].startswith(oper):
+                return i
+        return -1
 
-        Error codes:
-          * 0 when filter matches (=OK)
-          * 1-3 are reserved for calling functions
-          * 4 when fltr ASN != origin
-          * 5 when as-set recursive match fails
-          * 6 when unknown as-set is in the filter
-          * 7 PeerAS match failed
-          * 8 { prefix^range } match failed
-          * 9 composed expression failed
-          * 10 unknown fltr-set
-          * 11 unkown route-set or route-set not match
-          * 13 regexp failed to validate
-          * 14 empty filter (None or '')
-          * 20 unknown filter (=dunno)
-          * 21 unknown regexp (=dunno)
-          * 22 community can not be decided (=dunno)
+    @staticmethod
+    def compileFilter(fltr):
+        """ Compile filter text to a tree of FilterNode objects. Compiled filters
+        are memoized by the filter text because many aut-num objects share
+        identical filters.
+
+        :param str fltr: Filter to compile
+        :returns: FilterNode instance
+        :raises: Exception when parentheses or prefix filter can not be parsed
         """
-        
-        #common.d("Matching filter", fltr, 'prefix', prefix, 'currentAsPath', str(currentAsPath))
 
-        origin=(currentAsPath[-1].strip() if currentAsPath else '')
-        if not fltr:
-            return 14 # empty filter -> fail
-        fltr=fltr.strip().rstrip(';').strip()
+        fltr=(fltr.strip().rstrip(';').strip() if fltr else '')
+        if fltr in _glob_filter_cache:
+            return _glob_filter_cache[fltr]
 
+        n=AutNumRule._compileFilter(fltr)
+        if len(_glob_filter_cache) >= FILTER_CACHE_LIMIT:
+            _glob_filter_cache.clear()
+        _glob_filter_cache[fltr]=n
+        return n
 
-        # Recrusion for composed filters (with NOT, AND and OR)
-        def findOper(text, oper):
-            """ Find the first occurance of operator that is out of the parentheses. """
-            pc=0
-            for i,c in enumerate(text):
-                if c == '(':
-                    pc+=1
-                if c == ')':
-                    pc-=1
-                if pc == 0 and text[i:].startswith(oper):
-                    return i
-            return -1
+    @staticmethod
+    def _compileFilter(fltr):
+        """ Internal function. Do not use. Use compileFilter() instead.
+
+        :param str fltr: Normalized filter text
+        :returns: FilterNode instance
+        """
+
+        if not fltr:
+            return FilterUnknown(14) # empty filter -> fail
 
+        # Recrusion for composed filters (with NOT, AND and OR)
         op=" OR "
-        i=findOper(fltr, op)
+        i=AutNumRule._findOper(fltr, op)
         if i>=0:
-            #common.d("OR recursion a:", fltr[:i], "b:", fltr[i+len(op):])
-            a=AutNumRule.matchFilter(fltr[:i], prefix, currentAsPath, assetDirectory, fltrsetDirectory, rtsetDirectory, ipv6)
-            b=AutNumRule.matchFilter(fltr[i+len(op):], prefix, currentAsPath, assetDirectory, fltrsetDirectory, rtsetDirectory, ipv6)
-            #common.d("Recusion result a:", a, "b", b)
-            if a >= 20 and b >= 20:
-                return 20
-            
-            return (0 if a == 0 or b == 0 else 9)
+            return FilterOr(AutNumRule.compileFilter(fltr[:i]), AutNumRule.compileFilter(fltr[i+len(op):]))
 
         op=" AND "
-        i=findOper(fltr, op)
+        i=AutNumRule._findOper(fltr, op)
         if i>=0:
-            #common.d("AND recursion a:", fltr[:i], "b:", fltr[i+len(op):])
-            a=AutNumRule.matchFilter(fltr[:i], prefix, currentAsPath, assetDirectory, fltrsetDirectory, rtsetDirectory, ipv6)
-            b=AutNumRule.matchFilter(fltr[i+len(op):], prefix, currentAsPath, assetDirectory, fltrsetDirectory, rtsetDirectory, ipv6)
-            #common.d("AND recusion result a:", a, "b", b)
-            if a >= 20 or b >= 20:
-                return 20
-            return (0 if a == 0 and b == 0 else 9)
+            return FilterAnd(AutNumRule.compileFilter(fltr[:i]), AutNumRule.compileFilter(fltr[i+len(op):]))
 
         op="NOT "
-        i=findOper(fltr, op)
+        i=AutNumRule._findOper(fltr, op)
         if i>=0:
-            #common.d("NOT recursion a:", fltr[:i])
-            a=AutNumRule.matchFilter(fltr[i+len(op):], prefix, currentAsPath, assetDirectory, fltrsetDirectory, rtsetDirectory, ipv6)
-            #common.d("NOT recusion result a:", a)
-            if a >= 20:
-                return 20
-            return (0 if not a == 0 else 9)
+            return FilterNot(AutNumRule.compileFilter(fltr[i+len(op):]))
 
         # Parentheses
         if fltr[0] == '(':
             if fltr[-1] == ')':
-                return AutNumRule.matchFilter(fltr[1:-1], prefix, currentAsPath, assetDirectory, fltrsetDirectory, rtsetDirectory, ipv6)
+                return AutNumRule.compileFilter(fltr[1:-1])
             else:
-                raise Exception("Can not parse parentheses in filter:", fltr)
+                raise Exception("Can not parse parentheses in filter: "+fltr)
 
         # Atomic statements
 
-        if fltr.strip() == 'ANY':
-            return 0
-
-        if fltr.strip() == 'AS-ANY':
-            return 0
+        if fltr == 'ANY' or fltr == 'AS-ANY':
+            return FilterAny()
 
-        elif fltr.strip() == 'PEERAS':
-            if origin == currentAsPath[0]: # allow as-path prepending, i.e. aspath can be [x,x,x,x] and origin x
-                return 0
-            else:
-                return 7
+        elif fltr == 'PEERAS':
+            return FilterPeerAS()
 
         # ASN (= i.e. AS1)
         elif AutNumRule.isASN(fltr):
-            if fltr == origin:
-                #common.d("True, fltr ASN == origin", origin)
-                return 0
-            else:
-                #common.d("False, fltr ASN != origin f:", fltr, 'o:', origin)
-                return 4
+            return FilterASN(fltr)
 
         # as-set
         elif AsSetObject.isAsSet(fltr):
-            if fltr in assetDirectory.table:
-                # special recursion is used for speedup (otherwise
-                # recursion in this method could do the job)
-                if assetDirectory.table[fltr].recursiveMatch(origin, assetDirectory):
-                    #common.d('True, as-set recursive match f:', fltr, 'o:', origin)
-                    return 0
-                else:
-                    #common.d('False, no as-set recursive match f:', fltr, 'o:', origin)
-                    return 5
-            else:
-                #common.d('False, as-set not known. f:', fltr, 'o:', origin)
-                return 6
+            return FilterAsSetRef(fltr)
 
         # prefix filter (= i.e. { 1.2.3.0/16^23-24 })
         elif AutNumRule.isPfxFilter(fltr):
-            if AutNumRule.matchPfxFltr(fltr, prefix, ipv6):
-                return 0
-            else:
-                return 8
+            return FilterPrefixSet(fltr)
 
         # filter-set
         elif FilterSetObject.isFltrSet(fltr):
-            if fltr in fltrsetDirectory.table:
-                if ipv6:
-                    return AutNumRule.matchFilter(fltrsetDirectory.table[fltr].mp_filter, prefix, currentAsPath, assetDirectory,
-                                                  fltrsetDirectory, rtsetDirectory, ipv6)
-                else:
-                    return AutNumRule.matchFilter(fltrsetDirectory.table[fltr].filter, prefix, currentAsPath, assetDirectory,
-                                                  fltrsetDirectory, rtsetDirectory, ipv6)
-            else:
-                return 10
+            return FilterFltrSetRef(fltr)
 
         # route-set
         elif RouteSetObject.isRouteSet(fltr):
-            if fltr in rtsetDirectory.table:
-                rts = rtsetDirectory.table[fltr]
-
-                # prevent infinite recursion
-                rcl = (recursion_list if recursion_list else [])
-                if rts.getKey() in rcl:
-                    return 11
-                rcl.append(rts.getKey())
-
-                # recursively resolve members
-                # this needs own recursion because contents might be
-                # another route-set, as-set and/or IP range
-                members=(rts.mp_members if ipv6 else rts.members)
-                for m in members:
-                    if AutNumRule.isPfx(m): # prefix or prefix range
-                        if AutNumRule.matchFilter('{ '+m+' }', prefix, currentAsPath, assetDirectory,
-                                                  fltrsetDirectory, rtsetDirectory, ipv6) == 0:
-                            return 0
-                    else: # recursion (might contain another route-set, as-set or ASN)
-                        if AutNumRule.matchFilter(m, prefix, currentAsPath, assetDirectory,
-                                                  fltrsetDirectory, rtsetDirectory, ipv6, rcl) == 0:
-                            return 0
-            return 11
+            return FilterRouteSetRef(fltr)
 
         # <regular expression>
         elif AutNumRule.isAsPathRegExp(fltr):
-            r=AutNumRule.matchAsPathRegExp(fltr, currentAsPath)
-            if r>20:
-                return 20
-            else:
-                return r
+            return FilterAsPathRegex(fltr)
 
         # can not decide communities -> DUNNO
         elif fltr.find('COMMUNITY(') > -1 or fltr.find('COMMUNITY.CONTAINS(') > -1:
-            return 22
-        
+            return FilterUnknown(22)
+
         # list of identifiers (= from AS666 accept AS1 AS2 AS-HELL)
         elif len(fltr.split())>1:
-            for g in fltr.split():
-                if AutNumRule.matchFilter(g, prefix, currentAsPath, assetDirectory,
-                                          fltrsetDirectory, rtsetDirectory, ipv6) == 0:
-                    return 0
-            return 4 # most common use case is listing ASNs, therefore inherit ASN failure code
+            return FilterList([AutNumRule.compileFilter(g) for g in fltr.split()])
+
+        # Dunno
+        common.w("Can not parse filter:", fltr)
+        return FilterUnknown(20)
+
+    @staticmethod
+    def matchFilter(fltr, prefix, currentAsPath, assetDirectory, fltrsetDirectory, rtsetDirectory, ipv6=False):
+        """ Matches filter fltr to prefix with currentAsPath.
+        Using assetDirectory, fltrsetDirectory and rtsetDirectory.
+
+        The filter is compiled (see compileFilter()) on the first use and
+        the compiled form is reused afterwards.
+
+        :param str fltr: Filter to match
+        :param str prefix: Prefix to match
+        :param currentAsPath: list of strings, Current AS from the matching AS point of view
+        :param HashObjectDir assetDirectory: HashObjectDir instance that contains AsSet objs
+        :param HashObjectDir fltrsetDirectory: HashObjectDir instance that contains FltrSet objs
+        :param HashObjectDir rtsetDirectory: HashObjectDir instance that contains RtSet objs
+        :param bool ipv6: IPv6 flag
+        :returns: Error code
+
+        Error codes:
+          * 0 when filter matches (=OK)
+          * 1-3 are reserved for calling functions
+          * 4 when fltr ASN != origin
+          * 5 when as-set recursive match fails
+          * 6 when unknown as-set is in the filter
+          * 7 PeerAS match failed
+          * 8 { prefix^range } match failed
+          * 9 composed expression failed
+          * 10 unknown fltr-set
+          * 11 unkown route-set or route-set not match
+          * 13 regexp failed to validate
+          * 14 empty filter (None or '')
+          * 20 unknown filter (=dunno)
+          * 21 unknown regexp (=dunno)
+          * 22 community can not be decided (=dunno)
+        """
+        
+        #common.d("Matching filter", fltr, 'prefix', prefix, 'currentAsPath', str(currentAsPath))
 
-        # Dunno, return False
-        common.w("Can not parse filter:", fltr, 'hint pfx:', prefix, 'aspath:', currentAsPath)
-        # TODO rm
-        global filterdebug
-        common.w("Filter debug:", filterdebug)
-        return 20
+        return AutNumRule.compileFilter(fltr).evaluate(prefix, currentAsPath,
+                                                       FilterDirs(assetDirectory, fltrsetDirectory, rtsetDirectory, ipv6))
 
 
     def match(self, subject, prefix, currentAsPath, assetDirectory, fltrsetDirectory,
@@ -928,13 +1863,8 @@ class AutNumRule(object):
         res=self._parseRule() # return (afi, [(subject, filter)])
 
         # Check address family matches
-        if res[0] != 'ANY' and res[0] != 'ANY.UNICAST':
-            if ((ipv6 and res[0] != 'IPV6.UNICAST') or
-            ((not ipv6) and res[0] != 'IPV4.UNICAST')):
-                return 1
-
-        # TODO rm
-        global filterdebug
+        if not self.matchAfi(res[0], ipv6):
+            return 1
 
         # Walk through factors and find whether there is subject match,
         # run the filter if so
@@ -943,14 +1873,10 @@ class AutNumRule(object):
 
             if self.isASN(f[0]):
                 if f[0] == subject:
-                    # TODO rm
-                    filterdebug=f
                     return AutNumRule.matchFilter(f[1], prefix, currentAsPath, assetDirectory,
                                                   fltrsetDirectory, rtsetDirectory, ipv6)
 
             elif AsSetObject.isAsSet(f[0]):
-                # TODO rm
-                filterdebug=f
                 if f[0] == 'AS-ANY':
                     return AutNumRule.matchFilter(f[1], prefix, currentAsPath, assetDirectory,
                                                       fltrsetDirectory, rtsetDirectory, ipv6)
@@ -960,10 +1886,8 @@ class AutNumRule(object):
                                                       fltrsetDirectory, rtsetDirectory, ipv6)
 
             elif PeeringSetObject.isPeeringSet(f[0]):
-                # TODO rm
-                filterdebug=f
                 if f[0] in prngsetDirectory.table:
-                    if prngsetDirectory.table[f[0]].recursiveMatch(subject, prngsetDirectory):
+                    if prngsetDirectory.table[f[0]].recursiveMatch(subject, prngsetDirectory, ipv6=ipv6):
                         return AutNumRule.matchFilter(f[1], prefix, currentAsPath, assetDirectory,
                                                       fltrsetDirectory, rtsetDirectory, ipv6)
 
@@ -975,6 +1899,40 @@ class AutNumRule(object):
         # No match of factor for the subject means that the prefix should not appear
         return 3
 
+    def getFilterDeps(self, dirs):
+        """ Report inputs that verdicts of match() depend on besides the subject.
+        The result is kept in the object, so it is valid only as long as the
+        directories do not change.
+
+        :param FilterDirs dirs: Directories to resolve references in
+        :returns: Bitmask of FILTER_DEP_* flags, see FilterNode.getDeps()
+        """
+        if getattr(self, 'filter_deps', None) is None:
+            self.filter_deps={}
+
+        if not dirs.ipv6 in self.filter_deps:
+            try:
+                deps=0
+                for (subject, fltr) in self._parseRule()[1]:
+                    deps|=AutNumRule.compileFilter(fltr).getDeps(dirs)
+            except Exception:
+                deps=FILTER_DEP_ALL
+            self.filter_deps[dirs.ipv6]=deps
+
+        return self.filter_deps[dirs.ipv6]
+
+    def getFilterRefs(self, dirs, refs):
+        """ Collect RPSL objects referenced by filters of the rule.
+
+        :param FilterDirs dirs: Directories to resolve references in
+        :param refs: Set to add (class, key) tuples to, see FilterNode.getRefs()
+        """
+        try:
+            for (subject, fltr) in self._parseRule()[1]:
+                AutNumRule.compileFilter(fltr).getRefs(dirs, refs)
+        except Exception:
+            pass # the rule can not be matched at all
+
     
 
 class AutNumImportRule(AutNumRule):
@@ -1095,6 +2053,150 @@ class AutNumObject(RpslObject):
         """
         return self.aut_num
 
+    def dayCopy(self):
+        """ See RpslObject.dayCopy() """
+        o=copy.copy(self)
+        for a in ('import_list', 'export_list', 'mp_import_list', 'mp_export_list'):
+            rules=[]
+            for r in getattr(self, a):
+                r=copy.copy(r)
+                r.filter_deps=None
+                rules.append(r)
+            setattr(o, a, rules)
+        o.rule_index=None
+        o.subject_refs=None
+        return o
+
+    def _buildRuleIndex(self, rules, ipv6, asset_dir, prngset_dir):
+        """ Internal method. Do not use.
+        Create index of rules by neighbor ASN.
+
+        :param rules: List of AutNumRule in policy order
+        :param bool ipv6: IPv6 flag
+        :param HashObjectDir asset_dir: HashObjectDir with AsSet objs.
+        :param HashObjectDir prngset_dir: HashObjectDir with PeeringSet objs.
+        :returns: (index, anyrules), index is dict neighbor -> set of rule positions, \
+        anyrules is set of positions of rules that apply to any neighbor
+        """
+        index={}
+        anyrules=set()
+
+        def add(neighbor, i):
+            if neighbor in index:
+                index[neighbor].add(i)
+            else:
+                index[neighbor]=set([i])
+
+        for (i, r) in enumerate(rules):
+            if (not r.mp) and ipv6:
+                continue
+
+            try:
+                (afi, factors)=r._parseRule()
+            except Exception:
+                anyrules.add(i) # let AutNumRule.match() decide
+                continue
+
+            if not AutNumRule.matchAfi(afi, ipv6):
+                continue
+
+            for (subject, fltr) in factors:
+                if AutNumRule.isASN(subject):
+                    add(subject, i)
+
+                elif AsSetObject.isAsSet(subject):
+                    if subject == 'AS-ANY':
+                        anyrules.add(i)
+                    elif subject in asset_dir.table:
+                        asset=asset_dir.table[subject]
+                        if asset._ensureFlat(asset_dir):
+                            for a in asset.flat_asns:
+                                add('AS%d'%a, i)
+                        else:
+                            anyrules.add(i)
+
+                elif PeeringSetObject.isPeeringSet(subject):
+                    if subject in prngset_dir.table:
+                        prngset=prngset_dir.table[subject]
+                        if getattr(prngset, 'flat_peers', None) is None:
+                            PeeringSetObject.flattenDirectory(prngset_dir)
+                        flat=getattr(prngset, 'flat_peers', None)
+                        if flat is not None:
+                            for p in flat[ipv6]:
+                                add(p, i)
+                        else:
+                            anyrules.add(i)
+
+                else:
+                    # the rule ends with subject expansion failure for
+                    # the subjects that follow, see AutNumRule.match()
+                    break
+
+        return (index, anyrules)
+
+    def getRules(self, neighbor, export, ipv6, asset_dir, prngset_dir):
+        """ Get rules that might apply to the neighbor. The rules are
+        returned in policy order (rules followed by mp-rules). Index of
+        rules is built on the first use and kept in the object, it is valid
+        only as long as the set directories do not change.
+
+        :param str neighbor: ASN of the neighbor
+        :param bool export: Return export rules (import rules otherwise)
+        :param bool ipv6: IPv6 flag
+        :param HashObjectDir asset_dir: HashObjectDir with AsSet objs.
+        :param HashObjectDir prngset_dir: HashObjectDir with PeeringSet objs.
+        :returns: List of AutNumRule
+        """
+        if getattr(self, 'rule_index', None) is None:
+            self.rule_index={}
+
+        key=(export, ipv6)
+        if not key in self.rule_index:
+            rules=(self.export_list + self.mp_export_list if export else
+                   self.import_list + self.mp_import_list)
+            self.rule_index[key]=(rules,)+self._buildRuleIndex(rules, ipv6, asset_dir, prngset_dir)
+
+        (rules, index, anyrules)=self.rule_index[key]
+        pos=index.get(neighbor)
+        if pos is None:
+            pos=anyrules
+        elif anyrules:
+            pos=pos | anyrules
+        return [rules[i] for i in sorted(pos)]
+
+    def getSubjectRefs(self, export, ipv6):
+        """ Get sets referenced as subjects of the rules. The choice of rules
+        returned by getRules() depends on their content.
+
+        :param bool export: Export rules (import rules otherwise)
+        :param bool ipv6: IPv6 flag
+        :returns: frozenset of (class, key) tuples, see FilterNode.getRefs()
+        """
+        if getattr(self, 'subject_refs', None) is None:
+            self.subject_refs={}
+
+        key=(export, ipv6)
+        if not key in self.subject_refs:
+            refs=set()
+            for r in (self.export_list + self.mp_export_list if export else
+                      self.import_list + self.mp_import_list):
+                if (not r.mp) and ipv6:
+                    continue
+                try:
+                    factors=r._parseRule()[1]
+                except Exception:
+                    continue
+                for (subject, fltr) in factors:
+                    if subject == 'AS-ANY' or AutNumRule.isASN(subject):
+                        continue
+                    elif AsSetObject.isAsSet(subject):
+                        refs.add(('as-set', subject))
+                    elif PeeringSetObject.isPeeringSet(subject):
+                        refs.add(('peering-set', subject))
+            self.subject_refs[key]=frozenset(refs)
+
+        return self.subject_refs[key]
+
 
     def __str__(self):
         """ Return string representation.
@@ -1149,6 +2251,9 @@ class AsSetObject(RpslObject):
         RpslObject.__init__(self,textlines)
         self.as_set=None
         self.members=[]
+        self.flat_asns=None # see flattenDirectory()
+        self.depth=None
+        self.subtree_size=None
 
         for (a,v) in RpslObject.splitLines(self.text):
             if a==self.ASSET_ATTR:
@@ -1175,95 +2280,221 @@ class AsSetObject(RpslObject):
         """
         return self.as_set
 
+    def dayCopy(self):
+        """ See RpslObject.dayCopy() """
+        o=copy.copy(self)
+        o.members=list(self.members)
+        o.flat_asns=None
+        o.depth=None
+        o.subtree_size=None
+        return o
+
+    @staticmethod
+    def flattenDirectory(hashObjDir):
+        """ Compute transitive closure of all as-sets in the directory. Each
+        AsSetObject gets flat_asns (frozenset of ASN ints of all direct and
+        nested members), depth and subtree_size attributes.
+
+        The graph of as-set references is condensed to strongly connected
+        components (Tarjan) first, so reference loops are handled and all
+        as-sets in one component share the same closure. Closures are shared
+        with nested components whenever they are equal to save memory.
+
+        :param HashObjectDir hashObjDir: Dir object that holds the as-sets
+        """
+
+        table=hashObjDir.table
+
+        # direct ASNs and references to known as-sets
+        own={}
+        succ={}
+        for k in table.keys():
+            own[k]=set()
+            succ[k]=[]
+            for m in table[k].members:
+                if ASN_MATCH.match(m):
+                    own[k].add(int(m[2:]))
+                elif AsSetObject.isAsSet(m) and m in table:
+                    succ[k].append(m)
+
+        index={}
+        low={}
+        stack=[]
+        onstack=set()
+        sccof={} # as-set key -> component number
+        flat=[] # component number -> frozenset of ASN ints
+        depth=[] # component number -> depth
+        reach=[] # component number -> set of reachable components
+        sccsize=[] # component number -> number of as-sets in the component
+
+        def close_component(comp):
+            """ Compute closure for a component. All components reachable from
+            it are already closed (Tarjan emits them in reverse topological order).
+
+            :param comp: List of as-set keys in the component
+            """
+            cid=len(flat)
+            for k in comp:
+                sccof[k]=cid
+
+            asns=set()
+            nested=set()
+            for k in comp:
+                asns.update(own[k])
+                for m in succ[k]:
+                    if sccof[m] != cid:
+                        nested.add(sccof[m])
+
+            r=set([cid])
+            d=0
+            for n in nested:
+                asns.update(flat[n])
+                r.update(reach[n])
+                d=max(d, depth[n])
+
+            fs=None
+            for n in nested:
+                if len(flat[n]) == len(asns):
+                    fs=flat[n] # equal to the nested closure, share it
+                    break
+            if fs is None:
+                fs=frozenset(asns)
+
+            flat.append(fs)
+            depth.append(d+1)
+            reach.append(r)
+            sccsize.append(len(comp))
+
+            size=sum([sccsize[n] for n in r])
+            for k in comp:
+                o=table[k]
+                o.flat_asns=fs
+                o.depth=d+1
+                o.subtree_size=size
+
+        # iterative Tarjan's SCC algorithm
+        counter=0
+        for root in table.keys():
+            if root in index:
+                continue
+
+            index[root]=low[root]=counter
+            counter+=1
+            stack.append(root)
+            onstack.add(root)
+            work=[(root, iter(succ[root]))]
+
+            while work:
+                (v, it)=work[-1]
+                descended=False
+                for w in it:
+                    if not w in index:
+                        index[w]=low[w]=counter
+                        counter+=1
+                        stack.append(w)
+                        onstack.add(w)
+                        work.append((w, iter(succ[w])))
+                        descended=True
+                        break
+                    elif w in onstack:
+                        low[v]=min(low[v], index[w])
+                if descended:
+                    continue
+
+                work.pop()
+                if work:
+                    u=work[-1][0]
+                    low[u]=min(low[u], low[v])
+
+                if low[v] == index[v]:
+                    comp=[]
+                    while True:
+                        w=stack.pop()
+                        onstack.discard(w)
+                        comp.append(w)
+                        if w == v:
+                            break
+                    close_component(comp)
+
+    def _ensureFlat(self, hashObjDir):
+        """ Internal method. Do not use.
+        Make sure the closure is computed (objects loaded from pickles
+        created before flattening was introduced do not have it).
+
+        :param HashObjectDir hashObjDir: Dir object that holds the data
+        :returns: True when the closure is available
+        """
+        if getattr(self, 'flat_asns', None) is None:
+            AsSetObject.flattenDirectory(hashObjDir)
+        return getattr(self, 'flat_asns', None) is not None
+
     def recursiveMatch(self, target, hashObjDir, recursionList=None):
-        """ This methods does recusion in the objects members and tries to find match
-        with the target identifier.
+        """ This methods tries to find match of the target identifier in the
+        objects members and all nested as-sets.
 
-        This is being used by filter matching instead of full filter recursion because we
-        know that this type of object could hold only ASNs or references to another
-        as-sets and therefore full filter recursion is not needed and this special
-        recursion offers mild speedup.
+        ASN targets are looked up in the precomputed closure (see
+        flattenDirectory()), other targets (i.e. nested as-set names) are
+        found by recursion in the members.
 
         :param target: Target to find
         :param HashObjectDir hashObjDir: Dir object that holds the data
         :param recursionList: Recursion list to stop looping recursions
         :returns: True if the match is found, False otherwise
         """
-        
+
+        if ASN_MATCH.match(target) and self._ensureFlat(hashObjDir):
+            return int(target[2:]) in self.flat_asns
+
         if recursionList == None:
-            recursionList = []
+            recursionList = set()
         
 #        common.d("AsSetObject recursiveMatch: target", target, 'in', self.getKey(), 'recursionList', recursionList)
 #        common.d("Members:", self.members)
         # prevent recusion loop
         if self.getKey() in recursionList:
             return False
-        recursionList.append(self.getKey())
+        recursionList.add(self.getKey())
         
         if target in self.members:
             return True
 
         for m in self.members:
-            if self.isAsSet(m) and m in hashObjDir.table:
-                r = hashObjDir.table[m].recursiveMatch(target, hashObjDir, recursionList)
-                if r:
-                    return True
-
-        return False
-
-    def measureDepth(self, hashObjDir, recursionList=None):
-        """
-        This methods measures depth of the recursion tree.
-
-        The reason for having this function is debugging and statisics.
-
-        :param HashObjectDir hashObjDir: Dir object that holds the data
-        :param recursionList: Recursion list to stop looping recursion paths
-        :returns: Depth of the longest subtree
-        """
-        
-        if recursionList == None:
-            recursionList = []
-        
-        # prevent recusion loop
-        if self.getKey() in recursionList:
-            return 0
-        recursionList.append(self.getKey())
-
-        d = 0
-        for m in self.members:
-            if self.isAsSet(m) and m in hashObjDir.table:
-                r = hashObjDir.table[m].measureDepth(hashObjDir, recursionList)
-                if r>d:
-                    d = r
+            if self.isAsSet(m) and m in hashObjDir.table:
+                r = hashObjDir.table[m].recursiveMatch(target, hashObjDir, recursionList)
+                if r:
+                    return True
 
-        return d+1
+        return False
 
-    def measureSubtreeSize(self, hashObjDir, recursionList=None):
+    def measureDepth(self, hashObjDir, recursionList=None):
         """
-        This methods measures depth of the recursion tree.
+        This methods returns depth of the recursion tree, components of
+        as-sets referencing each other count as one level.
 
         The reason for having this function is debugging and statisics.
 
         :param HashObjectDir hashObjDir: Dir object that holds the data
-        :param recursionList: Recursion list to stop looping recursion paths
-        :returns: Size of the largest subtree
+        :param recursionList: Unused, kept for compatibility
+        :returns: Depth of the longest subtree
         """
         
-        if recursionList == None:
-            recursionList = []
-        
-        # prevent recusion loop
-        if self.getKey() in recursionList:
-            return 0
-        recursionList.append(self.getKey())
+        self._ensureFlat(hashObjDir)
+        return self.depth
 
-        d = 1
-        for m in self.members:
-            if self.isAsSet(m) and m in hashObjDir.table:
-                d += hashObjDir.table[m].measureSubtreeSize(hashObjDir, recursionList)
+    def measureSubtreeSize(self, hashObjDir, recursionList=None):
+        """
+        This methods returns number of as-sets reachable from this one
+        (including itself).
 
-        return d
+        The reason for having this function is debugging and statisics.
+
+        :param HashObjectDir hashObjDir: Dir object that holds the data
+        :param recursionList: Unused, kept for compatibility
+        :returns: Size of the subtree
+        """
+        
+        self._ensureFlat(hashObjDir)
+        return self.subtree_size
 
 
 
@@ -1330,7 +2561,54 @@ class PeeringSetObject(RpslObject):
         """
         return self.peering_set
 
-    def recursiveMatch(self, target, hashObjDir, recursionList=None):
+    def dayCopy(self):
+        """ See RpslObject.dayCopy() """
+        o=copy.copy(self)
+        o.flat_peers=None
+        return o
+
+    @staticmethod
+    def flattenDirectory(hashObjDir):
+        """ Resolve nested peering-sets of all objects in the directory and
+        store the resulting neighbor identifiers in attribute flat_peers of
+        each object as dict {ipv6 flag: frozenset}.
+
+        According to RFC 4012 peering attributes apply to IPv4 only while
+        mp-peering attributes apply to both address families.
+
+        :param HashObjectDir hashObjDir: Dir object that holds the peering-sets
+        """
+        table=hashObjDir.table
+
+        def collect(key, ipv6, visited, peers):
+            """ Collect neighbors of the peering-set and all nested peering-sets.
+
+            :param str key: Key of the peering-set
+            :param bool ipv6: Address family flag
+            :param visited: Set of keys of traversed peering-sets
+            :param peers: Set to fill with neighbor identifiers
+            """
+            if key in visited:
+                return
+            visited.add(key)
+
+            o=table[key]
+            for m in (o.mp_peering if ipv6 else o.peering + o.mp_peering):
+                if PeeringSetObject.isPeeringSet(m):
+                    if m in table:
+                        collect(m, ipv6, visited, peers)
+                else:
+                    peers.add(m)
+
+        for key in table.keys():
+            flat={}
+            for ipv6 in (False, True):
+                peers=set()
+                collect(key, ipv6, set(), peers)
+                flat[ipv6]=frozenset(peers)
+            table[key].flat_peers=flat
+
+    def recursiveMatch(self, target, hashObjDir, recursionList=None, ipv6=False):
         """
         This methods does recusion in the objects peering and mp-peering sections
         and tries to find match with the target identifier.
@@ -1340,12 +2618,24 @@ class PeeringSetObject(RpslObject):
         peering-sets and therefore full filter recursion is not needed and this special
         recursion offers mild speedup.
 
+        Neighbors are looked up in the sets precomputed by flattenDirectory()
+        when available.
+
         :param target: Target to match
         :param hashObjDir: Obj dir that contains the referenced data
         :param recursionList: List of traversed identifiers
+        :param bool ipv6: Match IPv6 neighbors (mp-peering only)
         :returns: True if the target has been found, False otherwise
         """
         if recursionList == None:
+            flat=getattr(self, 'flat_peers', None)
+            if flat is None:
+                # pickles created before flattening was introduced
+                PeeringSetObject.flattenDirectory(hashObjDir)
+                flat=getattr(self, 'flat_peers', None)
+            if flat is not None:
+                return target in flat[ipv6]
+
             recursionList = []
         
         #common.d("PeeringSetObject recursiveMatch: target", target, 'in', self.getKey(),
@@ -1445,6 +2735,92 @@ class FilterSetObject(RpslObject):
         
         return fltrsetid.upper().find('FLTR-') > -1
 
+    @staticmethod
+    def resolveDirectory(hashObjDir):
+        """ Compile filters of all filter-sets in the directory and store them
+        in attribute nodes of each object as dict {ipv6 flag: FilterNode}, so
+        that a reference to a filter-set costs a single lookup.
+
+        Filter-sets referencing each other in a loop can not be decided,
+        the reference that closes the loop is replaced by unknown filter
+        (code 20) in the filter of the referencing set, the rest of the filter
+        stays. Filter-sets are visited in the order of keys, so the same
+        reference is cut in each run.
+
+        :param HashObjectDir hashObjDir: Dir object that holds the filter-sets
+        """
+        table=hashObjDir.table
+
+        for o in table.values():
+            try:
+                o.nodes={False: AutNumRule.compileFilter(o.filter),
+                         True: AutNumRule.compileFilter(o.mp_filter)}
+            except Exception as e:
+                # leave it to the filter evaluation to fail
+                common.w("Can not compile filter-set", o.getKey(), ':', str(e))
+                o.nodes=None
+
+        def cut_reference(node, name):
+            """
+            :param FilterNode node: Root of the compiled filter
+            :param str name: Name of the filter-set that closes a loop
+            :returns: Copy of the filter with references to the filter-set \
+            replaced by unknown filter, the node itself when there are none
+            """
+            if isinstance(node, FilterFltrSetRef) and node.name == name:
+                return FilterUnknown(20)
+            children=node.getChildren()
+            cut=[cut_reference(c, name) for c in children]
+            if [c for (c, n) in zip(children, cut) if not c is n]:
+                return node.withChildren(cut)
+            return node
+
+        def references(node):
+            """
+            :param FilterNode node: Root of the compiled filter
+            :returns: Set of names of referenced filter-sets
+            """
+            refs=set()
+            stack=[node]
+            while stack:
+                n=stack.pop()
+                if isinstance(n, FilterFltrSetRef):
+                    refs.add(n.name)
+                stack.extend(n.getChildren())
+            return refs
+
+        for ipv6 in (False, True):
+            succ={}
+            for (k, o) in table.items():
+                if o.nodes:
+                    succ[k]=sorted([r for r in references(o.nodes[ipv6]) if r in table and table[r].nodes])
+                else:
+                    succ[k]=[]
+
+            # iterative DFS, break back edges
+            state={} # key -> 1 = on the stack, 2 = done
+            for root in sorted(table.keys()):
+                if root in state:
+                    continue
+                state[root]=1
+                work=[(root, iter(succ[root]))]
+                while work:
+                    (v, it)=work[-1]
+                    descended=False
+                    for w in it:
+                        if not w in state:
+                            state[w]=1
+                            work.append((w, iter(succ[w])))
+                            descended=True
+                            break
+                        elif state[w] == 1:
+                            common.w("Filter-set loop detected:", v, '->', w)
+                            table[v].nodes[ipv6]=cut_reference(table[v].nodes[ipv6], w)
+                    if descended:
+                        continue
+                    state[v]=2
+                    work.pop()
+
     def getKey(self):
         """
         :returns: Key of the FilterSet object.
@@ -1452,6 +2828,12 @@ class FilterSetObject(RpslObject):
         
         return self.filter_set
 
+    def dayCopy(self):
+        """ See RpslObject.dayCopy() """
+        o=copy.copy(self)
+        o.nodes=None
+        return o
+
     def __str__(self):
         """
         :returns: Text representation of the object.
@@ -1486,6 +2868,7 @@ class RouteSetObject(RpslObject):
         self.route_set=None
         self.members=[]
         self.mp_members=[]
+        self.prefixes=None # PrefixRangeSet, see expandDirectory()
 
         for (a,v) in RpslObject.splitLines(self.text):
             if a==self.ROUTESET_ATTR:
@@ -1511,6 +2894,83 @@ class RouteSetObject(RpslObject):
         """
         return str(rsid).find('RS-') > -1
 
+    @staticmethod
+    def _splitRange(member):
+        """ Internal function. Do not use.
+        Split member to name and range operator, i.e. RS-FOO^+ -> ('RS-FOO', '^+')
+
+        :param str member: Member name
+        :returns: Tuple (name, range operator or None)
+        """
+        m=SET_RANGE_PARSE.match(member)
+        if m:
+            return (m.group(1), m.group(2))
+        return (member, None)
+
+    def _expand(self, prs, rng, rsDir, asDir, routeDirs, visited):
+        """ Internal method. Do not use.
+        Add all prefixes of the route-set to the PrefixRangeSet.
+
+        :param PrefixRangeSet prs: Set to fill in
+        :param str rng: Range operator applied to the route-set or None
+        :param HashObjectDir rsDir: HashObjectDir that contains RouteSetObjects
+        :param HashObjectDir asDir: HashObjectDir that contains AsSetObjects
+        :param routeDirs: Tuple (RouteObjectDir, Route6ObjectDir)
+        :param visited: Set of (route-set key, range) traversed because of recursion
+        """
+
+        if (self.getKey(), rng) in visited:
+            return
+        visited.add((self.getKey(), rng))
+
+        # members: can hold only IPv4 prefixes, mp-members: IPv4 and IPv6
+        for (members, rdirs) in ((self.members, routeDirs[:1]), (self.mp_members, routeDirs)):
+            for m in members:
+                if AutNumRule.isPfx(m):
+                    AutNumRule.addPfxRange(prs, m, rng)
+                    continue
+
+                (name, r)=RouteSetObject._splitRange(m)
+                r=(r if r else rng)
+                if RouteSetObject.isRouteSet(name):
+                    if name in rsDir.table:
+                        rsDir.table[name]._expand(prs, r, rsDir, asDir, routeDirs, visited)
+
+                else:
+                    origins=[]
+                    if AutNumRule.isASN(name):
+                        origins=[name]
+                    elif AsSetObject.isAsSet(name) and name in asDir.table:
+                        aso=asDir.table[name]
+                        aso._ensureFlat(asDir)
+                        origins=['AS%d'%a for a in (aso.flat_asns or [])]
+
+                    # resolve through route objects with the origin
+                    for o in origins:
+                        for rd in rdirs:
+                            for ro in rd.originTable.get(o, []):
+                                AutNumRule.addPfxRange(prs, ro.route, r)
+
+    @staticmethod
+    def expandDirectory(rsDir, asDir, routeDir, route6Dir):
+        """ Expand all route-sets in the directory to PrefixRangeSet (stored
+        in prefixes attribute of each RouteSetObject). Expansion covers nested
+        route-sets, ASN and as-set members (resolved through route objects with
+        the origins) and range operators. Member-of back-references from route
+        objects has to be added to the members before.
+
+        :param HashObjectDir rsDir: HashObjectDir that contains RouteSetObjects
+        :param HashObjectDir asDir: HashObjectDir that contains AsSetObjects
+        :param RouteObjectDir routeDir: Route objects
+        :param RouteObjectDir route6Dir: Route6 objects
+        """
+
+        for k in rsDir.table.keys():
+            prs=PrefixRangeSet()
+            rsDir.table[k]._expand(prs, None, rsDir, asDir, (routeDir, route6Dir), set())
+            prs.compact()
+            rsDir.table[k].prefixes=prs
+
     def getKey(self):
         """
         :returns: Key of the FilterSet object.
@@ -1518,6 +2978,14 @@ class RouteSetObject(RpslObject):
         
         return self.route_set
 
+    def dayCopy(self):
+        """ See RpslObject.dayCopy() """
+        o=copy.copy(self)
+        o.members=list(self.members)
+        o.mp_members=list(self.mp_members)
+        o.prefixes=None
+        return o
+
     def __str__(self):
         """
         :returns: Text representation of the object.
@@ -1534,15 +3002,22 @@ class HashObjectDir(object):
     table attribute, which is a hastable with keys that uses getKey() of the objects
     to index them.
     """
-    def __init__(self, filename, objType):
+    def __init__(self, filename, objType, objs=None, table=None):
         """ Init the HashObjectDir from file
         
-        :param str filename: File to read
+        :param str filename: File to read or None to use objs or table
         :param objType: Object type what to construct as a hash directory member
+        :param objs: List of objects to use instead of parsing the file
+        :param table: Dict-like table to use instead of parsing the file \
+        (see LazyObjectTable)
         """
         
+        if table != None:
+            self.table=table
+            return
+
         self.table={}
-        for o in RpslObject.parseRipeFile(filename, objType):
+        for o in (RpslObject.parseRipeFile(filename, objType) if filename != None else (objs or [])):
             self.table[o.getKey()]=o
 
 
@@ -1568,6 +3043,14 @@ def ripe_route6_pickle(day):
     """
     return common.resultdir(day)+RIPE_DB_ROUTE6_PICKLE
 
+def ripe_fingerprint_pickle(day):
+    """ Construct file name
+
+    :param day: Day obj
+    :returns: string, pickle file name corresponding to the day
+    """
+    return common.resultdir(day)+RIPE_DB_FINGERPRINT_PICKLE
+
 def ripe_autnum_pickle(day):
     """ Construct file name
 
@@ -1625,6 +3108,731 @@ def decode_ripe_tgz_filename(filename):
 
 
 
+# RIPE DB snapshots
+#
+# RPSL objects are kept in a content-addressed store (see RpslObjectStore)
+# under the hash of their normalized text. Each day has a manifest per
+# class that maps object keys to store entries (hash, pack), where pack
+# is named after the day that introduced the object to the store. Hash
+# index of each class maps every hash in the store to (key, pack), so an
+# object is parsed and written once no matter which day meets it first.
+#
+# Manifests are stored as a chain of per-day snapshots: a keyframe holds
+# the whole manifest of a class, a delta holds entries added, removed and
+# modified since the base day. Keyframe is written every
+# RIPE_SNAPSHOT_KEYFRAME_INTERVAL days in the chain. References among
+# objects (member-of, as-set closures, route-set expansion) are resolved
+# by finalize_ripe_dirs() after loading.
+
+RPSL_STORE_DIR='/rpslstore'
+RPSL_STORE_PACK='/%s.%s.pack'
+RPSL_STORE_INDEX='/%s.%s.idx.pickle'
+RPSL_STORE_HASHES='/%s.hashes.pickle'
+RPSL_LAZY_CLASSES=['aut-num'] # classes loaded by LazyObjectTable when requested
+RPSL_LAZY_TABLE_LIMIT=10000 # max. number of objects held by LazyObjectTable
+RIPE_SNAPSHOT_PICKLE='/ripe.snapshot.pickle'
+RIPE_SNAPSHOT_CLASS_PICKLE='/ripe.snapshot.%s.pickle'
+RIPE_SNAPSHOT_KEYFRAME_INTERVAL=30
+
+# Packs hold pickled clean lines of objects one after another, the index of
+# a pack maps object hash to (offset, length, member-of list), the member-of
+# list is kept for aut-num objects only (see finalize_ripe_dirs()).
+
+# class -> (RIPE DB file, object type)
+RIPE_CLASSES={
+    'route': (RIPE_DB_ROUTE, RouteObject),
+    'route6': (RIPE_DB_ROUTE6, Route6Object),
+    'aut-num': (RIPE_DB_AUTNUM, AutNumObject),
+    'as-set': (RIPE_DB_ASSET, AsSetObject),
+    'filter-set': (RIPE_DB_FILTERSET, FilterSetObject),
+    'route-set': (RIPE_DB_ROUTESET, RouteSetObject),
+    'peering-set': (RIPE_DB_PEERINGSET, PeeringSetObject),
+    }
+
+# class -> classes needed to finalize it
+RIPE_CLASS_DEPS={
+    'as-set': ['aut-num'],
+    'route-set': ['route', 'route6', 'as-set', 'aut-num'],
+    }
+
+def ripe_snapshot_pickle(day):
+    """ Construct file name
+
+    :param day: Day obj
+    :returns: string, pickle file name corresponding to the day
+    """
+    return common.resultdir(day)+RIPE_SNAPSHOT_PICKLE
+
+def ripe_snapshot_class_pickle(day, cls):
+    """ Construct file name
+
+    :param day: Day obj
+    :param str cls: RPSL class (see RIPE_CLASSES)
+    :returns: string, pickle file name corresponding to the day and class
+    """
+    return common.resultdir(day)+(RIPE_SNAPSHOT_CLASS_PICKLE%cls)
+
+def rpsl_store_pack(cls, pack):
+    """ Construct file name
+
+    :param str cls: RPSL class (see RIPE_CLASSES)
+    :param pack: Day obj or its string that introduced the objects
+    :returns: string, file name of the pack in the object store
+    """
+    d=common.resultdir()+RPSL_STORE_DIR
+    common.checkcreatedir(d)
+    return d+(RPSL_STORE_PACK%(cls, str(pack)))
+
+def rpsl_store_index(cls, pack):
+    """ Construct file name
+
+    :param str cls: RPSL class (see RIPE_CLASSES)
+    :param pack: Day obj or its string that introduced the objects
+    :returns: string, pickle file name of the pack index in the object store
+    """
+    d=common.resultdir()+RPSL_STORE_DIR
+    common.checkcreatedir(d)
+    return d+(RPSL_STORE_INDEX%(cls, str(pack)))
+
+def rpsl_store_hashes(cls):
+    """ Construct file name
+
+    :param str cls: RPSL class (see RIPE_CLASSES)
+    :returns: string, pickle file name of the hash index of the class
+    """
+    d=common.resultdir()+RPSL_STORE_DIR
+    common.checkcreatedir(d)
+    return d+(RPSL_STORE_HASHES%cls)
+
+def rpsl_store_packs(cls):
+    """
+    :param str cls: RPSL class (see RIPE_CLASSES)
+    :returns: sorted list of names of complete packs of the class
+    """
+    d=common.resultdir()+RPSL_STORE_DIR
+    common.checkcreatedir(d)
+    # see RPSL_STORE_INDEX
+    prefix=cls+'.'
+    suffix='.idx.pickle'
+    return sorted([f[len(prefix):-len(suffix)] for f in os.listdir(d)
+                   if f.startswith(prefix) and f.endswith(suffix)])
+
+def ripe_legacy_pickle(day, cls):
+    """ Construct file name of the full pickle of a class (created by older
+    versions of module_prepare_day()).
+
+    :param day: Day obj
+    :param str cls: RPSL class (see RIPE_CLASSES)
+    :returns: string, pickle file name corresponding to the day and class
+    """
+    return {'route': ripe_route_pickle, 'route6': ripe_route6_pickle, 'aut-num': ripe_autnum_pickle,
+            'as-set': ripe_asset_pickle, 'filter-set': ripe_filterset_pickle,
+            'route-set': ripe_routeset_pickle, 'peering-set': ripe_peeringset_pickle}[cls](day)
+
+
+def ripe_dir_objects(d, cls=None):
+    """ Get objects of a directory indexed by a unique key.
+
+    :param d: HashObjectDir, RouteObjectDir or name of a RIPE DB file
+    :param str cls: RPSL class (see RIPE_CLASSES), needed only for file names
+    :returns: dict key -> object, key of route objects is (route, origin)
+    """
+    if isinstance(d, str):
+        objs=RpslObject.parseRipeFile(d, RIPE_CLASSES[cls][1])
+    elif isinstance(d, RouteObjectDir):
+        objs=d.enumerateObjs()
+    else:
+        return dict(d.table)
+
+    res={}
+    for o in objs:
+        res[ripe_object_key(o)]=o
+    return res
+
+
+def ripe_object_key(o):
+    """
+    :param RpslObject o: Object to get key of
+    :returns: Unique key of the object within its class, key of route \
+    objects is (route, origin)
+    """
+    if isinstance(o, RouteObject):
+        return (o.route, o.origin)
+    return o.getKey()
+
+
+def ripe_dir_from_objects(cls, objs):
+    """ Create directory of the class out of objects.
+
+    :param str cls: RPSL class (see RIPE_CLASSES)
+    :param objs: dict key -> object (see ripe_dir_objects())
+    :returns: RouteObjectDir or HashObjectDir
+    """
+    if cls == 'route' or cls == 'route6':
+        return RouteObjectDir(None, cls == 'route6', [objs[k] for k in sorted(objs.keys())])
+    else:
+        return HashObjectDir(None, RIPE_CLASSES[cls][1], objs.values())
+
+
+def diff_ripe_objects(old, new, manifest=False):
+    """ Compare two versions of objects of a class.
+
+    :param old: dict key -> object of the older day (see ripe_dir_objects())
+    :param new: dict key -> object of the newer day
+    :param bool manifest: old and new are manifests (see store_ripe_objects())
+    :returns: (added, removed, modified), added and modified are dicts \
+    key -> new object, removed is a list of keys
+    """
+    added={}
+    modified={}
+    for (k, o) in new.iteritems():
+        if not k in old:
+            added[k]=o
+        elif (old[k] != o if manifest else old[k].text != o.text):
+            modified[k]=o
+    removed=[k for k in old if not k in new]
+    return (added, removed, modified)
+
+
+def diff_ripe_dirs(old_dirs, new_dirs):
+    """ Compare two days of parsed RIPE DB.
+
+    :param old_dirs: dict class -> directory or RIPE DB file name of the older day
+    :param new_dirs: dict class -> directory or RIPE DB file name of the newer day
+    :returns: dict class -> (added, removed, modified), see diff_ripe_objects()
+    """
+    res={}
+    for cls in new_dirs:
+        if cls in old_dirs:
+            res[cls]=diff_ripe_objects(ripe_dir_objects(old_dirs[cls], cls),
+                                       ripe_dir_objects(new_dirs[cls], cls))
+    return res
+
+
+def parse_ripe_dirs(dirname):
+    """ Parse unpacked RIPE DB snapshot.
+
+    :param str dirname: Directory with RIPE DB split files
+    :returns: dict class -> RouteObjectDir or HashObjectDir
+    :raises Exception: When a file is missing
+    """
+    dirs={}
+    for cls in ('route', 'route6', 'aut-num', 'as-set', 'filter-set', 'route-set', 'peering-set'):
+        fn=dirname+RIPE_CLASSES[cls][0]
+        common.d("Parsing", fn)
+        if not os.path.isfile(fn):
+            raise Exception("Missing file "+fn)
+        if cls == 'route' or cls == 'route6':
+            dirs[cls]=RouteObjectDir(fn, cls == 'route6')
+        else:
+            dirs[cls]=HashObjectDir(fn, RIPE_CLASSES[cls][1])
+    return dirs
+
+
+def finalize_ripe_dirs(dirs):
+    """ Resolve references among parsed objects: add members from member-of
+    attributes, compute as-set closures and expand route-sets.
+    Only the steps whose inputs are present in dirs are done.
+
+    :param dirs: dict class -> directory, it is modified in place
+    """
+    if 'as-set' in dirs and 'aut-num' in dirs:
+        ass=dirs['as-set']
+        ao=dirs['aut-num']
+        # lazy tables know member-of without loading objects
+        memberof=getattr(ao.table, 'memberof', None)
+        # Add members from members-of in aut-num
+        for aok in ao.table.keys():
+            for m in (memberof[aok] if memberof != None else ao.table[aok].memberof_list):
+                if m in ass.table:
+                    ass.table[m].members.append(aok)
+                else:
+                    common.w("Can not append memeber-of ", m, 'from', aok, 'because as-set not found!')
+        # Precompute transitive closures of the as-sets
+        AsSetObject.flattenDirectory(ass)
+
+    if 'route-set' in dirs and 'route' in dirs and 'route6' in dirs and 'as-set' in dirs:
+        rs=dirs['route-set']
+        # Add members from members-of in route objects
+        for r in dirs['route'].enumerateObjs():
+            for m in r.memberof:
+                if m in rs.table:
+                    rs.table[m].members.append(r.getKey())
+                else:
+                    common.w("Can not find route-set for member-of", m, "in route", r.getKey())
+
+        # Add members from members-of in route6 objects
+        for r in dirs['route6'].enumerateObjs():
+            for m in r.memberof:
+                if m in rs.table:
+                    rs.table[m].mp_members.append(r.getKey())
+                else:
+                    common.w("Can not find route-set for member-of", m, "in", r.getKey())
+
+        # Expand route-sets to prefix ranges
+        RouteSetObject.expandDirectory(rs, dirs['as-set'], dirs['route'], dirs['route6'])
+
+
+class RpslObjectStore(object):
+    """ Content-addressed store of RPSL objects. Normalized text of objects
+    is kept in packs on disk (see rpsl_store_pack()), parsed objects of the
+    last loaded manifest of each class are kept in memory, so that an object
+    that does not change over many days is read and parsed once per process.
+    """
+
+    def __init__(self):
+        self.objects={} # class -> hash -> parsed object
+        self.indexes={} # (class, pack) -> pack index
+        self.parsed=0
+        self.reused=0
+
+    @staticmethod
+    def getHash(lines):
+        """
+        :param lines: Clean lines of the object (see RpslObject.splitRipeFile())
+        :returns: str, hash of the object text
+        """
+        return hashlib.md5(''.join(lines)).digest()
+
+    def addObject(self, cls, h, lines):
+        """ Parse a new object and keep it for the next getObjects().
+
+        :param str cls: RPSL class (see RIPE_CLASSES)
+        :param str h: Hash of the object, see getHash()
+        :param lines: Clean lines of the object
+        :returns: Parsed object, it must not be modified (see getObjects())
+        """
+        o=RIPE_CLASSES[cls][1](lines)
+        self.objects.setdefault(cls, {})[h]=o
+        self.parsed+=1
+        return o
+
+    def getIndex(self, cls, pack):
+        """
+        :param str cls: RPSL class (see RIPE_CLASSES)
+        :param str pack: Pack name
+        :returns: dict hash -> (offset, length, member-of list or None)
+        """
+        if not (cls, pack) in self.indexes:
+            self.indexes[(cls, pack)]=common.load_pickle(rpsl_store_index(cls, pack))
+        return self.indexes[(cls, pack)]
+
+    def readText(self, cls, h, pack):
+        """ Read one object from a pack.
+
+        :param str cls: RPSL class (see RIPE_CLASSES)
+        :param str h: Hash of the object
+        :param str pack: Pack name
+        :returns: Clean lines of the object
+        """
+        (offset, length, memberof)=self.getIndex(cls, pack)[h]
+        with open(rpsl_store_pack(cls, pack), 'rb') as f:
+            f.seek(offset)
+            return cPickle.loads(f.read(length))
+
+    @staticmethod
+    def writePack(cls, pack, objs):
+        """ Write new objects to a pack.
+
+        :param str cls: RPSL class (see RIPE_CLASSES)
+        :param str pack: Pack name
+        :param objs: dict hash -> (lines, parsed object)
+        """
+        idx={}
+        with open(rpsl_store_pack(cls, pack), 'wb') as f:
+            for (h, (lines, o)) in objs.iteritems():
+                data=cPickle.dumps(lines, cPickle.HIGHEST_PROTOCOL)
+                idx[h]=(f.tell(), len(data), getattr(o, 'memberof_list', None))
+                f.write(data)
+        # the index is written the last, it marks complete pack
+        common.save_pickle(idx, rpsl_store_index(cls, pack))
+
+    @staticmethod
+    def updateHashes(cls, pack=None, keys=None):
+        """ Get hash index of the class (see rpsl_store_hashes()). Complete
+        packs that the saved index does not cover (written by concurrent
+        processes or by older versions) are read and their objects parsed
+        to get the keys. The index is saved atomically when it changes.
+
+        :param str cls: RPSL class (see RIPE_CLASSES)
+        :param str pack: Pack just written by the caller or None
+        :param keys: dict hash -> key of objects in the pack or None
+        :returns: dict hash -> (key, pack)
+        """
+        fn=rpsl_store_hashes(cls)
+        if os.path.isfile(fn):
+            (packs, hashes)=common.load_pickle(fn)
+        else:
+            (packs, hashes)=(set(), {})
+
+        changed=False
+        if pack and not pack in packs:
+            for (h, k) in keys.iteritems():
+                hashes.setdefault(h, (k, pack))
+            packs.add(pack)
+            changed=True
+
+        for p in rpsl_store_packs(cls):
+            if p in packs:
+                continue
+            common.d("RPSL store: Indexing pack", cls, p)
+            idx=common.load_pickle(rpsl_store_index(cls, p))
+            with open(rpsl_store_pack(cls, p), 'rb') as f:
+                data=f.read()
+            for (h, (offset, length, memberof)) in idx.iteritems():
+                if not h in hashes:
+                    o=RIPE_CLASSES[cls][1](cPickle.loads(data[offset:offset+length]))
+                    hashes[h]=(ripe_object_key(o), p)
+            del data
+            packs.add(p)
+            changed=True
+
+        if changed:
+            tmp='%s.%d.tmp'%(fn, os.getpid())
+            common.save_pickle((packs, hashes), tmp)
+            os.rename(tmp, fn)
+        return hashes
+
+    def getObjects(self, cls, manifest):
+        """ Get objects listed in the manifest. Objects missing in memory
+        are read from packs and parsed. Objects not listed in the manifest
+        are dropped from memory.
+
+        :param str cls: RPSL class (see RIPE_CLASSES)
+        :param manifest: dict key -> (hash, pack), see store_ripe_objects()
+        :returns: dict key -> object, objects are own copies for the day \
+        (see RpslObject.dayCopy())
+        """
+        cached=self.objects.get(cls, {})
+
+        missing={}
+        for (h, pack) in manifest.itervalues():
+            if not h in cached:
+                missing.setdefault(pack, set()).add(h)
+
+        for pack in sorted(missing.keys()):
+            idx=self.getIndex(cls, pack)
+            with open(rpsl_store_pack(cls, pack), 'rb') as f:
+                data=f.read()
+            for h in missing[pack]:
+                (offset, length, memberof)=idx[h]
+                cached[h]=RIPE_CLASSES[cls][1](cPickle.loads(data[offset:offset+length]))
+                self.parsed+=1
+            del data
+
+        self.reused+=len(manifest)-sum([len(m) for m in missing.values()])
+
+        res={}
+        objs={}
+        for (k, (h, pack)) in manifest.iteritems():
+            objs[h]=cached[h]
+            res[k]=cached[h].dayCopy()
+        self.objects[cls]=objs
+        return res
+
+    def getTable(self, cls, manifest, limit=RPSL_LAZY_TABLE_LIMIT):
+        """ Get objects listed in the manifest to be loaded on first access.
+        Objects of the class held in memory are dropped.
+
+        :param str cls: RPSL class (see RIPE_CLASSES)
+        :param manifest: dict key -> (hash, pack), see store_ripe_objects()
+        :param int limit: Max. number of objects to hold in memory
+        :returns: LazyObjectTable
+        """
+        self.objects.pop(cls, None)
+        return LazyObjectTable(self, cls, manifest, limit)
+
+    def __str__(self):
+        """
+        :returns: Text representation of the store statistics
+        """
+        return 'RpslObjectStore: parsed=%d reused=%d'%(self.parsed, self.reused)
+
+
+
+class LazyObjectTable(object):
+    """ Read-only replacement of HashObjectDir.table that loads objects from
+    RpslObjectStore on first access. At most limit objects are held, the least
+    recently used are dropped. A dropped object loses state computed on it
+    (e.g. rule index of aut-num) and it is parsed again when it is needed.
+    """
+
+    def __init__(self, store, cls, manifest, limit=RPSL_LAZY_TABLE_LIMIT):
+        """
+        :param RpslObjectStore store: Store to read objects from
+        :param str cls: RPSL class (see RIPE_CLASSES)
+        :param manifest: dict key -> (hash, pack), see store_ripe_objects()
+        :param int limit: Max. number of objects to hold in memory
+        """
+        self.store=store
+        self.cls=cls
+        self.manifest=manifest
+        self.limit=limit
+        self.cache=collections.OrderedDict()
+        self.hits=0
+        self.misses=0
+
+        # member-of lists from pack indexes, see finalize_ripe_dirs()
+        self.memberof={}
+        for (k, (h, pack)) in manifest.iteritems():
+            self.memberof[k]=store.getIndex(cls, pack)[h][2] or []
+
+    def __contains__(self, key):
+        return key in self.manifest
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def __iter__(self):
+        return self.manifest.iterkeys()
+
+    def __getitem__(self, key):
+        """ Get object by key, load it when it is not in memory.
+
+        :param key: Key of the object
+        :returns: RpslObject
+        :raises KeyError: When the object does not exist
+        """
+        if key in self.cache:
+            o=self.cache.pop(key)
+            self.cache[key]=o
+            self.hits+=1
+            return o
+
+        (h, pack)=self.manifest[key]
+        o=RIPE_CLASSES[self.cls][1](self.store.readText(self.cls, h, pack))
+        self.misses+=1
+        if len(self.cache) >= self.limit:
+            self.cache.popitem(last=False)
+        self.cache[key]=o
+        return o
+
+    def get(self, key, default=None):
+        if key in self.manifest:
+            return self[key]
+        return default
+
+    def keys(self):
+        return self.manifest.keys()
+
+    def iterkeys(self):
+        return self.manifest.iterkeys()
+
+    def itervalues(self):
+        for k in self.manifest.iterkeys():
+            yield self[k]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for k in self.manifest.iterkeys():
+            yield (k, self[k])
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __str__(self):
+        """
+        :returns: Text representation of the table statistics
+        """
+        return 'LazyObjectTable %s: objects=%d held=%d hits=%d misses=%d'%(self.cls,
+            len(self.manifest), len(self.cache), self.hits, self.misses)
+
+
+# process-wide object store
+_glob_rpsl_store=RpslObjectStore()
+
+
+def store_ripe_objects(day, dirname, prevmanifests=None):
+    """ Add objects of unpacked RIPE DB of the day to the object store.
+    Objects already in the store (see RpslObjectStore.updateHashes()) are
+    recognized by hash without parsing and the manifests point to the packs
+    that hold them, objects new to the store are written to a pack of the day.
+
+    :param Day day: Day of the RIPE DB
+    :param str dirname: Directory with RIPE DB split files
+    :param prevmanifests: dict class -> manifest of the previous day or None, \
+    entries of the previous day are preferred to keep deltas small
+    :returns: dict class -> manifest (dict key -> (hash, pack))
+    :raises Exception: When a file is missing
+    """
+    manifests={}
+    for cls in sorted(RIPE_CLASSES.keys()):
+        fn=dirname+RIPE_CLASSES[cls][0]
+        common.d("Storing", fn)
+        if not os.path.isfile(fn):
+            raise Exception("Missing file "+fn)
+
+        hashes=RpslObjectStore.updateHashes(cls)
+        known={}
+        for (k, e) in ((prevmanifests or {}).get(cls) or {}).iteritems():
+            known[e[0]]=(k, e)
+
+        # a pack of the day exists when the day is prepared again
+        name=str(day)
+        while os.path.isfile(rpsl_store_index(cls, name)):
+            name='%s-%d'%(day, int(name[len(str(day))+1:] or 0)+1)
+
+        manifest={}
+        pack={}
+        for lines in RpslObject.splitRipeFile(fn):
+            h=RpslObjectStore.getHash(lines)
+            if h in known:
+                (k, e)=known[h]
+            elif h in hashes:
+                (k, p)=hashes[h]
+                e=(h, p)
+            elif h in pack:
+                continue # duplicate object
+            else:
+                o=_glob_rpsl_store.addObject(cls, h, lines)
+                k=ripe_object_key(o)
+                e=(h, name)
+                pack[h]=(lines, o)
+            manifest[k]=e
+
+        if pack:
+            RpslObjectStore.writePack(cls, name, pack)
+            RpslObjectStore.updateHashes(cls, name, dict([(h, ripe_object_key(o)) for (h, (lines, o))
+                                                          in pack.iteritems()]))
+        common.d("RPSL store", cls, ": objects", len(manifest), "new", len(pack))
+        manifests[cls]=manifest
+    return manifests
+
+
+def ripe_snapshot_exists(day):
+    """
+    :param Day day: Day to check
+    :returns: True when complete snapshot of the day exists
+    """
+    return os.path.isfile(ripe_snapshot_pickle(day))
+
+
+def save_ripe_snapshot(day, manifests, prevday=None, prevmanifests=None):
+    """ Save manifests of the day as a delta against the previous day or
+    as a keyframe (when there is no previous snapshot or the chain of
+    deltas is too long).
+
+    :param Day day: Day to save
+    :param manifests: dict class -> manifest, see store_ripe_objects()
+    :param Day prevday: Previous day to compute delta against or None
+    :param prevmanifests: Manifests of prevday if they are at hand or None
+    """
+    base=None
+    depth=0
+    if prevday and ripe_snapshot_exists(prevday):
+        idx=common.load_pickle(ripe_snapshot_pickle(prevday))
+        if idx['depth']+1 < RIPE_SNAPSHOT_KEYFRAME_INTERVAL:
+            base=prevday
+            depth=idx['depth']+1
+
+    if base:
+        common.d("Saving RIPE DB delta for day", day, "against", base)
+        old=prevmanifests or materialize_ripe_manifests(base, manifests.keys())
+    else:
+        common.d("Saving RIPE DB keyframe for day", day)
+
+    for cls in manifests:
+        if base:
+            (added, removed, modified)=diff_ripe_objects(old[cls], manifests[cls], True)
+            common.d("RIPE DB delta", cls, ": added", len(added), "removed", len(removed),
+                     "modified", len(modified))
+            common.save_pickle(('D', added, removed, modified), ripe_snapshot_class_pickle(day, cls))
+        else:
+            common.save_pickle(('K', manifests[cls]), ripe_snapshot_class_pickle(day, cls))
+
+    # the index is saved the last and atomically, it marks complete snapshot
+    fn=ripe_snapshot_pickle(day)
+    common.save_pickle({'base': base, 'depth': depth, 'classes': sorted(manifests.keys())}, fn+'.tmp')
+    os.rename(fn+'.tmp', fn)
+
+
+def materialize_ripe_manifests(day, classes):
+    """ Reconstruct manifests of the day from snapshots by applying
+    deltas to the keyframe.
+
+    :param Day day: Day to reconstruct
+    :param classes: List of RPSL classes (see RIPE_CLASSES)
+    :returns: dict class -> manifest (dict key -> (hash, pack))
+    """
+    chain=[day]
+    while True:
+        idx=common.load_pickle(ripe_snapshot_pickle(chain[-1]))
+        if not idx['base']:
+            break
+        chain.append(idx['base'])
+
+    res={}
+    for cls in classes:
+        manifest=None
+        for d in reversed(chain):
+            snap=common.load_pickle(ripe_snapshot_class_pickle(d, cls))
+            if snap[0] == 'K':
+                manifest=snap[1]
+            else:
+                (added, removed, modified)=snap[1:]
+                for k in removed:
+                    manifest.pop(k, None)
+                manifest.update(added)
+                manifest.update(modified)
+        res[cls]=manifest
+    return res
+
+
+def load_ripe_dirs(day, classes, lazy=False):
+    """ Load directories of the day. Full pickles created by older versions
+    are used when they exist, otherwise the directories are built from
+    the object store according to the day manifests and finalized.
+
+    :param Day day: Day to load
+    :param classes: List of RPSL classes (see RIPE_CLASSES)
+    :param bool lazy: Load objects of RPSL_LAZY_CLASSES on first access \
+    (see LazyObjectTable)
+    :returns: dict class -> RouteObjectDir or HashObjectDir
+    :raises Exception: When the day has not been prepared
+    """
+    res={}
+    missing=[]
+    for cls in classes:
+        fn=ripe_legacy_pickle(day, cls)
+        if os.path.isfile(fn):
+            res[cls]=common.load_pickle(fn)
+        else:
+            missing.append(cls)
+
+    # route-sets of older versions are not expanded to prefixes
+    if 'route-set' in res:
+        deps=load_ripe_dirs(day, ['as-set', 'route', 'route6'])
+        RouteSetObject.expandDirectory(res['route-set'], deps['as-set'], deps['route'], deps['route6'])
+        del deps
+
+    if not missing:
+        return res
+
+    if not ripe_snapshot_exists(day):
+        raise Exception("RIPE DB for day "+str(day)+" has not been prepared")
+
+    needed=set(missing)
+    for cls in missing:
+        needed.update(RIPE_CLASS_DEPS.get(cls, []))
+
+    dirs={}
+    for (cls, manifest) in materialize_ripe_manifests(day, needed).iteritems():
+        if lazy and cls in RPSL_LAZY_CLASSES:
+            dirs[cls]=HashObjectDir(None, RIPE_CLASSES[cls][1],
+                                    table=_glob_rpsl_store.getTable(cls, manifest))
+        else:
+            dirs[cls]=ripe_dir_from_objects(cls, _glob_rpsl_store.getObjects(cls, manifest))
+    common.d("Loaded RIPE DB for day", day, ':', str(_glob_rpsl_store))
+    finalize_ripe_dirs(dirs)
+
+    for cls in missing:
+        res[cls]=dirs[cls]
+    return res
+
+
+
 # Route checking code
 
 def check_ripe_route(path_vector, iana_dir, ripe_routes):
@@ -1681,7 +3889,8 @@ def check_ripe_route(path_vector, iana_dir, ripe_routes):
 
 
 
-def check_ripe_routes(day, ianadir, host, ipv6=False, bestonly=True):
+def check_ripe_routes(day, ianadir, host, ipv6=False, bestonly=True, carry=None, riperoutes=None,
+                      bgpdump=None):
     """ Check routes from BGP dump against RIPE route objects. Ignore all routes
     from the BGP dump that are either from outside of the RIPE region or
     does not contain enough information to check their origin. The most
@@ -1694,6 +3903,9 @@ def check_ripe_routes(day, ianadir, host, ipv6=False, bestonly=True):
     :param str host: Host name to take BGP feed from
     :param bool ipv6: IPv6 flag
     :param bool bestonly: Process only the best routes
+    :param IncrementalState carry: Reuse still valid results of the previous day or None
+    :param RouteObjectDir riperoutes: Route objects of the day or None to load them
+    :param bgpdump: BGP path vectors to check or None to load the day BGP dump
     :returns: list of (prefix, as-path, routeObj or None, status) and \
     status might be 0=OK, 1=aggregate, 2=missing origin, 3=not match, \
     4=not found, 5=non-RIPE NCC
@@ -1702,17 +3914,22 @@ def check_ripe_routes(day, ianadir, host, ipv6=False, bestonly=True):
 
     res=[]
     
-    riperoutes=None
-    if ipv6:
-        riperoutes=common.load_pickle(ripe_route6_pickle(day))
-    else:
-        riperoutes=common.load_pickle(ripe_route_pickle(day))
+    if riperoutes == None:
+        cls=('route6' if ipv6 else 'route')
+        riperoutes=load_ripe_dirs(day, [cls])[cls]
 
-    bgpdump=common.load_pickle(bgp.bgpdump_pickle(day, host, ipv6))
+    if bgpdump == None:
+        bgpdump=common.load_pickle(bgp.bgpdump_pickle(day, host, ipv6))
     for path_vector in bgpdump:
         if bestonly and not (path_vector[0] and '>' in path_vector[0]):
             continue
 
+        if carry != None:
+            r=carry.getRoute(path_vector)
+            if r != None:
+                yield r
+                continue
+
         yield check_ripe_route(path_vector, ianadir, riperoutes)
 
 
@@ -1723,7 +3940,8 @@ RIPE_ROUTES_MATCH_LEGEND=['OK', 'no-search aggregate', 'origin missing', 'AS not
 def report_ripe_routes_day(route_list, day, outdir, ipv6=False):
     """ Generate text report for a day and return stats for further graphing.
 
-    :param route_list: list of tuples (prefix, as-path, routeObj or None, status)
+    :param route_list: iterable of tuples (prefix, as-path, routeObj or None, status), \
+    it is read once
     :param Day day: Day obj specifying the day to process
     :param str outdir: Directory path
     :param bool ipv6: IPv6 flag
@@ -1811,7 +4029,7 @@ def ripe_gen_route_timeline(violators, days, ipv6=False):
     for d in sorted(days):
         common.d("ripe_gen_route_timeline: Working on day %s"%str(d))
         bgp2routesfn=common.resultdir(d)+(RIPE_BGP2ROUTES6_PICKLE if ipv6 else RIPE_BGP2ROUTES4_PICKLE)
-        dayres=common.load_pickle(bgp2routesfn)
+        dayres=common.read_records(bgp2routesfn)
         # dayres contains list of tuples (prefix, as-path, routeObj or None, status)
 
         for rv in dayres:
@@ -1904,7 +4122,7 @@ def ripe_gen_route_timeline_files(violators, days, ipv6=False):
         
         common.d("ripe_gen_route_timeline: Working on day %s"%str(d))
         bgp2routesfn=common.resultdir(d)+(RIPE_BGP2ROUTES6_PICKLE if ipv6 else RIPE_BGP2ROUTES4_PICKLE)
-        dayres=common.load_pickle(bgp2routesfn)
+        dayres=common.read_records(bgp2routesfn)
         # dayres contains list of tuples (prefix, as-path, routeObj or None, status)
 
         for rv in dayres:
@@ -1932,22 +4150,127 @@ def ripe_gen_route_timeline_files(violators, days, ipv6=False):
 
 
 
-# Path checking code
+# Path checking code
+
+def normalize_aspath(text):
+    """ Internal fuction.
+
+    :param str text: AS path in text form
+    :returns: list of ASNs in AS path.
+    """
+    text = text.replace('{', '').replace('}', '')
+    asns = text.split()[:-1] # remove i or e or ? in the end of the string (= which means on
+    # the beginning of the AS path)
+    return ['AS'+asn.strip() for asn in asns]
+
+
+class PathStepCache(object):
+    """ Memo of check_ripe_path_step() verdicts for a day. Most hops are
+    decided by filters that do not look at the prefix (i.e. ASN, as-set,
+    AS-ANY or PeerAS), so the verdict is keyed by the hop (asn, previous AS,
+    next AS, AF) and the prefix and/or AS path only when the filters
+    of the hop depend on them.
+
+    The cache is valid only for one set of directories (=one day).
+    """
+
+    def __init__(self, limit=PATH_STEP_CACHE_LIMIT):
+        """
+        :param int limit: Max. number of cached verdicts
+        """
+        self.limit=limit
+        self.deps={} # (asn, previous_as, next_as, ipv6) -> FILTER_DEP_* flags
+        self.refs={} # (asn, previous_as, next_as, ipv6) -> referenced RPSL objects
+        self.verdicts={} # (hop, prefix, aspath key) -> status code
+        self.hits=0
+        self.misses=0
+
+    def getHopDeps(self, asn, previous_as, next_as, autnum_dir, asset_dir, routeset_dir,
+                   fltrset_dir, prngset_dir, ipv6=False):
+        """ Get dependence flags of the hop. See check_ripe_path_step() for
+        parameters.
+
+        :returns: Bitmask of FILTER_DEP_* flags
+        """
+        hop=(asn, previous_as, next_as, ipv6)
+        if hop in self.deps:
+            return self.deps[hop]
+
+        deps=0
+        if asn in autnum_dir.table:
+            autnum=autnum_dir.table[asn]
+            if autnum.status == AutNumObject.ASN_STATUS_ASSIGNED:
+                dirs=FilterDirs(asset_dir, fltrset_dir, routeset_dir, ipv6)
+                if previous_as != None and previous_as != asn:
+                    for r in autnum.getRules(previous_as, False, ipv6, asset_dir, prngset_dir):
+                        deps|=r.getFilterDeps(dirs)
+                if next_as != None and next_as != asn:
+                    for r in autnum.getRules(next_as, True, ipv6, asset_dir, prngset_dir):
+                        deps|=r.getFilterDeps(dirs)
+
+        self.deps[hop]=deps
+        return deps
+
+    def getHopRefs(self, asn, previous_as, next_as, autnum_dir, asset_dir, routeset_dir,
+                   fltrset_dir, prngset_dir, ipv6=False):
+        """ Get RPSL objects that the verdict of the hop might depend on.
+        See check_ripe_path_step() for parameters.
+
+        :returns: frozenset of (class, key) tuples, see FilterNode.getRefs()
+        """
+        hop=(asn, previous_as, next_as, ipv6)
+        if hop in self.refs:
+            return self.refs[hop]
+
+        refs=set([('aut-num', asn)])
+        if asn in autnum_dir.table:
+            autnum=autnum_dir.table[asn]
+            if autnum.status == AutNumObject.ASN_STATUS_ASSIGNED:
+                dirs=FilterDirs(asset_dir, fltrset_dir, routeset_dir, ipv6)
+                for (neighbor, export) in ((previous_as, False), (next_as, True)):
+                    if neighbor == None or neighbor == asn:
+                        continue
+                    refs.update(autnum.getSubjectRefs(export, ipv6))
+                    for r in autnum.getRules(neighbor, export, ipv6, asset_dir, prngset_dir):
+                        r.getFilterRefs(dirs, refs)
+
+        refs=frozenset(refs)
+        self.refs[hop]=refs
+        return refs
+
+    @staticmethod
+    def getPathKey(deps, aspath):
+        """
+        :param int deps: Dependence flags of the hop
+        :param aspath: AS path from the hop point of view
+        :returns: The part of AS path that the verdict depends on
+        """
+        if deps & FILTER_DEP_ASPATH:
+            return tuple(aspath)
+        elif deps & FILTER_DEP_ENDS:
+            return ((aspath[0], aspath[-1]) if aspath else ())
+        return None
+
+    def getHitRate(self):
+        """
+        :returns: Ratio of lookups answered from the cache (0.0 - 1.0)
+        """
+        total=self.hits+self.misses
+        return (float(self.hits)/total if total else 0.0)
 
-def normalize_aspath(text):
-    """ Internal fuction.
+    def __str__(self):
+        """ :returns: String representation with counters """
+        return 'PathStepCache: hits=%d misses=%d hitrate=%.3f hops=%d verdicts=%d'%(
+            self.hits, self.misses, self.getHitRate(), len(self.deps), len(self.verdicts))
 
-    :param str text: AS path in text form
-    :returns: list of ASNs in AS path.
-    """
-    text = text.replace('{', '').replace('}', '')
-    asns = text.split()[:-1] # remove i or e or ? in the end of the string (= which means on
-    # the beginning of the AS path)
-    return ['AS'+asn.strip() for asn in asns]
+    def __repr__(self):
+        """ :returns: String representation with counters """
+        return self.__str__()
 
 
 def check_ripe_path_step(pfx, asn, current_aspath, previous_as, next_as,
-                         autnum_dir, asset_dir, routeset_dir, fltrset_dir, prngset_dir, ipv6=False):
+                         autnum_dir, asset_dir, routeset_dir, fltrset_dir, prngset_dir, ipv6=False,
+                         cache=None):
     """ Check one step in as-path from BGP by means of resolving proper aut-num
     object for the asn and check filters based on prefix that is being checked
     and current_aspath.
@@ -1980,6 +4303,7 @@ def check_ripe_path_step(pfx, asn, current_aspath, previous_as, next_as,
     :param HashObjectDir routeset_dir: HashObjectDir with RouteSet objs.
     :param HashObjectDir fltrset_dir: HashObjectDir with FltrSet objs.
     :param HashObjectDir prngset_dir: HashObjectDir with PeeringSet objs.
+    :param PathStepCache cache: Memo of verdicts for the day or None
     :returns: Status code
 
     Status codes:
@@ -1995,6 +4319,23 @@ def check_ripe_path_step(pfx, asn, current_aspath, previous_as, next_as,
 
     #common.d('Checking path for', pfx, 'step from', previous_as, 'to', next_as, 'via', asn)
 
+    if cache != None:
+        deps=cache.getHopDeps(asn, previous_as, next_as, autnum_dir, asset_dir, routeset_dir,
+                              fltrset_dir, prngset_dir, ipv6)
+        key=((asn, previous_as, next_as, ipv6), (pfx if deps & FILTER_DEP_PREFIX else None),
+             PathStepCache.getPathKey(deps, current_aspath))
+        if key in cache.verdicts:
+            cache.hits+=1
+            return cache.verdicts[key]
+
+        cache.misses+=1
+        r=check_ripe_path_step(pfx, asn, current_aspath, previous_as, next_as, autnum_dir,
+                               asset_dir, routeset_dir, fltrset_dir, prngset_dir, ipv6)
+        if len(cache.verdicts) >= cache.limit:
+            cache.verdicts.clear()
+        cache.verdicts[key]=r
+        return r
+
     if asn in autnum_dir.table:
         autnum=autnum_dir.table[asn]
 
@@ -2011,17 +4352,7 @@ def check_ripe_path_step(pfx, asn, current_aspath, previous_as, next_as,
         elif asn == previous_as: # as-path prepend
             import_match = True
         else: # real transition from previous_as to asn (match import filter)
-            for ir in autnum.import_list:
-                m=ir.match(previous_as, pfx, current_aspath, asset_dir, fltrset_dir,
-                           routeset_dir, prngset_dir, ipv6)
-                if m == 0:
-                    import_match=True
-                    break
-                else:
-                    if m>3:
-                        status=m
-
-            for ir in autnum.mp_import_list:
+            for ir in autnum.getRules(previous_as, False, ipv6, asset_dir, prngset_dir):
                 m=ir.match(previous_as, pfx, current_aspath, asset_dir, fltrset_dir,
                            routeset_dir, prngset_dir, ipv6)
                 if m == 0:
@@ -2041,17 +4372,7 @@ def check_ripe_path_step(pfx, asn, current_aspath, previous_as, next_as,
         elif next_as == asn: # as-path prepend
             export_match=True
         else: # real transition from asn to next_as (match export filter)
-            for er in autnum.export_list:
-                m=er.match(next_as, pfx, current_aspath, asset_dir, fltrset_dir,
-                           routeset_dir, prngset_dir, ipv6)
-                if m == 0:
-                    export_match=True
-                    break
-                else:
-                    if m>3:
-                        status=m
-
-            for er in autnum.mp_export_list:
+            for er in autnum.getRules(next_as, True, ipv6, asset_dir, prngset_dir):
                 m=er.match(next_as, pfx, current_aspath, asset_dir, fltrset_dir,
                            routeset_dir, prngset_dir, ipv6)
                 if m == 0:
@@ -2073,8 +4394,25 @@ def check_ripe_path_step(pfx, asn, current_aspath, previous_as, next_as,
     
 
 
+def path_hops(aspath, myas=None):
+    """ Enumerate steps of the AS path as they are checked by check_ripe_path().
+
+    :param aspath: List of ASNs (see normalize_aspath())
+    :param myas: ASN of the observation point
+    :returns: Iterator of tuples (asn, previous_as, next_as, relative_aspath)
+    """
+    for i,asn in enumerate(aspath):
+        next_as = (aspath[i-1] if i>0 else myas)
+
+        previous_as = (aspath[i+1] if (i+1)<len(aspath) else None)
+
+        relative_aspath = aspath[i+1:] if (i+1)<len(aspath) else [aspath[-1]]
+
+        yield (asn, previous_as, next_as, relative_aspath)
+
+
 def check_ripe_path(path_vector, autnum_dir, asset_dir, routeset_dir, filterset_dir,
-                    prngset_dir, ipv6=False, myas=None):
+                    prngset_dir, ipv6=False, myas=None, cache=None):
     """ Chech path in path vector by means of resolving all aut-num
     object and filters along the as-path in the path_vector from BGP.
 
@@ -2092,6 +4430,7 @@ def check_ripe_path(path_vector, autnum_dir, asset_dir, routeset_dir, filterset_
     :param HashObjectDir prngset_dir: HashObjectDir with PeeringSet objs.
     :param bool ipv6: IPv6 flag
     :param myas: ASN of the observation point
+    :param PathStepCache cache: Memo of step verdicts for the day or None
     :returns: (path_vector, allinripe, status), path_vector is a tuple, allinripe is bool, \
     status is int
     """
@@ -2106,15 +4445,10 @@ def check_ripe_path(path_vector, autnum_dir, asset_dir, routeset_dir, filterset_
 
     #common.d('Checking path for ', str(path_vector))
     # go through as-path one by one AS and check routes
-    for i,asn in enumerate(aspath):
-        next_as = (aspath[i-1] if i>0 else myas)
-
-        previous_as = (aspath[i+1] if (i+1)<len(aspath) else None)
-
-        relative_aspath = aspath[i+1:] if (i+1)<len(aspath) else [aspath[-1]]
-
+    for (asn, previous_as, next_as, relative_aspath) in path_hops(aspath, myas):
         res = check_ripe_path_step(path_vector[1], asn, relative_aspath, previous_as, next_as,
-                                   autnum_dir, asset_dir, routeset_dir, filterset_dir, prngset_dir, ipv6)
+                                   autnum_dir, asset_dir, routeset_dir, filterset_dir, prngset_dir, ipv6,
+                                   cache)
         if res == 2: # means that the ASN is out of RIPE region
             allinripe = False
 
@@ -2130,7 +4464,22 @@ def check_ripe_path(path_vector, autnum_dir, asset_dir, routeset_dir, filterset_
     return (path_vector, allinripe, status)
 
 
-def check_ripe_paths(day, ianadir, host, ipv6=False, bestonly=True, myas=None, pfx_with_matching_route=None):
+def load_ripe_path_dirs(day, lazy=True):
+    """ Load directories needed by check_ripe_paths() and resolve references
+    among the sets once for the whole day.
+
+    :param Day day: Day to load
+    :param bool lazy: Load aut-num objects on first access (see load_ripe_dirs())
+    :returns: dict class -> HashObjectDir
+    """
+    dirs=load_ripe_dirs(day, ['as-set', 'aut-num', 'filter-set', 'route-set', 'peering-set'], lazy)
+    FilterSetObject.resolveDirectory(dirs['filter-set'])
+    PeeringSetObject.flattenDirectory(dirs['peering-set'])
+    return dirs
+
+
+def check_ripe_paths(day, ianadir, host, ipv6=False, bestonly=True, myas=None, pfx_with_matching_route=None,
+                     cache=None, carry=None, hoprefs=None, dirs=None, bgpdump=None):
     """ Check paths during their travel in the RIPE region.
 
     :param day: Day to match
@@ -2140,6 +4489,13 @@ def check_ripe_paths(day, ianadir, host, ipv6=False, bestonly=True, myas=None, p
     :param bool bestonly: Match only the best routes
     :param myas: ASN of the observation point
     :param pfx_with_matching_route: List of prefixes with matching routes
+    :param PathStepCache cache: Memo of step verdicts to use (new one is created \
+    when None), it holds hit-rate counters afterwards
+    :param IncrementalState carry: Reuse still valid results of the previous day or None
+    :param hoprefs: Dict to fill with RPSL objects that verdicts of the hops depend on \
+    ((asn, previous_as, next_as) -> frozenset of (class, key)) or None
+    :param dirs: Directories of the day (see load_ripe_path_dirs()) or None to load them
+    :param bgpdump: BGP path vectors to check or None to load the day BGP dump
     :returns: Iterator that returns (path_vector, whole_path_in_ripe, status, status_per_as) \
     where path_vector is BGP path vector from checked host table for the day, \
     whole_path_in_ripe indicates whether whole path is withing \
@@ -2181,13 +4537,20 @@ def check_ripe_paths(day, ianadir, host, ipv6=False, bestonly=True, myas=None, p
     #riperoutes=common.load_pickle(riperoutes_pkl)
     # Memory optimization. See further.
 
-    asset_dir = common.load_pickle(ripe_asset_pickle(day))
-    autnum_dir = common.load_pickle(ripe_autnum_pickle(day))
-    filterset_dir = common.load_pickle(ripe_filterset_pickle(day))
-    routeset_dir = common.load_pickle(ripe_routeset_pickle(day))
-    peeringset_dir = common.load_pickle(ripe_peeringset_pickle(day))
+    if dirs == None:
+        dirs = load_ripe_path_dirs(day)
+    asset_dir = dirs['as-set']
+    autnum_dir = dirs['aut-num']
+    filterset_dir = dirs['filter-set']
+    routeset_dir = dirs['route-set']
+    peeringset_dir = dirs['peering-set']
+    del dirs
 
-    bgpdump=common.load_pickle(bgp.bgpdump_pickle(day, host, ipv6))
+    if cache == None:
+        cache=PathStepCache()
+
+    if bgpdump == None:
+        bgpdump=common.load_pickle(bgp.bgpdump_pickle(day, host, ipv6))
 
     # Run the check for BGP data of the day
     count = 0
@@ -2202,8 +4565,21 @@ def check_ripe_paths(day, ianadir, host, ipv6=False, bestonly=True, myas=None, p
         #if rc[3] == 0 or rc[3] == 5: # if the route checks in RIPE DB or it is outside of RIPE region
         # memory optimization:
         if path_vector[1] in pfx_with_matching_route:
-            yield check_ripe_path(path_vector, autnum_dir, asset_dir, routeset_dir, filterset_dir,
-                                  peeringset_dir, ipv6, myas)
+            r=(carry.getPath(path_vector, myas) if carry != None else None)
+            if r == None:
+                r=check_ripe_path(path_vector, autnum_dir, asset_dir, routeset_dir, filterset_dir,
+                                  peeringset_dir, ipv6, myas, cache)
+
+            if hoprefs != None:
+                for (asn, previous_as, next_as, relative_aspath) in path_hops(normalize_aspath(path_vector[3]), myas):
+                    hop=(asn, previous_as, next_as)
+                    if not hop in hoprefs:
+                        if carry != None and carry.isHopUnchanged(hop):
+                            hoprefs[hop]=carry.hoprefs[hop]
+                        else:
+                            hoprefs[hop]=cache.getHopRefs(asn, previous_as, next_as, autnum_dir, asset_dir,
+                                                          routeset_dir, filterset_dir, peeringset_dir, ipv6)
+            yield r
         else:
 #            common.d("Origin does not match... No point in checking the path.", path_vector)
             status  = [(asn, 1) for asn in normalize_aspath(path_vector[3])] # 1=dunno
@@ -2212,6 +4588,46 @@ def check_ripe_paths(day, ianadir, host, ipv6=False, bestonly=True, myas=None, p
             # either local route or aggregate route generated in some remote location
             yield (path_vector, True, status)
 
+    common.d("Path step cache for day", day, ':', str(cache))
+    if isinstance(autnum_dir.table, LazyObjectTable):
+        common.d("Aut-num table for day", day, ':', str(autnum_dir.table))
+
+
+
+def check_ripe_day(day, ianadir, host, ipv6=False, myas=None, carry=None, hoprefs=None, riperoutes=None,
+                   dirs=None, bgpdump=None):
+    """ Check routes (see check_ripe_routes()) and paths (see
+    check_ripe_paths()) of the best routes in one pass over the BGP dump.
+    The path of a route is checked only when its origin matches a route
+    object or it is outside of the RIPE region, a prefix is expected to have
+    one best route.
+
+    :param day: Day obj specifying the day to process
+    :param IanaDirectory ianadir:
+    :param str host: Host name to take BGP feed from
+    :param bool ipv6: IPv6 flag
+    :param str myas: ASN of the host or None
+    :param IncrementalState carry: Reuse still valid results of the previous day or None
+    :param hoprefs: Dict to fill with RPSL objects that verdicts of the hops depend on \
+    (see check_ripe_paths()) or None
+    :param RouteObjectDir riperoutes: Route objects of the day or None to load them
+    :param dirs: Path checking directories (see load_ripe_path_dirs()) or None to load them
+    :param bgpdump: BGP path vectors to check or None to load the day BGP dump
+    :returns: Iterator that returns (route result, path result) for each best route
+    """
+    if bgpdump == None:
+        bgpdump=common.load_pickle(bgp.bgpdump_pickle(day, host, ipv6))
+
+    # the path check sees the verdict of the route it is checking right now
+    worthy=set()
+    routes=check_ripe_routes(day, ianadir, host, ipv6, True, carry, riperoutes, bgpdump)
+    paths=check_ripe_paths(day, ianadir, host, ipv6, True, myas, worthy, None, carry, hoprefs, dirs, bgpdump)
+    for r in routes:
+        worthy.clear()
+        if r[3] == 0 or r[3] == 5: # match or non-RIPE (=unknown)
+            worthy.add(r[0])
+        yield (r, paths.next())
+
 
 
 RIPE_PATHS_MATCH_LEGEND = ['Path verification OK', 'Uncheckable (non-RIPE/aggregate/...)', 'Path verification failed']
@@ -2220,7 +4636,7 @@ RIPE_PATHS_MATCH_DET_LEGEND = ['Hops OK', 'Hops UNKNOWN', 'Import NOT FOUND', 'E
 def report_ripe_paths_day(check_res, day, outdir, ipv6=False):
     """ Generate meaningful report of the check result.
 
-    :param check_res: Check result from the check_ripe_paths
+    :param check_res: Check result from the check_ripe_paths, it is read once
     :param Day day: Day to check and report
     :param str outdir: Output directory name
     :param bool ipv6: IPv6 flag
@@ -2454,22 +4870,278 @@ def report_ripe_paths_day(check_res, day, outdir, ipv6=False):
 
 
 
-def module_prepare_day(fn, d):
+# Incremental processing
+
+def _digest(*parts):
+    """ Internal function. Do not use.
+
+    :param parts: Values to hash (their repr() is hashed)
+    :returns: Binary MD5 digest
+    """
+    return hashlib.md5(repr(parts)).digest()
+
+
+def fingerprint_ripe_dirs(route_dir, route6_dir, autnum_dir, asset_dir, fltrset_dir,
+                          rtset_dir, prngset_dir):
+    """ Fingerprint RPSL objects of a day. Fingerprints of sets cover
+    the resolved content (closure of an as-set, expanded prefixes of
+    a route-set, ...), so a change in a nested object changes fingerprints
+    of all sets that include it.
+
+    :param RouteObjectDir route_dir: RouteObjectDir with route objs.
+    :param RouteObjectDir route6_dir: RouteObjectDir with route6 objs.
+    :param HashObjectDir autnum_dir: HashObjectDir with AutNum objs.
+    :param HashObjectDir asset_dir: HashObjectDir with AsSet objs.
+    :param HashObjectDir fltrset_dir: HashObjectDir with FltrSet objs.
+    :param HashObjectDir rtset_dir: HashObjectDir with RouteSet objs.
+    :param HashObjectDir prngset_dir: HashObjectDir with PeeringSet objs.
+    :returns: dict class -> dict key -> digest or None when route-sets \
+    are not expanded (see RouteSetObject.expandDirectory())
+
+    Classes are 'route' (key is common.prefix_to_int() of the prefix),
+    'aut-num', 'as-set', 'filter-set', 'route-set' and 'peering-set'.
+    """
+
+    for o in rtset_dir.table.values():
+        if getattr(o, 'prefixes', None) is None:
+            return None
+
+    routes={}
+    for rd in (route_dir, route6_dir):
+        origins={}
+        for o in rd.enumerateObjs():
+            try:
+                k=common.prefix_to_int(o.route)
+            except Exception:
+                common.w("Can not fingerprint route", o.route)
+                continue
+            if k in origins:
+                origins[k].append(o.origin)
+            else:
+                origins[k]=[o.origin]
+        for k in origins:
+            routes[k]=_digest(sorted(origins[k]))
+
+    AsSetObject.flattenDirectory(asset_dir)
+    PeeringSetObject.flattenDirectory(prngset_dir)
+
+    return {
+        'route': routes,
+        'aut-num': dict([(k, _digest(o.text)) for (k,o) in autnum_dir.table.iteritems()]),
+        'as-set': dict([(k, _digest(sorted(o.flat_asns))) for (k,o) in asset_dir.table.iteritems()]),
+        'filter-set': dict([(k, _digest(o.filter, o.mp_filter)) for (k,o) in fltrset_dir.table.iteritems()]),
+        'route-set': dict([(k, _digest(sorted(o.prefixes.ranges[False]), sorted(o.prefixes.ranges[True])))
+                           for (k,o) in rtset_dir.table.iteritems()]),
+        'peering-set': dict([(k, _digest(sorted(o.flat_peers[False]), sorted(o.flat_peers[True])))
+                             for (k,o) in prngset_dir.table.iteritems()]),
+        }
+
+
+def load_ripe_fingerprints(day):
+    """ Load fingerprints of RPSL objects of the day. Create them out of
+    the day RIPE DB snapshot or pickles when they are missing (days
+    prepared by older versions).
+
+    :param Day day: Day to load fingerprints for
+    :returns: Fingerprints (see fingerprint_ripe_dirs()) or None when not available
+    """
+
+    fn=ripe_fingerprint_pickle(day)
+    if os.path.isfile(fn):
+        return common.load_pickle(fn)
+
+    try:
+        dirs=load_ripe_dirs(day, ['route', 'route6', 'aut-num', 'as-set', 'filter-set',
+                                  'route-set', 'peering-set'])
+    except Exception as e:
+        common.w("Can not load RIPE DB for day", day, ':', str(e))
+        return None
+
+    common.d("Creating fingerprints for day", day)
+    fp=fingerprint_ripe_dirs(dirs['route'], dirs['route6'], dirs['aut-num'], dirs['as-set'],
+                             dirs['filter-set'], dirs['route-set'], dirs['peering-set'])
+    if fp != None:
+        common.save_pickle(fp, fn)
+    return fp
+
+
+class IncrementalState(object):
+    """ Results of the previous day together with fingerprints of RPSL
+    objects of both days. It decides which verdicts of the previous day
+    are still valid: the verdict is carried forward when the BGP row
+    (prefix and AS path) is the same and none of the RPSL objects it
+    depends on has changed.
+
+    Results of the previous day are streamed once and only a compact index
+    of verdicts is kept: the hash of the BGP row (see getKey()) mapped to
+    the route status or to the path statuses. Route verdicts that refer to
+    route objects are not kept, such routes are checked again.
+    """
+
+    def __init__(self, prev_routes, prev_paths, prev_hoprefs, prev_fp, cur_fp):
+        """
+        :param prev_routes: Results of check_ripe_routes() for the previous day
+        :param prev_paths: Results of check_ripe_paths() for the previous day
+        :param prev_hoprefs: Hop references recorded by check_ripe_paths() for the previous day
+        :param prev_fp: Fingerprints of the previous day (see fingerprint_ripe_dirs())
+        :param cur_fp: Fingerprints of the current day
+        """
+        self.routes={}
+        self.worthy=set()
+        for r in prev_routes:
+            if r[2] == None:
+                self.routes[IncrementalState.getKey(r[0], r[1])]=r[3]
+            if r[3] == 0 or r[3] == 5:
+                self.worthy.add(r[0])
+
+        # paths of other prefixes are not carried (see getPath())
+        self.paths={}
+        statuses={}
+        for p in prev_paths:
+            if p[0][1] in self.worthy:
+                self.paths[IncrementalState.getKey(p[0][1], p[0][3])]=(p[1], tuple([statuses.setdefault(s, s)
+                                                                                     for s in p[2]]))
+
+        self.hoprefs=prev_hoprefs
+        self.prev_fp=prev_fp
+        self.cur_fp=cur_fp
+        self.changed={}
+
+        self.routes_carried=0
+        self.routes_recomputed=0
+        self.paths_carried=0
+        self.paths_recomputed=0
+
+    @staticmethod
+    def load(prevday, day, ipv6):
+        """ Load state for processing the day incrementally.
+
+        :param Day prevday: Previous processed day
+        :param Day day: Day to process
+        :param bool ipv6: IPv6 flag
+        :returns: IncrementalState or None when the previous day results \
+        or fingerprints are not available
+        """
+        bgp2routesfn=common.resultdir(prevday)+(RIPE_BGP2ROUTES6_PICKLE if ipv6 else RIPE_BGP2ROUTES4_PICKLE)
+        bgp2pathsfn=common.resultdir(prevday)+(RIPE_BGP2PATHS6_PICKLE if ipv6 else RIPE_BGP2PATHS4_PICKLE)
+        hoprefsfn=common.resultdir(prevday)+(RIPE_BGP2PATHS6_HOPREFS_PICKLE if ipv6 else RIPE_BGP2PATHS4_HOPREFS_PICKLE)
+        for fn in (bgp2routesfn, bgp2pathsfn, hoprefsfn):
+            if not os.path.isfile(fn):
+                common.d("Incremental check not possible, missing", fn)
+                return None
+
+        prev_fp=load_ripe_fingerprints(prevday)
+        cur_fp=load_ripe_fingerprints(day)
+        if prev_fp == None or cur_fp == None:
+            common.d("Incremental check not possible, missing fingerprints for", prevday, 'or', day)
+            return None
+
+        return IncrementalState(common.read_records(bgp2routesfn), common.read_records(bgp2pathsfn),
+                                common.load_pickle(hoprefsfn), prev_fp, cur_fp)
+
+    @staticmethod
+    def getKey(prefix, aspath):
+        """
+        :param str prefix: Prefix of the BGP row
+        :param str aspath: AS path of the BGP row
+        :returns: str, hash of the BGP row
+        """
+        return hashlib.md5(prefix+' '+aspath).digest()
+
+    def isChanged(self, ref):
+        """
+        :param ref: Tuple (class, key), see fingerprint_ripe_dirs()
+        :returns: True when the object differs between the days
+        """
+        if ref in self.changed:
+            return self.changed[ref]
+
+        (cls, key)=ref
+        c=(self.prev_fp[cls].get(key) != self.cur_fp[cls].get(key))
+        self.changed[ref]=c
+        return c
+
+    def isHopUnchanged(self, hop):
+        """
+        :param hop: Tuple (asn, previous_as, next_as)
+        :returns: True when the hop has been checked the previous day and \
+        none of the objects its verdict depends on has changed
+        """
+        refs=self.hoprefs.get(hop)
+        if refs == None:
+            return False
+        for r in refs:
+            if self.isChanged(r):
+                return False
+        return True
+
+    def getRoute(self, path_vector):
+        """ Get route check result of the previous day if it is still valid.
+
+        :param path_vector: Path vector to check
+        :returns: Result of check_ripe_route() or None
+        """
+        status=self.routes.get(IncrementalState.getKey(path_vector[1], path_vector[3]))
+        if status != None:
+            try:
+                if not self.isChanged(('route', common.prefix_to_int(path_vector[1]))):
+                    self.routes_carried+=1
+                    return (path_vector[1], path_vector[3], None, status)
+            except Exception:
+                pass
+        self.routes_recomputed+=1
+        return None
+
+    def getPath(self, path_vector, myas=None):
+        """ Get path check result of the previous day if it is still valid.
+        The caller has to make sure that the prefix passed the route check.
+
+        :param path_vector: Path vector to check
+        :param myas: ASN of the observation point
+        :returns: Result of check_ripe_path() or None
+        """
+        p=self.paths.get(IncrementalState.getKey(path_vector[1], path_vector[3]))
+        if p != None:
+            for (asn, previous_as, next_as, relative_aspath) in path_hops(normalize_aspath(path_vector[3]), myas):
+                if not self.isHopUnchanged((asn, previous_as, next_as)):
+                    break
+            else:
+                self.paths_carried+=1
+                return (path_vector, p[0], list(p[1]))
+        self.paths_recomputed+=1
+        return None
+
+    def __str__(self):
+        """ :returns: String representation with counters """
+        return ('IncrementalState: routes carried=%d recomputed=%d, paths carried=%d recomputed=%d, changed objs=%d'%(
+            self.routes_carried, self.routes_recomputed, self.paths_carried, self.paths_recomputed,
+            len([r for r in self.changed if self.changed[r]])))
+
+
+
+def module_prepare_day(fn, d, prevd=None):
     """ Prepare datastructures for RPS module for a day.
 
+    New objects are added to the object store (see store_ripe_objects())
+    and the day manifests are saved as a snapshot (see save_ripe_snapshot()),
+    a delta against the previous day when prevd has been prepared already.
+    Objects already in the store are not parsed again.
+
     :param str fn: Filename of the daily RIPE archive
     :param Day d: Day object that represent the day to check and report
+    :param Day prevd: Previous day or None
     :raises Exception: When various I/O errors happen
     """
     
     # skip parsed days (enumerate all needed results in condition)
-    if (os.path.isfile(ripe_route_pickle(d)) and
-        os.path.isfile(ripe_route6_pickle(d)) and
-        os.path.isfile(ripe_autnum_pickle(d)) and
-        os.path.isfile(ripe_asset_pickle(d)) and
-        os.path.isfile(ripe_filterset_pickle(d)) and
-        os.path.isfile(ripe_routeset_pickle(d)) and
-        os.path.isfile(ripe_peeringset_pickle(d))):
+    if (ripe_snapshot_exists(d) or
+        (os.path.isfile(ripe_route_pickle(d)) and
+         os.path.isfile(ripe_route6_pickle(d)) and
+         os.path.isfile(ripe_autnum_pickle(d)) and
+         os.path.isfile(ripe_asset_pickle(d)) and
+         os.path.isfile(ripe_filterset_pickle(d)) and
+         os.path.isfile(ripe_routeset_pickle(d)) and
+         os.path.isfile(ripe_peeringset_pickle(d)))):
         common.d("RPSL preprocess: Skipping dir", d, "because we have all needed results.")
         return
 
@@ -2477,88 +5149,22 @@ def module_prepare_day(fn, d):
     tmpdir=common.unpack_ripe_file(fn)
     common.d("Resulting dir:", tmpdir)
     try:
-        # ripe.db.route
-        ros=None
-        common.d("Parsing", tmpdir+RIPE_DB_ROUTE)
-        if os.path.isfile(tmpdir+RIPE_DB_ROUTE):
-            ros=RouteObjectDir(tmpdir+RIPE_DB_ROUTE, False)
-            common.save_pickle(ros, ripe_route_pickle(d))
-        else:
-            raise Exception("Missing file "+tmpdir+RIPE_DB_ROUTE)
-
-        # ripe.db.route6
-        ros6=None
-        common.d("Parsing", tmpdir+RIPE_DB_ROUTE6)
-        if os.path.isfile(tmpdir+RIPE_DB_ROUTE6):
-            ros6=RouteObjectDir(tmpdir+RIPE_DB_ROUTE6, True)
-            common.save_pickle(ros6, ripe_route6_pickle(d))
-        else:
-            raise Exception("Missing file "+tmpdir+RIPE6_DB_ROUTE)
-                    
-        # ripe.db.aut-num
-        ao=None
-        common.d("Parsing", tmpdir+RIPE_DB_AUTNUM)
-        if os.path.isfile(tmpdir+RIPE_DB_AUTNUM):
-            ao=HashObjectDir(tmpdir+RIPE_DB_AUTNUM, AutNumObject)
-            common.save_pickle(ao, ripe_autnum_pickle(d))
-        else:
-            raise Exception("Missing file "+tmpdir+RIPE_DB_AUTNUM)
-
-        # ripe.db.as-set
-        common.d("Parsing", tmpdir+RIPE_DB_ASSET)
-        if os.path.isfile(tmpdir+RIPE_DB_ASSET):
-            ass=HashObjectDir(tmpdir+RIPE_DB_ASSET, AsSetObject)
-            # Add members from members-of in aut-num
-            for aok in ao.table.keys():
-                for m in ao.table[aok].memberof_list:
-                    if m in ass.table:
-                        ass.table[m].members.append(aok)
-                    else:
-                        common.w("Can not append memeber-of ", m, 'from', aok, 'because as-set not found!')
-            common.save_pickle(ass, ripe_asset_pickle(d))
-        else:
-            raise Exception("Missing file "+tmpdir+RIPE_DB_ASSET)
-
-        # ripe.db.filter-set
-        common.d("Parsing", tmpdir+RIPE_DB_FILTERSET)
-        if os.path.isfile(tmpdir+RIPE_DB_FILTERSET):
-            fs=HashObjectDir(tmpdir+RIPE_DB_FILTERSET, FilterSetObject)
-            common.save_pickle(fs, ripe_filterset_pickle(d))
-        else:
-            raise Exception("Missing file "+tmpdir+RIPE_DB_FILTERSET)
-
-        # ripe.db.route-set
-        common.d("Parsing", tmpdir+RIPE_DB_ROUTESET)
-        if os.path.isfile(tmpdir+RIPE_DB_ROUTESET):
-            rs=HashObjectDir(tmpdir+RIPE_DB_ROUTESET, RouteSetObject)
-            # Add members from members-of in route objects
-            for r in ros.enumerateObjs():
-                for m in r.memberof:
-                    if m in rs.table:
-                        rs.table[m].members.append(r.getKey())
-                    else:
-                        common.w("Can not find route-set for member-of", m, "in route", r.getKey())
-
-            # Add members from members-of in route6 objects
-            for r in ros6.enumerateObjs():
-                for m in r.memberof:
-                    if m in rs.table:
-                        rs.table[m].mp_members.append(r.getKey())
-                    else:
-                        common.w("Can not find route-set for member-of", m, "in", r.getKey())
-
-            common.save_pickle(rs, ripe_routeset_pickle(d))
-        else:
-            raise Exception("Missing file "+tmpdir+RIPE_DB_ROUTESET)
-
-        # ripe.db.peering-set
-        common.d("Parsing", tmpdir+RIPE_DB_PEERINGSET)
-        if os.path.isfile(tmpdir+RIPE_DB_PEERINGSET):
-            fs=HashObjectDir(tmpdir+RIPE_DB_PEERINGSET, PeeringSetObject)
-            common.save_pickle(fs, ripe_peeringset_pickle(d))
-        else:
-            raise Exception("Missing file "+tmpdir+RIPE_DB_PEERINGSET)
-
+        prevmanifests=None
+        if prevd and ripe_snapshot_exists(prevd):
+            prevmanifests=materialize_ripe_manifests(prevd, RIPE_CLASSES.keys())
+
+        # save new objects and manifests
+        manifests=store_ripe_objects(d, tmpdir, prevmanifests)
+        save_ripe_snapshot(d, manifests, prevd, prevmanifests)
+        del prevmanifests
+        del manifests
+
+        # fingerprints for incremental checking
+        dirs=load_ripe_dirs(d, RIPE_CLASSES.keys())
+        fp=fingerprint_ripe_dirs(dirs['route'], dirs['route6'], dirs['aut-num'], dirs['as-set'],
+                                 dirs['filter-set'], dirs['route-set'], dirs['peering-set'])
+        if fp != None:
+            common.save_pickle(fp, ripe_fingerprint_pickle(d))
 
     finally:
         common.d("Removing dir", tmpdir, "expanded from", fn, "for time", d, ".")
@@ -2580,7 +5186,7 @@ def module_listdays(data_root_dir):
         yield (d,fn)
 
 
-def module_preprocess(data_root_dir, thrnum=1):
+def module_preprocess(data_root_dir, thrnum=1, budget=None, codecheck=True):
         """ Prepare datastructures for RPSL module.
         Run in multiple threads if thrnum allows it.
 
@@ -2588,87 +5194,392 @@ def module_preprocess(data_root_dir, thrnum=1):
         and consumes huge ammount of memory (at least 1G per parser). Therefore
         concurrent execution could run out of resources.
 
+        Days are saved as keyframes and deltas in calendar periods (see
+        module_preprocess_nodes()) and only stale days are rebuilt (see
+        common.run_graph()).
+
         :param str data_root_dir: Directory with BGP as well as RIPE data \
         (/{<bgphost1>, <bgphost2>, ..., ripe})
         :param int thrnum: Number of concurrent threads
+        :param int budget: Memory budget in MB for concurrent threads or None
+        :param bool codecheck: Rebuild results of a different code version
+        :returns: List of (task name, error message) of failed days
         """
-        
-        def module_prepare_thread(tasks):
-            try:
-                for t in tasks:
-                    module_prepare_day(t[0], t[1])
-            except Exception as e:
-                print str(e)
-                traceback.print_exc()
 
-        tasks = [[] for i in range(0,thrnum)]
+        return common.run_graph(module_preprocess_nodes(data_root_dir), None, thrnum, budget, codecheck)
+
+
+def preprocess_node(day):
+    """
+    :returns: Name of the build node that prepares RPSL data of the day \
+    (see module_preprocess_nodes())
+    """
+    return 'rpsl-preprocess-'+str(day)
+
+
+def process_node(day, host, ipv6):
+    """
+    :returns: Name of the build node that checks BGP dump of the day \
+    (see module_process_nodes())
+    """
+    return 'rpsl-process-%s-%s-%s'%(str(day), host, ('ipv6' if ipv6 else 'ipv4'))
+
+
+def module_preprocess_nodes(data_root_dir):
+    """ Create build nodes (see common.run_graph()) of module_preprocess().
+
+    Days are chained in calendar periods of RIPE_SNAPSHOT_KEYFRAME_INTERVAL
+    days. A day is saved as a delta against the preceding day of its period,
+    therefore it depends on it, the first day of a period is a keyframe.
+    Periods are built concurrently, a keyframe stores again only objects
+    that the store index does not know yet (see store_ripe_objects()).
+    A day saved by older versions as a delta against a day of another
+    period depends on that day as well, until it is rebuilt.
+
+    :param str data_root_dir: Data directory to search for days
+    :returns: List of common.BuildNode objects
+    """
+
+    def period(d):
+        """
+        :returns: Number of the calendar period of the day
+        """
+        return datetime.date(*d.time).toordinal()/RIPE_SNAPSHOT_KEYFRAME_INTERVAL
+
+    code=common.code_fingerprint([sys.modules[__name__]])
+    days=sorted(module_listdays(data_root_dir))
+    known=set([str(d) for (d, fn) in days])
+    nodes=[]
+    for (i, (d, fn)) in enumerate(days):
+        prevd=None
+        deps=[]
+        if i > 0 and period(days[i-1][0]) == period(d):
+            prevd=days[i-1][0]
+            deps.append(preprocess_node(prevd))
+
+        legacy=[ripe_route_pickle(d), ripe_route6_pickle(d), ripe_autnum_pickle(d), ripe_asset_pickle(d),
+                ripe_filterset_pickle(d), ripe_routeset_pickle(d), ripe_peeringset_pickle(d)]
+        outputs=[ripe_snapshot_pickle(d)]
+        if ripe_snapshot_exists(d):
+            base=common.load_pickle(ripe_snapshot_pickle(d))['base']
+            if base and str(base) in known and preprocess_node(base) not in deps:
+                deps.append(preprocess_node(base))
+        elif not [f for f in legacy if not os.path.isfile(f)]:
+            outputs=legacy
+
+        clean=([ripe_snapshot_pickle(d), ripe_fingerprint_pickle(d)]+legacy+
+               [ripe_snapshot_class_pickle(d, cls) for cls in RIPE_CLASSES])
+        nodes.append(common.BuildNode(preprocess_node(d), module_prepare_day, (fn, d, prevd), outputs,
+                                      [fn], deps, code, 'rpsl-preprocess', os.path.getsize(fn), clean))
+    return nodes
+
+
+def module_process_nodes(days, ianadir, host, ipv6, thrnum=1, incremental=False, shards=1):
+    """ Create build nodes (see common.run_graph()) of module_process().
+    A node checks a day and it depends on RPSL data of the day (see
+    module_preprocess_nodes()), its BGP dump (see bgp.module_preprocess_nodes())
+    and the IANA file.
+
+    In incremental mode days are split to chains (see day_chains()), a day
+    is checked after the preceding day of its chain and reuses its results.
+
+    :param days: List of Day objects
+    :param IanaDirectory ianadir: Pre-loaded IanaDirectory object
+    :param str host: Host to take BGP feed from
+    :param bool ipv6: IPv6 flag
+    :param int thrnum: Number of concurrent threads
+    :param bool incremental: Carry results over from the preceding day
+    :param int shards: Number of processes to split each day among
+    :returns: List of common.BuildNode objects
+    """
+
+    code=common.code_fingerprint([sys.modules[__name__], ianaspace])
+    chains=(day_chains(sorted(days), thrnum) if incremental else [[d] for d in days])
+    nodes=[]
+    for chain in chains:
+        for (i, d) in enumerate(chain):
+            prevday=(chain[i-1] if i>0 else None)
+            fn=bgp.bgpdump_pickle(d, host, ipv6)
+            outputs=[common.resultdir(d)+(RIPE_BGP2ROUTES6_PICKLE if ipv6 else RIPE_BGP2ROUTES4_PICKLE),
+                     common.resultdir(d)+(RIPE_BGP2PATHS6_PICKLE if ipv6 else RIPE_BGP2PATHS4_PICKLE)]
+            clean=[common.resultdir(d)+(RIPE_BGP2PATHS6_HOPREFS_PICKLE if ipv6 else RIPE_BGP2PATHS4_HOPREFS_PICKLE)]
+            nodes.append(common.BuildNode(process_node(d, host, ipv6), module_process_day,
+                                          (d, ianadir, host, ipv6, prevday, shards), outputs, [ianadir.listfile],
+                                          [preprocess_node(d), bgp.preprocess_node(d, host, ipv6)], code,
+                                          'rpsl-process-'+('ipv6' if ipv6 else 'ipv4'), (os.path.getsize(fn) if fn else 0),
+                                          clean, ([process_node(prevday, host, ipv6)] if prevday else [])))
+    return nodes
+
+
+def day_chains(days, thrnum):
+    """ Split days to chains of consecutive days to be processed in order
+    by one thread. There are at least thrnum chains (when there are enough
+    days) so that all threads have work.
+
+    :param days: Sorted list of Day objects (or tuples starting with Day)
+    :param int thrnum: Number of threads
+    :returns: List of lists of Day objects (or tuples)
+    """
+    length=max(1, (len(days)+thrnum-1)/thrnum)
+    return [days[i:i+length] for i in range(0, len(days), length)]
+
 
-        for i,(d,fn) in enumerate(module_listdays(data_root_dir)):
-            tasks[i%thrnum].append((fn,d))
 
-        if thrnum > 1:
-            threads=[]
-            for i in range(0,thrnum):
-                t=multiprocessing.Process(target=module_prepare_thread, args=[tasks[i]])
-                t.start()
-                threads.append(t)
+def shard_rows(rows, shards, key=None):
+    """ Split rows to shards.
+
+    :param rows: List of rows to split
+    :param int shards: Number of shards
+    :param key: Function that returns key of a row, rows with equal keys go \
+    to the same shard, or None to split rows to contiguous ranges
+    :returns: List of lists of row indexes, one list per shard
+    """
+    if key == None:
+        return [range(i*len(rows)/shards, (i+1)*len(rows)/shards) for i in range(0, shards)]
+
+    index=[[] for i in range(0, shards)]
+    for (i, r) in enumerate(rows):
+        index[hash(key(r)) % shards].append(i)
+    return index
+
+
+def run_shards(shards, work, rows, name, key=None, receive=None):
+    """ Split rows to shards (see shard_rows()) and run work(shard_rows) for
+    each shard in a forked process. Data loaded before the call (RPSL
+    directories, IanaDirectory, ...) are shared by the processes
+    copy-on-write. Garbage collector is disabled in the processes because
+    it touches (and so copies) all shared objects.
+
+    Shards send results in batches of common.RECORD_BATCH through bounded
+    queues and the results are merged in the order of rows while the shards
+    run. A shard that is SHARD_QUEUE_DEPTH batches ahead of the merge waits,
+    therefore memory does not grow with the number of rows.
+
+    :param int shards: Number of processes
+    :param work: Function that takes a list of rows and returns (results, extra), \
+    where results is an iterator with one result per row and extra is a function \
+    that returns any picklable object, it is called after each batch
+    :param rows: List of rows to split
+    :param str name: Name of the work for messages
+    :param key: Function that returns key of a row or None, see shard_rows()
+    :param receive: Function called with the extra of each batch before the \
+    results of the batch are returned or None
+    :returns: Iterator of results in the order of rows
+    :raises Exception: When a shard fails
+    """
+    index=shard_rows(rows, shards, key)
+    owner=array.array('H', [0])*len(rows)
+    for (i, idx) in enumerate(index):
+        for j in idx:
+            owner[j]=i
+    queues=[multiprocessing.Queue(SHARD_QUEUE_DEPTH) for i in range(0, shards)]
+
+    def shard_main(i):
+        """ Process main function, sends (results, extra) batches, None
+        at the end or error message
+
+        :param int i: Shard index
+        """
+        gc.disable()
+        try:
+            (results, extra)=work([rows[j] for j in index[i]])
+            batch=[]
+            for r in results:
+                batch.append(r)
+                if len(batch) >= common.RECORD_BATCH:
+                    queues[i].put((batch, extra()))
+                    batch=[]
+            queues[i].put((batch, extra()))
+            queues[i].put(None)
+        except:
+            queues[i].put(traceback.format_exc())
+            raise
 
-            for t in threads:
-                t.join()
-        else: # no threading
-            module_prepare_thread(tasks[0])
+    def get(i):
+        """ Get the next item from a shard.
 
+        :param int i: Shard index
+        :returns: (results, extra) or None at the end
+        :raises Exception: When the shard fails
+        """
+        while True:
+            try:
+                item=queues[i].get(True, SHARD_POLL)
+                break
+            except Queue.Empty:
+                if not procs[i].is_alive():
+                    try:
+                        item=queues[i].get(True, 1)
+                        break
+                    except Queue.Empty:
+                        raise Exception("Shard %d of %s died"%(i, name))
+        if isinstance(item, str):
+            raise Exception("Shard %d of %s failed: %s"%(i, name, item))
+        if item and receive:
+            receive(item[1])
+        return item
+
+    procs=[]
+    try:
+        for i in range(0, shards):
+            p=multiprocessing.Process(target=shard_main, args=[i])
+            p.start()
+            procs.append(p)
+
+        bufs=[collections.deque() for i in range(0, shards)]
+        for j in xrange(len(rows)):
+            i=owner[j]
+            while not bufs[i]:
+                item=get(i)
+                if item == None:
+                    raise Exception("Shard %d of %s returned less results than rows"%(i, name))
+                bufs[i].extend(item[0])
+            yield bufs[i].popleft()
+
+        for i in range(0, shards):
+            item=get(i)
+            while item != None:
+                if bufs[i] or item[0]:
+                    raise Exception("Shard %d of %s returned more results than rows"%(i, name))
+                item=get(i)
+
+        for p in procs:
+            p.join()
+        failed=[str(i) for (i, p) in enumerate(procs) if p.exitcode != 0]
+        if failed:
+            raise Exception("Shards "+', '.join(failed)+" of "+name+" failed")
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+            p.join()
 
 
-def module_process_day(day, ianadir, host, ipv6):
+def module_process_day(day, ianadir, host, ipv6, prevday=None, shards=1):
     """ This function is executed from module_process in multiple threads.
     This function executes check_ripe_routes() and check_ripe_paths()
     for the day in question and saves the results in proper pikcle files.
     Main function is creating the pickles eficiently - i.e. do not recreate
     already-existing results.
 
+    When prevday is given and its results are available, only the verdicts
+    that might have changed are recomputed (see IncrementalState).
+
+    Routes and paths are checked in one pass over the BGP dump (see
+    check_ripe_day()).
+
+    When shards > 1 the day data are loaded once and the BGP dump is split
+    among shards processes that share them (see run_shards()). Rows are
+    split by AS path, so that steps of equal paths are checked (and cached,
+    see PathStepCache) by one process. Results are merged in the original
+    order of the BGP dump while the shards run and they are written and
+    checkpointed the same way.
+
+    Results are streamed to record files (see common.RecordWriter), a day
+    interrupted by a crash resumes after the last checkpoint.
+
     :param Day day: Day to process
     :param IanaDirectory ianadir: Pre-loaded IanaDirectory object
     :param str host: Host to take BGP feed from
     :param bool ipv6: IPv6 flag
+    :param Day prevday: Previous day to carry still valid results from or None
+    :param int shards: Number of processes to split the day among
     """
 
     # Output filenames
     bgp2routesfn=common.resultdir(day)+(RIPE_BGP2ROUTES6_PICKLE if ipv6 else RIPE_BGP2ROUTES4_PICKLE)
     bgp2pathsfn=common.resultdir(day)+(RIPE_BGP2PATHS6_PICKLE if ipv6 else RIPE_BGP2PATHS4_PICKLE)
+    hoprefsfn=common.resultdir(day)+(RIPE_BGP2PATHS6_HOPREFS_PICKLE if ipv6 else RIPE_BGP2PATHS4_HOPREFS_PICKLE)
 
-    # check routes
-    pfx_path_check_worthy={}
-    res=None
-    if not os.path.isfile(bgp2routesfn):
-        common.d("Checking routes. Creating file", bgp2routesfn)
-        res=list(check_ripe_routes(day, ianadir, host, ipv6, True))
-        common.save_pickle(res, bgp2routesfn)
-    else:
-        if not os.path.isfile(bgp2pathsfn):
-            res=common.load_pickle(bgp2routesfn)
-        else:
-            return # shortcut - we are not going to analyze anything, just stop
+    if os.path.isfile(bgp2routesfn) and os.path.isfile(bgp2pathsfn):
+        return # shortcut - we are not going to analyze anything, just stop
 
-    # filter routes to be checked by path_check
-    for r in res:
-        if r[3] == 0 or r[3] == 5: # match or non-RIPE (=unknown)
-            pfx_path_check_worthy[r[0]] = True
+    carry=None
+    if prevday:
+        carry=IncrementalState.load(prevday, day, ipv6)
 
+    # only the best routes are checked, each of them gives one result
+    bgpdump=[pv for pv in common.load_pickle(bgp.bgpdump_pickle(day, host, ipv6))
+             if pv[0] and '>' in pv[0]]
 
-    # free bgp2routes
-    del res
-    gc.collect()
+    common.d("Checking routes and paths. Creating files", bgp2routesfn, bgp2pathsfn)
+    hoprefs=collections.OrderedDict()
+    saved=[0]
+
+    def new_hoprefs():
+        """ Hop references are saved with the frames of results for resuming.
+
+        :returns: List of hop references added since the previous frame
+        """
+        h=list(itertools.islice(hoprefs.iteritems(), saved[0], None))
+        saved[0]=len(hoprefs)
+        return h
+
+    # both files are checkpointed together
+    routes=common.RecordWriter(bgp2routesfn, None, common.RECORD_BATCH, None)
+    paths=common.RecordWriter(bgp2pathsfn, new_hoprefs, common.RECORD_BATCH, None)
+    if routes.count != paths.count:
+        common.w("Checkpoints of", bgp2routesfn, "and", bgp2pathsfn, "differ, starting over")
+        routes.abort()
+        paths.abort()
+        routes=common.RecordWriter(bgp2routesfn, None, common.RECORD_BATCH, None)
+        paths=common.RecordWriter(bgp2pathsfn, new_hoprefs, common.RECORD_BATCH, None)
+    for (records, h) in paths.frames():
+        hoprefs.update(h)
+    saved[0]=len(hoprefs)
+    rows=bgpdump[paths.count:]
+
+    if shards > 1:
+        cls=('route6' if ipv6 else 'route')
+        riperoutes=load_ripe_dirs(day, [cls])[cls]
+        dirs=load_ripe_path_dirs(day, False)
+
+        def work(rows):
+            """ Check routes and paths of a shard
+
+            :param rows: Path vectors to check
+            :returns: (results, function that returns hop references added \
+            since its previous call)
+            """
+            h=collections.OrderedDict()
+            sent=[0]
+
+            def new_hoprefs():
+                r=list(itertools.islice(h.iteritems(), sent[0], None))
+                sent[0]=len(h)
+                return r
+
+            return (check_ripe_day(day, ianadir, host, ipv6, MY_ASN, carry, h, riperoutes, dirs, rows), new_hoprefs)
+
+        res=run_shards(shards, work, rows, bgp2pathsfn, lambda pv: pv[3], hoprefs.update)
+    else:
+        res=check_ripe_day(day, ianadir, host, ipv6, MY_ASN, carry, hoprefs, None, None, rows)
+
+    last=time.time()
+    try:
+        for (r, p) in res:
+            routes.write(r)
+            if paths.write(p) and time.time()-last >= common.RECORD_CHECKPOINT:
+                routes.checkpoint()
+                paths.checkpoint()
+                last=time.time()
+    finally:
+        res.close() # stops shard processes on errors
     res=None
+    riperoutes=None
+    dirs=None
+
+    routes.flush()
+    paths.flush()
+    common.save_pickle(dict(hoprefs), hoprefsfn)
+    routes.close()
+    paths.close()
 
-    # check paths
-    if not os.path.isfile(bgp2pathsfn):
-        common.d("Checking paths. Creating file", bgp2pathsfn)
-        res=list(check_ripe_paths(day, ianadir, host, ipv6, True, MY_ASN, pfx_path_check_worthy))
-        common.save_pickle(res, bgp2pathsfn)
+    if carry != None:
+        common.d("Incremental check for day", day, ':', str(carry))
 
 
-def module_process(days, ianadir, host, ipv6, thrnum=1):
+def module_process(days, ianadir, host, ipv6, thrnum=1, incremental=False, shared=False, budget=None):
     """ Module main interface.
 
     Plan:
@@ -2690,53 +5601,187 @@ def module_process(days, ianadir, host, ipv6, thrnum=1):
     data for that day.
 
     Warning: The checking phase needs a lot of memory (~1-2G per thread).
-    Running multiple instances concurrently might run out of resources.
+    Running multiple instances concurrently might run out of resources
+    unless a memory budget is given.
+
+    Threads pull days from a shared queue, the largest BGP dumps first (see
+    common.run_tasks()). A failed day is reported and the others go on.
+    With a memory budget less threads run when their measured peak memory
+    does not fit the budget.
+
+    In incremental mode each day reuses still valid results of the preceding
+    day, therefore days are processed in order in chains of consecutive days
+    (see day_chains()) that are pulled as a whole.
+
+    In shared mode days are processed one by one, each day is loaded once
+    and its BGP dump is split among thrnum processes that share the loaded
+    data (memory of one day instead of thrnum days is needed). Shared mode
+    is used as well when less than thrnum days need processing.
 
     :param days: List of Day objects
     :param IanaDirectory ianadir: Pre-loaded IanaDirectory object
     :param str host: Host to take BGP feed from
     :param bool ipv6: IPv6 flag
     :param int thrnum: Number of concurrent threads
+    :param bool incremental: Carry results over from the preceding day
+    :param bool shared: Split each day among the threads
+    :param int budget: Memory budget in MB for concurrent threads or None \
+    (see common.run_tasks()), it does not apply to shared mode
+    :returns: List of (task name, error message) of failed days
     """
 
-    def module_process_thread(tasks):
-        """ Thread main function
+    def day_cost(d):
+        """ Estimate cost of the day by the size of its BGP dump.
 
-        :param tasks: List of task tuples assigned to this thread
-        :raises Exception: When a threading error happen
+        :param Day d: Day to estimate
+        :returns: Cost estimate
         """
-        try:
-            for t in tasks:
-                module_process_day(*t)
-        except Exception as e:
-            print str(e)
-            traceback.print_exc()
+        fn=bgp.bgpdump_pickle(d, host, ipv6)
+        bgp2routesfn=common.resultdir(d)+(RIPE_BGP2ROUTES6_PICKLE if ipv6 else RIPE_BGP2ROUTES4_PICKLE)
+        bgp2pathsfn=common.resultdir(d)+(RIPE_BGP2PATHS6_PICKLE if ipv6 else RIPE_BGP2PATHS4_PICKLE)
+        if fn == None or (os.path.isfile(bgp2routesfn) and os.path.isfile(bgp2pathsfn)):
+            return 0 # nothing to do or missing BGP dump
+        return os.path.getsize(fn)
 
+    def day_step(d, prevday, shards=1):
+        """
+        :returns: Task step processing the day (see common.run_tasks())
+        """
+        return ('RPSL process %s %s %s'%(str(d), host, ('IPv6' if ipv6 else 'IPv4')),
+                module_process_day, (d, ianadir, host, ipv6, prevday, shards))
+
+    if thrnum > 1 and not shared and len([d for d in days if day_cost(d) > 0]) < thrnum:
+        common.d('Less days to process than threads, splitting days among threads.')
+        shared=True
+
+    if shared and thrnum > 1:
+        # one task, days in order
+        days=sorted(days)
+        steps=[day_step(d, (days[i-1] if incremental and i>0 else None), thrnum) for (i, d) in enumerate(days)]
+        return common.run_tasks([(0, steps)], 1)
+
+    tasks=[]
+    if incremental:
+        # chains of consecutive days, the first day of a chain is fully checked
+        for chain in day_chains(sorted(days), thrnum):
+            tasks.append((sum([day_cost(d) for d in chain]),
+                          [day_step(d, (chain[i-1] if i>0 else None)) for (i, d) in enumerate(chain)]))
+    else:
+        for d in days:
+            tasks.append((day_cost(d), [day_step(d, None)]))
 
-    tasks=[[] for i in range(0,thrnum)]
-    thrindex=0
-    for d in days:
-        if thrnum > 1:
-            common.d('Considering data for day:', str(d), 'thread index:', str(thrindex%thrnum))
-            tasks[thrindex%thrnum].append((d, ianadir, host, ipv6))
-            thrindex+=1
-        else:
-            # run single-threaded worker
-            common.d('Considering data for day:', str(d), 'single-threaded.')
-            module_process_day(d, ianadir, host, ipv6)
+    return common.run_tasks(tasks, thrnum, 'rpsl-process-'+('ipv6' if ipv6 else 'ipv4'), budget)
+
+    
+def _context_records(name, ipv4file, ipv6file):
+    """ Internal function. Do not use.
+    Create loader of a day context item that streams check results of the day
+    (see common.read_records()). The stream is not kept in the context.
+
+    :param str name: Item name
+    :param str ipv4file: Result file of IPv4 checks relative to the result dir
+    :param str ipv6file: Result file of IPv6 checks relative to the result dir
+    """
+    def load(ctx):
+        fn=common.resultdir(ctx.day)+(ipv6file if ctx.ipv6 else ipv4file)
+        if not os.path.isfile(fn):
+            raise Exception('Can not load '+fn)
+        return common.read_records(fn)
+
+    common.DayContext.register(name, load, False)
+
+_context_records('rpsl-routes', RIPE_BGP2ROUTES4_PICKLE, RIPE_BGP2ROUTES6_PICKLE)
+_context_records('rpsl-paths', RIPE_BGP2PATHS4_PICKLE, RIPE_BGP2PATHS6_PICKLE)
+
+
+class RipeAnalysis(object):
+    """ Postprocess of RIPE check results (see module_postprocess() and
+    common.visit_days()).
+    """
+
+    def __init__(self, ipv6):
+        """
+        :param bool ipv6: IPv6 flag
+        """
+        self.ipv6=ipv6
+        self.days=[]
+        self.route_totals=[]
+        self.route_violators={}
+        self.path_totals=[]
+        self.path_totals_detail=[]
+        self.path_stats=[]
+
+
+    def note_violators(self, res):
+        """ Pass route check results through and note route violators.
+
+        :param res: Iterator of check_ripe_routes() results
+        :returns: Iterator of the same results
+        """
+        for r in res:
+            if r[3]==3 or r[3]==4: # not match or not found
+                self.route_violators[r[0]] = True
+            yield r
+
+
+    def visit(self, ctx):
+        """ Generate reports of the day.
+
+        :param ctx: common.DayContext of the day
+        """
+        day=ctx.day
+        ipv6=self.ipv6
+        self.days.append(day)
+
+        # Generate report for routes and filter route violators
+        self.route_totals.append(report_ripe_routes_day(self.note_violators(ctx.get('rpsl-routes')),
+                                                        day, common.resultdir(day), ipv6))
+
+        path_res=report_ripe_paths_day(ctx.get('rpsl-paths'), day, common.resultdir(day), ipv6)
+        self.path_totals.append(path_res[0])
+        self.path_totals_detail.append(path_res[1])
+        self.path_stats.append(path_res[2])
+
+
+    def finish(self):
+        """ Generate graphs and timelines of all visited days.
+        """
+        ipv6=self.ipv6
+
+        # Graph route totals
+        if self.route_totals:
+            common.d("Generating graph with pfx", common.resultdir()+'/bgp2routes'+('6' if ipv6 else '4'))
+            graph.gen_multilineplot(self.route_totals, common.resultdir()+'/bgp2routes'+('6' if ipv6 else '4'),
+                                    legend=RIPE_ROUTES_MATCH_LEGEND, ylabel="\# of pfxes")
+
+        # Revisit common.resultdir(d)+RIPE_BGP2ROUTES_PICKLE for each day and cross check time to fix
+        if self.route_violators:
+            common.d("Crating route timeline...")
+#            tl=ripe_gen_route_timeline(self.route_violators.keys(), self.days, ipv6)
+#            report_route_timeline(tl, ipv6)
+            ripe_gen_route_timeline_files(self.route_violators.keys(), self.days, ipv6)
+
+        # Graph path totals
+        if self.path_totals:
+            common.d("Generating graph with pfx", common.resultdir()+'/bgp2paths'+('6' if ipv6 else '4'))
+            graph.gen_multilineplot(self.path_totals, common.resultdir()+'/bgp2paths'+('6' if ipv6 else '4'),
+                                    legend=RIPE_PATHS_MATCH_LEGEND, ylabel="\# of pfxes")
+
+        if self.path_totals_detail:
+            common.d("Generating graph with pfx", common.resultdir()+'/bgp2paths-detail'+('6' if ipv6 else '4'))
+            graph.gen_multilineplot(self.path_totals_detail,
+                                    common.resultdir()+'/bgp2paths-detail'+('6' if ipv6 else '4'),
+                                    legend=RIPE_PATHS_MATCH_DET_LEGEND, ylabel="\# of pfxes")
+
+        if self.path_stats:
+            common.d("Generating graph with pfx", common.resultdir()+'/bgp2paths-stats'+('6' if ipv6 else '4'))
+            graph.gen_multilineplot(self.path_stats,
+                                    common.resultdir()+'/bgp2paths-stats'+('6' if ipv6 else '4'),
+                                    legend=['Errors per path', 'Dunno per path', 'Avg path len'],
+                                    ylabel="\# of occurences")
 
-    # run worker threads
-    if thrnum > 1:
-        threads=[]
-        for i in range(0,thrnum):
-            t=multiprocessing.Process(target=module_process_thread, args=[tasks[i]])
-            t.start()
-            threads.append(t)
 
-        for t in threads:
-            t.join()
 
-    
 def module_postprocess(days, ianadir, host, ipv6):
     """ Module main interface. Run postprocess (generate graphs and text outputs).
 
@@ -2745,83 +5790,18 @@ def module_postprocess(days, ianadir, host, ipv6):
     check results form module_process just load the results and count
     numbers for graphs and text outputs and write them.
 
+    Results are streamed from the record files (see common.read_records())
+    in one pass per day, therefore memory does not grow with the size of
+    the BGP table. run_all visits days with RipeAnalysis together with other
+    analyses instead (see common.visit_days()).
+
     :param days: List of Day objects
     :param IanaDirectory ianadir: Pre-loaded IanaDirectory object
     :param str host: Host to take BGP feed from
     :param bool ipv6: IPv6 flag
     """
 
-    route_totals=[]
-    route_violators={}
-    path_totals=[]
-    path_totals_detail=[]
-    path_stats=[]
-
-    for day in days:   
-        # Load check route results
-        bgp2routesfn=common.resultdir(day)+(RIPE_BGP2ROUTES6_PICKLE if ipv6 else RIPE_BGP2ROUTES4_PICKLE)
-        if os.path.isfile(bgp2routesfn):
-            res=common.load_pickle(bgp2routesfn)
-        else:
-            raise Exception('Can not load '+bgp2routesfn)
-
-        # Generate report for routes
-        route_totals.append(report_ripe_routes_day(res, day, common.resultdir(day), ipv6))
-
-        # Filter route violators
-        for r in res:
-            if r[3]==3 or r[3]==4: # not match or not found
-                route_violators[r[0]] = True
-
-        # free bgp2routes
-        del res
-        gc.collect()
-        res=None
-
-        # Load check paths results
-        bgp2pathsfn=common.resultdir(day)+(RIPE_BGP2PATHS6_PICKLE if ipv6 else RIPE_BGP2PATHS4_PICKLE)
-        if os.path.isfile(bgp2pathsfn):
-            res=common.load_pickle(bgp2pathsfn)
-        else:
-            raise Exception('Can not load '+bgp2pathsfn)
-
-        path_res=report_ripe_paths_day(res, day, common.resultdir(day), ipv6)
-        path_totals.append(path_res[0])
-        path_totals_detail.append(path_res[1])
-        path_stats.append(path_res[2])
-    
-    # Graph route totals
-    if route_totals:
-        common.d("Generating graph with pfx", common.resultdir()+'/bgp2routes'+('6' if ipv6 else '4'))
-        graph.gen_multilineplot(route_totals, common.resultdir()+'/bgp2routes'+('6' if ipv6 else '4'),
-                                legend=RIPE_ROUTES_MATCH_LEGEND, ylabel="\# of pfxes")
-
-    # Revisit common.resultdir(d)+RIPE_BGP2ROUTES_PICKLE for each day and cross check time to fix
-    if route_violators:
-        common.d("Crating route timeline...")
-#        tl=ripe_gen_route_timeline(route_violators.keys(), days, ipv6)
-#        report_route_timeline(tl, ipv6)
-        ripe_gen_route_timeline_files(route_violators.keys(), days, ipv6)
-
-    # Graph path totals
-    if path_totals:
-        common.d("Generating graph with pfx", common.resultdir()+'/bgp2paths'+('6' if ipv6 else '4'))
-        graph.gen_multilineplot(path_totals, common.resultdir()+'/bgp2paths'+('6' if ipv6 else '4'),
-                                legend=RIPE_PATHS_MATCH_LEGEND, ylabel="\# of pfxes")
-
-    if path_totals_detail:
-        common.d("Generating graph with pfx", common.resultdir()+'/bgp2paths-detail'+('6' if ipv6 else '4'))
-        graph.gen_multilineplot(path_totals_detail,
-                                common.resultdir()+'/bgp2paths-detail'+('6' if ipv6 else '4'),
-                                legend=RIPE_PATHS_MATCH_DET_LEGEND, ylabel="\# of pfxes")
-
-
-    if path_stats:
-        common.d("Generating graph with pfx", common.resultdir()+'/bgp2paths-stats'+('6' if ipv6 else '4'))
-        graph.gen_multilineplot(path_stats,
-                                common.resultdir()+'/bgp2paths-stats'+('6' if ipv6 else '4'),
-                                legend=['Errors per path', 'Dunno per path', 'Avg path len'],
-                                ylabel="\# of occurences")
+    common.visit_days(days, host, ipv6, [RipeAnalysis(ipv6)], ianadir)
 
 
 
@@ -28,6 +28,7 @@
 
 import os
 import re
+import sys
 import argparse
 
 import common
@@ -66,26 +67,68 @@ def get_available_days():
         days = common.intersect(days, ripe)
         return sorted(list(days))
 
-def preprocess_data(threads=1):
+def preprocess_nodes():
+        """ Create build nodes of preprocess (see common.run_graph()).
+
+        :returns: List of common.BuildNode objects
+        """
+
+        nodes=rpsl.module_preprocess_nodes(DATA_DIR)
+        for ipv6 in [False,True]:
+                nodes+=bgp.module_preprocess_nodes(BGP_HOSTS, BGP_DATA, ipv6)
+        return nodes
+
+
+
+def preprocess_data(threads=1, budget=None, codecheck=True):
         """
         Preprocess data. Meaning: Read textual data and create proper Python datastructures
         and save them in form of pickles. This should not be much time consuming and it has
         to be done on the one place (at least the code counts on in to some extent).
 
+        Only stale results are rebuilt, i.e. results of changed data or code
+        (see common.run_graph()).
+
         :param int threads: Number of threads to run
+        :param int budget: Memory budget in MB or None
+        :param bool codecheck: Rebuild results of a different code version
+        :returns: List of (task name, error message) of failed tasks
         """
         
-        # Prepare RPSL parsing products
-        rpsl.module_preprocess(DATA_DIR, threads)
+        # Prepare RPSL parsing products and create BGP data in result directories
+        # (= ROOT/results/2014-04-01/bgp4-marge.pickle).
+        # Use filename_bgp_pickle_for_day() to get the filename.
+        return common.run_graph(preprocess_nodes(), None, threads, budget, codecheck)
+
 
+
+def process_nodes(days, threads=1, incremental=False, shards=1):
+        """ Create build nodes of process (see common.run_graph()).
+
+        :param days: Days that forms the workpackage
+        :param int threads: Threads to run
+        :param bool incremental: Reuse still valid results of preceding days
+        :param int shards: Processes to split each day among
+        :returns: List of common.BuildNode objects
+        """
+
+        nodes=[]
         for ipv6 in [False,True]:
-                # Create BGP data in result directories (= ROOT/results/2014-04-01/bgp4-marge.pickle).
-                # Use filename_bgp_pickle_for_day() to get the filename.
-                bgp.module_preprocess(BGP_HOSTS, BGP_DATA, ipv6)
+                # Initialize ianaspace's IanaDirectory object for the current AF.
+                ifn = (IANA_IPV6 if ipv6 else IANA_IPV4)
+                ianadir=ianaspace.iana_directory(ifn,ipv6)
 
+                for host in BGP_HOSTS:
+                        # Run RPSL matching (routes and paths)
+                        nodes+=rpsl.module_process_nodes(days, ianadir, host, ipv6, threads, incremental, shards)
+
+                        # Summarize BGP dumps for postprocess timelines
+                        nodes+=bgp.module_summary_nodes(days, ianadir, host, ipv6)
+        return nodes
 
 
-def process_workpackage(days, threads=1):
+
+def process_workpackage(days, threads=1, incremental=False, shared=False, budget=None, codecheck=True):
         """
         This function contains the most time consuming work that has to be done for
         each day but it does not aggregate days. Meaning: Days can be processed concurently.
@@ -93,18 +136,104 @@ def process_workpackage(days, threads=1):
         module. Another is achieved by splitting workpackages and distributing them over
         different servers.
 
+        Only stale results are rebuilt (see common.run_graph()), stale
+        preprocess results of the days are rebuilt first.
+
         :param days: Days that forms the workpackage
         :param int threads: Threads to run
+        :param bool incremental: Reuse still valid results of preceding days
+        :param bool shared: Split each day among the threads instead of days
+        :param int budget: Memory budget in MB or None
+        :param bool codecheck: Rebuild results of a different code version
+        :returns: List of (task name, error message) of failed tasks
         """
 
-        for ipv6 in [False,True]:
-                # Initialize ianaspace's IanaDirectory object for the current AF.
-                ifn = (IANA_IPV6 if ipv6 else IANA_IPV4)
-                ianadir=ianaspace.IanaDirectory(ifn,ipv6)
+        pre=preprocess_nodes()
+        nodes=process_nodes(days, threads, incremental)
+        targets=[n.name for n in nodes]
+
+        if threads > 1 and not shared:
+                (stale, keys, missing)=common.plan_graph(pre+nodes, targets, codecheck)
+                if len(set(stale) & set(targets)) < threads:
+                        common.d('Less days to process than threads, splitting days among threads.')
+                        shared=True
+
+        if shared and threads > 1:
+                # preprocess in threads, then one day at a time in one chain
+                known=set([n.name for n in pre])
+                failed=common.run_graph(pre, [dep for n in nodes for dep in n.deps if dep in known],
+                                        threads, budget, codecheck)
+                if failed:
+                        return failed
+                return common.run_graph(pre+process_nodes(days, 1, incremental, threads), targets, 1, None, codecheck)
+
+        return common.run_graph(pre+nodes, targets, threads, budget, codecheck)
+
+
+
+def cluster_tasks(days, codecheck=True):
+        """ Create cluster tasks for the days. There is one task
+        for each day, BGP host and address family.
+
+        :param days: Days that form the workpackage
+        :param bool codecheck: Rebuild results of a different code version
+        :returns: List of (name, cost, spec) (see common.publish_cluster_tasks())
+        """
 
+        tasks=[]
+        for ipv6 in [False,True]:
                 for host in BGP_HOSTS:
-                        # Run RPSL matching (routes and paths)
-                        rpsl.module_process(days, ianadir, host, ipv6, threads)
+                        for d in days:
+                                fn=bgp.bgpdump_pickle(d, host, ipv6)
+                                tasks.append(('%s-%s-%s'%(str(d), host, ('ipv6' if ipv6 else 'ipv4')),
+                                              (os.path.getsize(fn) if fn else 0), (d.time, host, ipv6, codecheck)))
+        return tasks
+
+
+
+def cluster_task_targets(spec):
+        """
+        :param spec: (day time tuple, host, ipv6, codecheck) (see cluster_tasks())
+        :returns: List of names of build nodes the task builds
+        """
+
+        (t, host, ipv6, codecheck)=spec
+        return [rpsl.process_node(common.Day(t), host, ipv6), bgp.summary_node(common.Day(t), host, ipv6)]
+
+
+
+def stale_cluster_tasks(days, tasks, codecheck=True):
+        """ Find tasks with stale results (see common.plan_graph()).
+
+        :param days: Days that form the workpackage
+        :param tasks: List of (name, cost, spec) (see cluster_tasks())
+        :param bool codecheck: Rebuild results of a different code version
+        :returns: List of names of the stale tasks
+        """
+
+        (stale, keys, missing)=common.plan_graph(preprocess_nodes()+process_nodes(days),
+                                                 [n for (name, cost, spec) in tasks for n in cluster_task_targets(spec)],
+                                                 codecheck)
+        stale=set(stale+[name for (name, err) in missing])
+        return [name for (name, cost, spec) in tasks if set(cluster_task_targets(spec)) & stale]
+
+
+
+def process_cluster_task(spec):
+        """ Process one cluster task on a worker node. Stale results of the
+        task are rebuilt (see common.run_graph()).
+
+        :param spec: (day time tuple, host, ipv6, codecheck) (see cluster_tasks())
+        """
+
+        (t, host, ipv6, codecheck)=spec
+        ifn = (IANA_IPV6 if ipv6 else IANA_IPV4)
+        ianadir=ianaspace.iana_directory(ifn,ipv6)
+        nodes=(preprocess_nodes()+rpsl.module_process_nodes([common.Day(t)], ianadir, host, ipv6)+
+               bgp.module_summary_nodes([common.Day(t)], ianadir, host, ipv6))
+        failed=common.run_graph(nodes, cluster_task_targets(spec), 1, None, codecheck)
+        if failed:
+                raise Exception('%s: %s'%failed[0])
 
 
 
@@ -117,17 +246,16 @@ def postprocess_workpackage(days):
 
         for ipv6 in [False,True]:
                 ifn = (IANA_IPV6 if ipv6 else IANA_IPV4)
-                ianadir=ianaspace.IanaDirectory(ifn,ipv6)
+                ianadir=ianaspace.iana_directory(ifn,ipv6)
                 
                 for host in BGP_HOSTS:
-                        # Run basic BGP stats
-                        bgp.module_postprocess(host, days, ipv6)
-
-                        # Run basic BGP stats with regards to IANA top-level assignments
-                        ianaspace.module_process(ianadir, host, days, ipv6, bestonly=True)
-
-                        # Generate advanced RPSL matching stats
-                        rpsl.module_postprocess(days, ianadir, host, ipv6)
+                        # Visit each day once with all analyses:
+                        # basic BGP stats, BGP stats with regards to IANA
+                        # top-level assignments and advanced RPSL matching stats
+                        common.visit_days(days, host, ipv6,
+                                          [bgp.PathLengthAnalysis(host, ipv6),
+                                           ianaspace.RirAnalysis(host, ipv6, bestonly=True),
+                                           rpsl.RipeAnalysis(ipv6)], ianadir)
 
 
 
@@ -163,6 +291,18 @@ def read_days(filename):
 
 
 
+def report_failures(failed):
+        """ Report failed tasks and end when there are any.
+
+        :param failed: List of (task name, error message)
+        """
+        if failed:
+                for (name, err) in failed:
+                        common.w("FAILED:", name, ":", err)
+                sys.exit(1)
+
+
+
 def main():
         """ run_all.py entrypoint. Everything starts here! """
 
@@ -178,6 +318,18 @@ def main():
         parser.add_argument('--listdays', dest='listdays', action='store_true',
                             help='list only available days and end')
         parser.add_argument('--threads', dest='thr', type=int, action='store', help='run THR threads', default=1)
+        parser.add_argument('--incremental', dest='incremental', action='store_true',
+                            help='reuse results of the preceding day for unchanged routes and paths')
+        parser.add_argument('--shared', dest='shared', action='store_true',
+                            help='process one day at a time in THR threads sharing the day data')
+        parser.add_argument('--mem-budget', dest='membudget', type=int, action='store',
+                            help='run less than THR threads when they would need more than MEMBUDGET MB')
+        parser.add_argument('--cluster', dest='cluster', action='store', choices=['coordinator', 'worker'],
+                            help='share the process work over nodes with common results directory')
+        parser.add_argument('--lease', dest='lease', type=int, action='store', default=common.CLUSTER_LEASE,
+                            help='reclaim cluster tasks of nodes silent for LEASE seconds')
+        parser.add_argument('--ignore-code', dest='codecheck', action='store_false',
+                            help='do not rebuild results built by a different code version')
         args = parser.parse_args()
         doall = (True if not args.preproc and not args.proc and not args.postproc else False)
 
@@ -199,13 +351,37 @@ def main():
                         print str(d)
                 return
 
+        if args.cluster == 'worker':
+                common.run_cluster_worker(process_cluster_task, args.thr, args.lease)
+                return
+
+        if args.cluster == 'coordinator' and (doall or args.proc):
+                # workers wait until preprocess ends
+                common.unpublish_cluster_tasks()
+
         if doall or args.preproc:
-                preprocess_data(args.thr)
+                report_failures(preprocess_data(args.thr, args.membudget, args.codecheck))
                 if args.preproc:
                         return
 
         if doall or args.proc:
-                process_workpackage(days, args.thr)
+                if args.cluster == 'coordinator':
+                        tasks=cluster_tasks(days, args.codecheck)
+                        common.publish_cluster_tasks(tasks, stale_cluster_tasks(days, tasks, args.codecheck))
+                        common.run_cluster_worker(process_cluster_task, args.thr, args.lease)
+                else:
+                        report_failures(process_workpackage(days, args.thr, args.incremental, args.shared, args.membudget,
+                                                            args.codecheck))
+                if args.proc and not args.cluster:
+                        return
+
+        if args.cluster == 'coordinator':
+                # postprocess when all nodes are done
+                failed=common.wait_cluster_tasks()
+                if failed == None:
+                        common.w("No cluster tasks are published, nothing to wait for")
+                        failed=[]
+                report_failures(failed)
                 if args.proc:
                         return
 